@@ -4,7 +4,7 @@ import json
 from pathlib import Path
 from typing import Any, List
 
-from pydantic import Field
+from pydantic import Field, model_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -92,10 +92,22 @@ class Settings(BaseSettings):
     # --- Web server (health + CryptoPay webhook) ---
     web_server_host: str = Field("0.0.0.0", alias="WEB_SERVER_HOST")
     web_server_port: int = Field(8080, alias="WEB_SERVER_PORT")
+    # GET /stats/<STATS_SECRET> (disabled if empty)
+    stats_secret: str | None = Field(None, alias="STATS_SECRET")
+    # GET /metrics (Prometheus text) with "Authorization: Bearer <METRICS_TOKEN>" (disabled if empty)
+    metrics_token: str | None = Field(None, alias="METRICS_TOKEN")
+
+    # --- Tracing: slow updates always kept, the rest sampled; empty TRACE_FILE disables ---
+    trace_file: str = Field("data/traces.jsonl", alias="TRACE_FILE")
+    trace_sample_rate: float = Field(0.01, alias="TRACE_SAMPLE_RATE")
+    trace_slow_ms: int = Field(3000, alias="TRACE_SLOW_MS")
+    trace_max_mb: int = Field(50, alias="TRACE_MAX_MB")
 
     # --- Schedulers ---
     checkin_hour: int = Field(22, alias="CHECKIN_HOUR")
     checkin_minute: int = Field(0, alias="CHECKIN_MINUTE")
+    # check-ins are spread over this many minutes after CHECKIN_HOUR:MINUTE, user's local time
+    checkin_window_min: int = Field(60, alias="CHECKIN_WINDOW_MIN")
     fact_hour: int = Field(10, alias="FACT_HOUR")
     fact_minute: int = Field(0, alias="FACT_MINUTE")
 
@@ -112,11 +124,73 @@ class Settings(BaseSettings):
     perplexity_base_url: str = Field("https://api.perplexity.ai", alias="PERPLEXITY_BASE_URL")
     perplexity_model: str = Field("sonar-pro", alias="PERPLEXITY_MODEL")
 
+    # --- LLM pipeline ---
+    max_context_messages: int = Field(16, alias="MAX_CONTEXT_MESSAGES")
+    # Rolling summary: turns older than the last RECENT_CONTEXT_MESSAGES go into users.long_memory
+    enable_summarizer: bool = Field(True, alias="ENABLE_SUMMARIZER")
+    recent_context_messages: int = Field(6, alias="RECENT_CONTEXT_MESSAGES")
+    long_memory_max_chars: int = Field(1500, alias="LONG_MEMORY_MAX_CHARS")
+    summarize_delay_sec: int = Field(30, alias="SUMMARIZE_DELAY_SEC")
+    enable_pro_research: bool = Field(True, alias="ENABLE_PRO_RESEARCH")
+    enable_formatter_pass: bool = Field(True, alias="ENABLE_FORMATTER_PASS")
+    # What a new message does to an answer still streaming: cancel | queue | merge
+    generation_policy: str = Field("cancel", alias="GENERATION_POLICY")
+    # Deferred mode: heavy pro requests are answered by a background worker pool
+    enable_deferred_mode: bool = Field(False, alias="ENABLE_DEFERRED_MODE")
+    deferred_workers: int = Field(2, alias="DEFERRED_WORKERS")
+    deferred_min_chars: int = Field(1500, alias="DEFERRED_MIN_CHARS")
+
+    # --- Streaming preview edits (Telegram flood limits) ---
+    edits_global_per_sec: float = Field(25.0, alias="EDITS_GLOBAL_PER_SEC")
+    edits_min_interval_sec: float = Field(0.9, alias="EDITS_MIN_INTERVAL_SEC")
+    edits_max_interval_sec: float = Field(5.0, alias="EDITS_MAX_INTERVAL_SEC")
+
+    # --- Broadcasts (daily check-ins, admin mailings) ---
+    broadcast_per_sec: float = Field(20.0, alias="BROADCAST_PER_SEC")
+    broadcast_concurrency: int = Field(16, alias="BROADCAST_CONCURRENCY")
+    broadcast_batch_size: int = Field(500, alias="BROADCAST_BATCH_SIZE")
+
+    # --- LLM admission control (max concurrent upstream requests per provider) ---
+    llm_concurrency_deepseek: int = Field(16, alias="LLM_CONCURRENCY_DEEPSEEK")
+    llm_concurrency_perplexity: int = Field(4, alias="LLM_CONCURRENCY_PERPLEXITY")
+
+    # --- LLM quota pacing (0 = unknown, learned from x-ratelimit-* headers) ---
+    deepseek_rpm: int = Field(0, alias="DEEPSEEK_RPM")
+    deepseek_tpm: int = Field(0, alias="DEEPSEEK_TPM")
+    perplexity_rpm: int = Field(50, alias="PERPLEXITY_RPM")
+    perplexity_tpm: int = Field(0, alias="PERPLEXITY_TPM")
+
+    # --- Multi-process mode: one ingress + WORKERS update workers (0 = single process) ---
+    workers: int = Field(0, alias="WORKERS")
+    worker_socket: str = Field("data/ingress.sock", alias="WORKER_SOCKET")
+    worker_max_inflight: int = Field(64, alias="WORKER_MAX_INFLIGHT")
+
+    # --- Telegram updates: long polling (default) or webhook ---
+    telegram_webhook_enabled: bool = Field(False, alias="TELEGRAM_WEBHOOK_ENABLED")
+    telegram_webhook_url: str | None = Field(None, alias="TELEGRAM_WEBHOOK_URL")
+    telegram_webhook_path: str = Field("/tg/webhook", alias="TELEGRAM_WEBHOOK_PATH")
+    telegram_webhook_secret: str | None = Field(None, alias="TELEGRAM_WEBHOOK_SECRET")
+    telegram_webhook_max_pending: int = Field(256, alias="TELEGRAM_WEBHOOK_MAX_PENDING")
+    # Several instances behind one URL: only one of them should call setWebhook
+    telegram_webhook_set_on_start: bool = Field(True, alias="TELEGRAM_WEBHOOK_SET_ON_START")
+
     # --- CryptoPay ---
     cryptopay_api_token: str | None = Field(None, alias="CRYPTOPAY_API_TOKEN")
     cryptopay_base_url: str = Field("https://pay.crypt.bot/api", alias="CRYPTOPAY_BASE_URL")
     cryptopay_webhook_secret: str | None = Field(None, alias="CRYPTOPAY_WEBHOOK_SECRET")
     cryptopay_webhook_url: str | None = Field(None, alias="CRYPTOPAY_WEBHOOK_URL")
+    # reconciliation sweep over all active invoices (for lost webhooks)
+    invoice_sync_interval_min: int = Field(5, alias="INVOICE_SYNC_INTERVAL_MIN")
+    invoice_sync_batch: int = Field(100, alias="INVOICE_SYNC_BATCH")
+    invoice_expiry_grace_sec: int = Field(600, alias="INVOICE_EXPIRY_GRACE_SEC")
+    # a plan tap reuses the user's pending invoice while it has this much time left
+    invoice_reuse_min_valid_sec: int = Field(600, alias="INVOICE_REUSE_MIN_VALID_SEC")
+
+    # --- Notification outbox (payment / referral messages) ---
+    outbox_per_sec: float = Field(10.0, alias="OUTBOX_PER_SEC")
+    outbox_batch_size: int = Field(50, alias="OUTBOX_BATCH_SIZE")
+    # renewal reminder this long before premium runs out (0 = off)
+    renewal_reminder_hours: int = Field(24, alias="RENEWAL_REMINDER_HOURS")
 
     # --- Limits / plans ---
     basic_trial_limit: int = Field(10, alias="BASIC_TRIAL_LIMIT")
@@ -137,6 +211,21 @@ class Settings(BaseSettings):
     speechkit_lang: str = Field("ru-RU", alias="SPEECHKIT_LANG")
     speechkit_topic: str = Field("general", alias="SPEECHKIT_TOPIC")
     speechkit_timeout_sec: int = Field(25, alias="SPEECHKIT_TIMEOUT_SEC")
+    # long notes are cut into segments within the sync STT limits, recognized in parallel
+    stt_max_segment_sec: float = Field(25.0, alias="STT_MAX_SEGMENT_SEC")
+    stt_max_segment_bytes: int = Field(900_000, alias="STT_MAX_SEGMENT_BYTES")
+    stt_parallelism: int = Field(4, alias="STT_PARALLELISM")
+    # pipe short notes from the Telegram download straight into the STT request
+    stt_stream_upload: bool = Field(True, alias="STT_STREAM_UPLOAD")
+    # local pre-filter: taps and silent clips never reach the paid STT
+    stt_prefilter: bool = Field(True, alias="STT_PREFILTER")
+    stt_min_duration_sec: float = Field(1.0, alias="STT_MIN_DURATION_SEC")
+    stt_min_bitrate: int = Field(3000, alias="STT_MIN_BITRATE")
+    stt_min_speech_sec: float = Field(0.5, alias="STT_MIN_SPEECH_SEC")
+    stt_active_bitrate: int = Field(8000, alias="STT_ACTIVE_BITRATE")
+    # transcription cache by file_unique_id: in-memory LRU + SQLite
+    voice_cache_memory_items: int = Field(500, alias="VOICE_CACHE_MEMORY_ITEMS")
+    voice_cache_db_items: int = Field(50000, alias="VOICE_CACHE_DB_ITEMS")
 
     # --- Referral salt ---
     # Used to generate stable referral codes. If unset, falls back to BOT_TOKEN prefix.
@@ -146,6 +235,17 @@ class Settings(BaseSettings):
     def ref_salt_effective(self) -> str:
         return (self.ref_salt or self.bot_token[:16]).strip()
 
+    @model_validator(mode="after")
+    def _check_telegram_webhook(self) -> "Settings":
+        # an open webhook path lets anyone feed the bot forged updates
+        if not self.telegram_webhook_enabled:
+            return self
+        if not (self.telegram_webhook_secret or "").strip():
+            raise ValueError("TELEGRAM_WEBHOOK_SECRET is required when TELEGRAM_WEBHOOK_ENABLED=true")
+        if self.telegram_webhook_set_on_start and not (self.telegram_webhook_url or "").startswith("https://"):
+            raise ValueError("TELEGRAM_WEBHOOK_URL must be an https:// URL when TELEGRAM_WEBHOOK_ENABLED=true")
+        return self
+
     # Convenience
     @property
     def data_dir_path(self) -> Path:
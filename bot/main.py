@@ -3,28 +3,22 @@ from __future__ import annotations
 import asyncio
 import logging
 from contextlib import suppress
-from pathlib import Path
 
-from aiogram import Bot, Dispatcher
-from aiogram.client.default import DefaultBotProperties
-from aiogram.enums.parse_mode import ParseMode
+from aiogram import Dispatcher
 from aiohttp import web
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 from bot.config import Settings
 from bot.logging_conf import setup_logging
+from bot.middlewares import TracingMiddleware, UpdateLatencyMiddleware
 from bot.routers import setup_routers
+from bot.runtime import build_runtime
+from bot.sharding import ShardForwardMiddleware, ShardRouter
 
-from services.crypto_pay import CryptoPayClient
-from services.db import apply_migrations, connect
-from services.jobs import (
-    downgrade_expired_subscriptions,
-    send_daily_checkins,
-    sync_active_invoices,
-)
-from services.llm.openai_compat import OpenAICompatClient
-from services.llm.orchestrator import Orchestrator
+from services.jobs import send_due_checkins
+from services.referrals import check_ref_stats
 from web.app import create_app
+from web.telegram_webhook import TelegramWebhookIngress
 
 
 async def start_web_server(app: web.Application, host: str, port: int) -> web.AppRunner:
@@ -40,46 +34,71 @@ async def main() -> None:
     setup_logging(settings.log_level)
     log = logging.getLogger("main")
 
-    Path(settings.data_dir).mkdir(parents=True, exist_ok=True)
-
-    db = await connect(settings.db_path)
-    await apply_migrations(db, str(Path(__file__).resolve().parent.parent / "migrations"))
-
-    deepseek = OpenAICompatClient(
-        api_key=settings.deepseek_api_key,
-        base_url=settings.deepseek_base_url,
-        default_model=settings.deepseek_model,
-    )
-    perplexity = OpenAICompatClient(
-        api_key=settings.perplexity_api_key,
-        base_url=settings.perplexity_base_url,
-        default_model=settings.perplexity_model,
-    )
-
-    orchestrator = Orchestrator(deepseek=deepseek, perplexity=perplexity, settings=settings)
-
-    cryptopay = CryptoPayClient(
-        api_token=settings.cryptopay_api_token,
-        base_url=settings.cryptopay_base_url,
-    )
-
-    bot = Bot(
-        token=settings.bot_token,
-        default=DefaultBotProperties(
-            parse_mode=ParseMode.HTML,
-            link_preview_is_disabled=True,
-        ),
-    )
+    sharded = settings.workers > 0
+    # with workers, LLM quotas and the edit budget are split between them;
+    # the ingress itself only runs deferred jobs and scheduled tasks
+    runtime = await build_runtime(settings, share=max(1, settings.workers))
+    bot, cryptopay = runtime.bot, runtime.cryptopay
 
     dp = Dispatcher()
+    # in sharded mode the routers are never run here, but they still define allowed_updates
     dp.include_router(setup_routers())
+    update_latency = UpdateLatencyMiddleware()
+    dp.update.outer_middleware(update_latency)
+
+    shards = None
+    if sharded:
+        shards = ShardRouter(
+            workers=settings.workers,
+            socket_path=settings.worker_socket,
+            max_inflight=settings.worker_max_inflight,
+            on_message=runtime.on_worker_message,
+        )
+        dp.update.outer_middleware(ShardForwardMiddleware(shards))
+        await shards.start()
+        log.info("Forwarding updates to %s workers via %s", settings.workers, settings.worker_socket)
+    else:
+        # with workers, updates are traced where they are handled
+        dp.update.outer_middleware(TracingMiddleware())
+
+    # kwargs every handler gets, same for polling and webhook
+    workflow = runtime.workflow()
+
+    telegram = None
+    if settings.telegram_webhook_enabled:
+        telegram = TelegramWebhookIngress(
+            bot=bot,
+            dispatcher=dp,
+            secret=settings.telegram_webhook_secret,
+            context=workflow,
+            max_pending=settings.telegram_webhook_max_pending,
+        )
 
-    # Web server for CryptoPay webhook + health
+    stats = runtime.stats()
+    stats["updates"] = lambda: {
+        "mode": "webhook" if telegram else "polling",
+        **update_latency.stats(),
+        **({"webhook": telegram.stats()} if telegram else {}),
+    }
+    if shards is not None:
+        stats["shards"] = shards.stats
+
+    # Web server for CryptoPay webhook + health (+ Telegram webhook)
+    await runtime.notifications.start()
+    await runtime.expiry.start()
+    await runtime.inbox.start()
+    runtime.register_background_metrics()
     app = create_app(
-        bot=bot,
-        db=db,
         cryptopay=cryptopay,
+        inbox=runtime.inbox,
         webhook_secret=settings.cryptopay_webhook_secret,
+        stats_secret=settings.stats_secret,
+        stats=stats,
+        metrics_token=settings.metrics_token,
+        metric_dumps=shards.metric_dumps if shards is not None else None,
+        profiler=runtime.profiler,
+        telegram=telegram,
+        telegram_path=settings.telegram_webhook_path,
     )
     web_runner = await start_web_server(app, settings.web_server_host, settings.web_server_port)
     log.info("Web server started on %s:%s", settings.web_server_host, settings.web_server_port)
@@ -88,56 +107,75 @@ async def main() -> None:
     scheduler = AsyncIOScheduler(timezone=settings.timezone)
 
     scheduler.add_job(
-        sync_active_invoices,
+        runtime.reconciler.run,
         "interval",
-        minutes=5,
-        args=[bot, db, cryptopay],
+        minutes=settings.invoice_sync_interval_min,
         id="sync_invoices",
+        max_instances=1,
         replace_existing=True,
     )
 
     scheduler.add_job(
-        downgrade_expired_subscriptions,
-        "cron",
-        hour=0,
-        minute=5,
-        args=[db],
-        id="downgrade_expired",
+        send_due_checkins,
+        "interval",
+        minutes=1,
+        args=[runtime.broadcasts, settings],
+        id="due_checkins",
+        max_instances=1,
+        coalesce=True,
         replace_existing=True,
     )
 
+    # referral counters are maintained incrementally; recount off-peak to catch drift
     scheduler.add_job(
-        send_daily_checkins,
+        check_ref_stats,
         "cron",
-        hour=settings.checkin_hour,
-        minute=settings.checkin_minute,
-        args=[bot, db],
-        id="daily_checkins",
+        hour=4,
+        minute=10,
+        args=[runtime.db],
+        kwargs={"fix": True},
+        id="check_ref_stats",
+        max_instances=1,
         replace_existing=True,
     )
 
     scheduler.start()
+    await runtime.broadcasts.resume_unfinished()
 
-    # Start polling
     try:
-        await bot.delete_webhook(drop_pending_updates=True)
-        await dp.start_polling(
-            bot,
-            db=db,
-            settings=settings,
-            orchestrator=orchestrator,
-            cryptopay=cryptopay,
-        )
+        if telegram is not None:
+            if settings.telegram_webhook_set_on_start:
+                await bot.set_webhook(
+                    url=settings.telegram_webhook_url,
+                    secret_token=settings.telegram_webhook_secret,
+                    allowed_updates=dp.resolve_used_update_types(),
+                    max_connections=100,
+                )
+            log.info("Receiving updates via webhook at %s", settings.telegram_webhook_path)
+            await dp.emit_startup(bot=bot, **workflow)
+            try:
+                await asyncio.Event().wait()
+            finally:
+                await dp.emit_shutdown(bot=bot, **workflow)
+        else:
+            # Start polling
+            await bot.delete_webhook(drop_pending_updates=True)
+            # sharded: forward updates one by one, in order; a full worker then
+            # stalls polling instead of piling up tasks waiting in forward()
+            await dp.start_polling(bot, handle_as_tasks=not sharded, **workflow)
     finally:
         # Graceful shutdown (чтобы systemd не ловил утечки и порт 8080 не зависал)
         with suppress(Exception):
             scheduler.shutdown(wait=False)
+        if telegram is not None:
+            with suppress(Exception):
+                await telegram.close()
+        if shards is not None:
+            with suppress(Exception):
+                await shards.close()
         with suppress(Exception):
             await web_runner.cleanup()
-        with suppress(Exception):
-            await bot.session.close()
-        with suppress(Exception):
-            await db.close()
+        await runtime.close()
 
 
 if __name__ == "__main__":
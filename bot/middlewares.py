@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import Response, TelegramType
+from aiogram.types import TelegramObject, Update
+
+from services import tracing
+from services.metrics import TELEGRAM_API
+
+
+class UpdateLatencyMiddleware(BaseMiddleware):
+    """Age of an update when its handler starts: Telegram `date` -> now.
+
+    The same number in polling and webhook mode, so both can be compared on
+    live traffic. Telegram dates have 1 s resolution; look at the distribution.
+    """
+
+    def __init__(self) -> None:
+        self._ages: Deque[float] = deque(maxlen=2000)
+        self.handled = 0
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        if isinstance(event, Update):
+            msg = event.message or event.edited_message
+            if msg is not None and msg.date is not None:
+                self._ages.append(max(0.0, time.time() - msg.date.timestamp()))
+        self.handled += 1
+        return await handler(event, data)
+
+    def stats(self) -> dict:
+        ages = sorted(self._ages)
+        if not ages:
+            return {"handled": self.handled}
+        return {
+            "handled": self.handled,
+            "age_p50_sec": round(ages[len(ages) // 2], 3),
+            "age_p95_sec": round(ages[min(len(ages) - 1, int(len(ages) * 0.95))], 3),
+            "age_max_sec": round(ages[-1], 3),
+        }
+
+
+class TracingMiddleware(BaseMiddleware):
+    """One trace per update; everything the handler awaits hangs off its root span."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        attrs: Dict[str, Any] = {}
+        if isinstance(event, Update):
+            attrs["update_id"] = event.update_id
+            msg = event.message or event.edited_message
+            user = msg.from_user if msg is not None else None
+            if user is None and event.callback_query is not None:
+                user = event.callback_query.from_user
+            if user is not None:
+                attrs["user_id"] = user.id
+            if msg is not None:
+                attrs["kind"] = "voice" if msg.voice else "command" if (msg.text or "").startswith("/") else "text"
+        with tracing.trace("update", **attrs):
+            return await handler(event, data)
+
+
+class TelegramApiMetricsMiddleware(BaseRequestMiddleware):
+    """Every Bot API call -> telegram_api_seconds{method, status} and a trace span.
+
+    Status is "ok" or the exception class (TelegramRetryAfter,
+    TelegramBadRequest, ...), so 429s and network errors show up as rates.
+    """
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        started = time.perf_counter()
+        status = "ok"
+        try:
+            with tracing.span(f"tg.{method.__api_method__}"):
+                return await make_request(bot, method)
+        except Exception as e:
+            status = type(e).__name__
+            raise
+        finally:
+            TELEGRAM_API.labels(method.__api_method__, status).observe(time.perf_counter() - started)
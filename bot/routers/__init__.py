@@ -1,6 +1,7 @@
 from aiogram import Router
 
 from bot.routers.start import router as start_router
+from bot.routers.admin import router as admin_router
 from bot.routers.menu import router as menu_router
 from bot.routers.chat import router as chat_router
 from bot.routers.continue_ import router as continue_router
@@ -9,6 +10,7 @@ from bot.routers.continue_ import router as continue_router
 def setup_routers() -> Router:
     r = Router()
     r.include_router(start_router)
+    r.include_router(admin_router)
     r.include_router(menu_router)
     r.include_router(continue_router)
     r.include_router(chat_router)
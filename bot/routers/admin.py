@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import html
+import time
+
+from aiogram import Router
+from aiogram.filters import BaseFilter, Command
+from aiogram.types import BufferedInputFile, Message
+
+from bot import texts
+from services import broadcast as broadcast_repo
+from services.profiler import MAX_SECONDS, ProfilerBusy
+
+router = Router()
+
+
+class _IsAdmin(BaseFilter):
+    async def __call__(self, message: Message, settings) -> bool:
+        return bool(message.from_user) and settings.is_admin(message.from_user.id)
+
+
+# everyone else falls through to the regular chat handler
+router.message.filter(_IsAdmin())
+
+
+@router.message(Command("broadcast"))
+async def cmd_broadcast(message: Message, db, broadcasts) -> None:
+    parts = (message.html_text or "").split(maxsplit=1)
+    if len(parts) < 2 or not parts[1].strip():
+        await message.answer(texts.BROADCAST_USAGE)
+        return
+
+    b = await broadcast_repo.create_or_get(
+        db,
+        kind="admin",
+        run_key=f"admin:{message.from_user.id}:{message.message_id}:{int(time.time())}",
+        text=parts[1].strip(),
+        audience="all",
+        created_by=message.from_user.id,
+    )
+    broadcasts.start(b)
+    await message.answer(texts.BROADCAST_STARTED.format(id=b.id))
+
+
+@router.message(Command("broadcast_status"))
+async def cmd_broadcast_status(message: Message, db) -> None:
+    items = await broadcast_repo.list_recent(db, limit=5)
+    if not items:
+        await message.answer(texts.BROADCAST_STATUS_EMPTY)
+        return
+    await message.answer(
+        "\n".join(
+            texts.BROADCAST_STATUS_LINE.format(
+                id=b.id, kind=b.kind, status=b.status, sent=b.sent, blocked=b.blocked, failed=b.failed
+            )
+            for b in items
+        )
+    )
+
+
+@router.message(Command("profile"))
+async def cmd_profile(message: Message, profiler) -> None:
+    parts = (message.text or "").split()
+    try:
+        seconds = int(parts[1]) if len(parts) > 1 else 10
+    except ValueError:
+        seconds = 0
+    if not 1 <= seconds <= MAX_SECONDS:
+        await message.answer(texts.PROFILE_USAGE.format(max=MAX_SECONDS))
+        return
+
+    await message.answer(texts.PROFILE_STARTED.format(seconds=seconds))
+    try:
+        profile = await profiler.run(seconds)
+    except ProfilerBusy:
+        await message.answer(texts.PROFILE_BUSY)
+        return
+
+    await message.answer_document(
+        BufferedInputFile(profile.collapsed().encode("utf-8"), filename=f"profile-{int(time.time())}.folded"),
+        caption="collapsed stacks: flamegraph.pl / speedscope",
+    )
+    await message.answer(f"<pre>{html.escape(profile.top_table(25))[:3900]}</pre>")
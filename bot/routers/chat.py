@@ -1,29 +1,34 @@
 from __future__ import annotations
 
-import io
+import asyncio
 import re
 import time
 
-from aiogram import Router
-from aiogram.exceptions import TelegramBadRequest
+from aiogram import Bot, Router
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.types import Message
 
 from bot import texts
 from bot.keyboards import ikb_continue, kb_main
 from services import continues as cont_repo
+from services import deferred as deferred_repo
+from services.deferred import MAX_ATTEMPTS, DeferredJob, predict_heavy
 from services import limits as limits_service
 from services import memory as memory_repo
 from services import users as users_repo
+from services.llm.admission import priority_for
+from services.llm.features import analyze
+from services.llm.orchestrator import STREAM_MAX_TOKENS
 from services.llm.postprocess import clean_text
 from services.llm.style import update_style
-from services.voice import SpeechkitError, speech_to_text_oggopus
+from services.llm.supervisor import GenerationProgress
+from services.metrics import TELEGRAM_EDITS
+from services.voice import SpeechkitError, VoiceRejected
 
 router = Router()
 
-_MEDICAL_RE = re.compile(
-    r"\b(болит|боль|температур|кашел|насморк|давлен|пульс|тошнит|рвот|понос|диаре|сыпь|аллерг|анализ|симптом|врач|лекарств|таблет|антибиот|дозировк|мг|ml|мл)\b",
-    re.IGNORECASE,
-)
+# longest flood-control pause we sit out before giving up on an edit
+MAX_RETRY_AFTER_WAIT = 10
 
 
 def _strip_tags(html: str) -> str:
@@ -42,15 +47,29 @@ async def _ensure_user(db, settings, user_id: int):
     return u
 
 
-async def _run_llm_flow(message: Message, db, settings, orchestrator, user_text: str, *, preface: str = "") -> None:
+async def _run_llm_flow(
+    message: Message,
+    db,
+    settings,
+    orchestrator,
+    user_text: str,
+    *,
+    preface: str = "",
+    progress: GenerationProgress | None = None,
+    deferred=None,
+    edits=None,
+) -> None:
     # ensure user exists
     u = await _ensure_user(db, settings, message.from_user.id)
 
     # admin flag (♾)
     is_admin = settings.is_admin(u.user_id)
 
+    # one scan of the text for style + routing flags
+    features = analyze(user_text)
+
     # update style signals
-    new_style = update_style(u.style, user_text)
+    new_style = update_style(u.style, user_text, features)
     await users_repo.set_style(db, u.user_id, new_style)
     u.style = new_style
 
@@ -71,6 +90,8 @@ async def _run_llm_flow(message: Message, db, settings, orchestrator, user_text:
         if res.reason == "daily":
             await message.answer(texts.DAILY_LIMIT_REACHED, reply_markup=kb_main())
             return
+    if progress is not None:
+        progress.charged = True
 
     # refresh user after usage update
     u = await users_repo.get_user(db, u.user_id)
@@ -79,38 +100,67 @@ async def _run_llm_flow(message: Message, db, settings, orchestrator, user_text:
     # remember user msg
     await memory_repo.add(db, u.user_id, "user", clean_text(user_text)[:4000])
 
+    # heavy pro request: answer in the background and free the handler now
+    if deferred is not None and predict_heavy(features, u.mode, settings):
+        job_id = await deferred.submit(user_id=u.user_id, chat_id=message.chat.id, text=user_text)
+        await message.answer(texts.DEFERRED_ACCEPTED.format(job_id=job_id), reply_markup=kb_main())
+        return
+
     # loader message
     loading_text = "⌛ <i>Думаю над ответом…</i>"
     if preface:
         loading_text = preface + "\n" + loading_text
     loading = await message.answer(loading_text, reply_markup=kb_main())
+    if progress is not None:
+        progress.loading = loading
 
     last_edit = 0.0
     can_edit = True
 
-    async def safe_edit(text: str, reply_markup=None) -> bool:
+    async def safe_edit(text: str, reply_markup=None, *, retry: bool = True) -> bool:
         nonlocal can_edit
         if not can_edit:
             return False
         try:
             await loading.edit_text(text, reply_markup=reply_markup)
+            TELEGRAM_EDITS.labels("ok").inc()
             return True
+        except TelegramRetryAfter as e:
+            TELEGRAM_EDITS.labels("retry_after").inc()
+            if retry and e.retry_after <= MAX_RETRY_AFTER_WAIT:
+                await asyncio.sleep(e.retry_after)
+                return await safe_edit(text, reply_markup, retry=False)
+            return False
         except TelegramBadRequest as e:
+            TELEGRAM_EDITS.labels("bad_request").inc()
             msg = str(e)
             if ("message can't be edited" in msg) or ("message to edit not found" in msg):
                 can_edit = False
             return False
         except Exception:
+            TELEGRAM_EDITS.labels("error").inc()
             return False
 
+    session = None
+    if edits is not None:
+        # previews go through the shared scheduler (global budget, coalescing)
+        session = edits.register(message.chat.id, lambda t: loading.edit_text(t))
+
     async def on_delta(preview_html_escaped: str) -> None:
         nonlocal last_edit
+        if session is not None:
+            if can_edit:
+                session.submit(loading_text + "\n\n" + preview_html_escaped)
+            return
         now = time.monotonic()
         if now - last_edit < 0.9:
             return
         last_edit = now
         await safe_edit(loading_text + "\n\n" + preview_html_escaped)
 
+    async def on_queue(position: int, eta: float) -> None:
+        await safe_edit(loading_text + "\n\n" + texts.QUEUE_POSITION.format(position=position, eta=max(1, round(eta))))
+
     try:
         html_out = await orchestrator.answer_stream(
             db,
@@ -119,17 +169,31 @@ async def _run_llm_flow(message: Message, db, settings, orchestrator, user_text:
             u.style,
             user_text,
             on_delta=on_delta,
+            priority=priority_for(is_admin=is_admin, is_premium=u.is_premium),
+            on_queue=on_queue,
+            progress=progress,
+            features=features,
+            long_memory=u.long_memory,
+            memory_upto=u.long_memory_upto,
         )
+    except asyncio.CancelledError:
+        if session is not None:
+            await session.close()
+        raise
     except Exception:
+        if session is not None:
+            await session.close()
         if not await safe_edit(texts.GENERIC_ERROR, reply_markup=None):
             await message.answer(texts.GENERIC_ERROR, reply_markup=kb_main())
         return
 
     # medical disclaimer (pro)
-    if u.mode == "pro" and _MEDICAL_RE.search(user_text or ""):
+    if u.mode == "pro" and features.medical:
         html_out = texts.MEDICAL_DISCLAIMER + "\n\n" + html_out
 
     parts = orchestrator.split_for_telegram(html_out)
+    if session is not None:
+        await session.close()
 
     if len(parts) == 1:
         ok = await safe_edit(parts[0], reply_markup=None)
@@ -144,10 +208,137 @@ async def _run_llm_flow(message: Message, db, settings, orchestrator, user_text:
     # store assistant memory (plain)
     await memory_repo.add(db, u.user_id, "assistant", _strip_tags(parts[0])[:4000])
 
+    # fold old turns into long_memory off the hot path
+    if orchestrator.summarizer is not None:
+        orchestrator.summarizer.schedule(db, u.user_id)
+
+
+async def run_deferred_job(bot: Bot, db, settings, orchestrator, job: DeferredJob) -> None:
+    """Answer a deferred request and deliver it as new messages.
+
+    A retry (the queue reruns failed jobs with backoff) picks up after the
+    last step that went through: a saved answer isn't generated again and a
+    delivered one isn't sent again.
+    """
+    u = await users_repo.get_user(db, job.user_id)
+    if not u:
+        return
+
+    html_out = job.answer
+    if not html_out:
+        features = analyze(job.text)
+        try:
+            html_out = await orchestrator.answer_stream(
+                db,
+                u.user_id,
+                u.mode,
+                u.style,
+                job.text,
+                priority=priority_for(is_admin=settings.is_admin(u.user_id), is_premium=u.is_premium),
+                features=features,
+                long_memory=u.long_memory,
+                memory_upto=u.long_memory_upto,
+            )
+        except Exception:
+            if job.attempts < MAX_ATTEMPTS:
+                raise
+            await bot.send_message(job.chat_id, texts.GENERIC_ERROR, reply_markup=kb_main())
+            return
+
+        if u.mode == "pro" and features.medical:
+            html_out = texts.MEDICAL_DISCLAIMER + "\n\n" + html_out
+        await deferred_repo.save_answer(db, job, html_out)
+
+    parts = orchestrator.split_for_telegram(html_out)
+    if not job.delivered:
+        first = texts.DEFERRED_READY.format(job_id=job.id) + "\n\n" + parts[0]
+        if len(parts) == 1:
+            await bot.send_message(job.chat_id, first)
+        else:
+            state = await cont_repo.create(db, u.user_id, parts)
+            await bot.send_message(job.chat_id, first, reply_markup=ikb_continue(state.token))
+        # a failure past this point must not send it again
+        await deferred_repo.mark_delivered(db, job, 1)
+
+    await memory_repo.add(db, u.user_id, "assistant", _strip_tags(parts[0])[:4000])
+    if orchestrator.summarizer is not None:
+        orchestrator.summarizer.schedule(db, u.user_id)
+
+
+async def _on_superseded(message: Message, db, settings, supervisor, progress: GenerationProgress) -> None:
+    if progress.charged:
+        await limits_service.refund(
+            db,
+            message.from_user.id,
+            timezone=settings.timezone,
+            is_admin=settings.is_admin(message.from_user.id),
+        )
+        supervisor.record_saved(STREAM_MAX_TOKENS - progress.chars // 4)
+    if progress.loading is not None:
+        try:
+            await progress.loading.edit_text(texts.GENERATION_SUPERSEDED)
+        except Exception:
+            pass
+
+
+async def _supervised_flow(
+    message: Message,
+    db,
+    settings,
+    orchestrator,
+    supervisor,
+    user_text: str,
+    *,
+    preface: str = "",
+    deferred=None,
+    edits=None,
+) -> None:
+    if supervisor is None:
+        await _run_llm_flow(
+            message,
+            db,
+            settings,
+            orchestrator,
+            user_text,
+            preface=preface,
+            deferred=deferred,
+            edits=edits,
+        )
+        return
+
+    async def flow(text: str, progress: GenerationProgress) -> None:
+        try:
+            await _run_llm_flow(
+                message,
+                db,
+                settings,
+                orchestrator,
+                text,
+                preface=preface,
+                progress=progress,
+                deferred=deferred,
+                edits=edits,
+            )
+        except asyncio.CancelledError:
+            await _on_superseded(message, db, settings, supervisor, progress)
+            raise
+
+    await supervisor.run(message.from_user.id, user_text, flow)
+
 
 @router.message(lambda m: m.voice is not None)
-async def chat_voice(message: Message, db, settings, orchestrator, cryptopay=None):
-    if not getattr(settings, "enable_voice", False):
+async def chat_voice(
+    message: Message,
+    db,
+    settings,
+    orchestrator,
+    supervisor=None,
+    deferred=None,
+    edits=None,
+    voice=None,
+    cryptopay=None,
+):
+    if not getattr(settings, "enable_voice", False) or voice is None:
         await message.answer("🎙️ Голосовые сейчас выключены.", reply_markup=kb_main())
         return
 
@@ -172,22 +363,13 @@ async def chat_voice(message: Message, db, settings, orchestrator, cryptopay=Non
             await message.answer(texts.DAILY_LIMIT_REACHED, reply_markup=kb_main())
             return
 
-    # скачиваем voice (ogg/opus)
+    # кэш по file_unique_id, иначе скачиваем voice (ogg/opus) и распознаём
     loading = await message.answer("🎙️ <i>Расшифровываю голос…</i>", reply_markup=kb_main())
     try:
-        file = await message.bot.get_file(message.voice.file_id)
-        buf = io.BytesIO()
-        await message.bot.download_file(file.file_path, buf)
-        audio_bytes = buf.getvalue()
-
-        text = await speech_to_text_oggopus(
-            audio_bytes,
-            api_key=settings.speechkit_api_key,
-            folder_id=settings.speechkit_folder_id,
-            lang=settings.speechkit_lang,
-            topic=settings.speechkit_topic,
-            timeout_sec=settings.speechkit_timeout_sec,
-        )
+        text = await voice.transcribe(message.bot, message.voice)
+    except VoiceRejected:
+        await loading.edit_text("🎙️ Не слышу речи — голосовое слишком короткое или тихое. Запиши ещё раз.", reply_markup=kb_main())
+        return
     except SpeechkitError:
         await loading.edit_text("🎙️ Не смог распознать голос. Попробуй чуть медленнее/громче.", reply_markup=kb_main())
         return
@@ -200,16 +382,37 @@ async def chat_voice(message: Message, db, settings, orchestrator, cryptopay=Non
     except Exception:
         pass
 
-    await _run_llm_flow(
+    await _supervised_flow(
         message,
         db,
         settings,
         orchestrator,
+        supervisor,
         text,
         preface=f"📝 <b>Расшифровка:</b> {_strip_tags(text)[:300]}",
+        deferred=deferred,
+        edits=edits,
     )
 
 
 @router.message(lambda m: m.text and not m.text.startswith("/"))
-async def chat(message: Message, db, settings, orchestrator, cryptopay=None):
-    await _run_llm_flow(message, db, settings, orchestrator, message.text or "")
+async def chat(
+    message: Message,
+    db,
+    settings,
+    orchestrator,
+    supervisor=None,
+    deferred=None,
+    edits=None,
+    cryptopay=None,
+):
+    await _supervised_flow(
+        message,
+        db,
+        settings,
+        orchestrator,
+        supervisor,
+        message.text or "",
+        deferred=deferred,
+        edits=edits,
+    )
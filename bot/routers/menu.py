@@ -4,6 +4,7 @@ from datetime import datetime
 from zoneinfo import ZoneInfo
 
 from aiogram import Router
+from aiogram.filters import Command, CommandObject
 from aiogram.types import Message
 
 from bot import texts
@@ -27,8 +28,8 @@ from bot.keyboards import (
     kb_profile,
     kb_subscription,
 )
+from services import checkins as checkins_repo
 from services import limits as limits_service
-from services import payments as payments_service
 from services import referrals as refs_repo
 from services import users as users_repo
 
@@ -63,7 +64,7 @@ async def open_profile(message: Message, db, settings) -> None:
     user_id = message.from_user.id
     await _ensure_user(db, settings, user_id)
 
-    # актуализируем план (автодаунгрейд премиума по времени)
+    # is_premium сверяет premium_until с часами, даунгрейд делает планировщик
     u = await limits_service.ensure_plan_fresh(db, user_id)
 
     is_admin = settings.is_admin(user_id)
@@ -134,16 +135,14 @@ async def open_subscription(message: Message, settings) -> None:
 
 
 @router.message(lambda m: m.text in (BTN_SUB_1M, BTN_SUB_3M, BTN_SUB_12M))
-async def create_invoice(message: Message, db, settings, cryptopay) -> None:
+async def create_invoice(message: Message, db, settings, invoices) -> None:
     user_id = message.from_user.id
     await _ensure_user(db, settings, user_id)
 
     months = 1 if message.text == BTN_SUB_1M else 3 if message.text == BTN_SUB_3M else 12
     amount = settings.price_1m if months == 1 else settings.price_3m if months == 3 else settings.price_12m
 
-    inv = await payments_service.create_subscription_invoice(
-        db,
-        cryptopay,
+    inv = await invoices.issue(
         user_id=user_id,
         months=months,
         amount_usdt=float(amount),
@@ -187,3 +186,21 @@ async def toggle_checkin(message: Message, db, settings) -> None:
     new_val = await users_repo.toggle_checkin(db, user_id)
     status = "Вкл ✅" if new_val else "Выкл ❌"
     await message.answer(f"🫂 Ежедневный чек-ин: <b>{status}</b>", reply_markup=kb_profile())
+
+
+@router.message(Command("timezone"))
+async def set_timezone(message: Message, command: CommandObject, db, settings) -> None:
+    user_id = message.from_user.id
+    await _ensure_user(db, settings, user_id)
+
+    if not (command.args or "").strip():
+        u = await users_repo.get_user(db, user_id)
+        await message.answer(texts.TIMEZONE_CURRENT.format(tz=(u.tz if u else "") or settings.timezone))
+        return
+
+    tz = checkins_repo.parse_timezone(command.args)
+    if tz is None:
+        await message.answer(texts.TIMEZONE_BAD)
+        return
+    await users_repo.set_timezone(db, user_id, tz)
+    await message.answer(texts.TIMEZONE_SET.format(tz=tz), reply_markup=kb_main())
@@ -0,0 +1,351 @@
+from __future__ import annotations
+
+import asyncio
+import math
+from contextlib import suppress
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict
+
+import aiosqlite
+from aiogram import Bot
+from aiogram.client.default import DefaultBotProperties
+from aiogram.enums.parse_mode import ParseMode
+
+from bot.config import Settings
+from bot.middlewares import TelegramApiMetricsMiddleware
+from bot.routers.chat import run_deferred_job
+
+from services import broadcast as broadcast_repo
+from services.broadcast import BroadcastEngine
+from services.crypto_pay import CryptoPayClient
+from services.cryptopay_inbox import CryptoPayInbox
+from services.db import apply_migrations, connect
+from services.deferred import DeferredQueue
+from services.edits import EditScheduler
+from services import tracing
+from services.expiry import ExpiryScheduler
+from services.metrics import QUEUE_DEPTH
+from services.jobs import handle_invoice_status
+from services.outbox import NotificationSender
+from services.payments import InvoiceIssuer
+from services.profiler import SamplingProfiler
+from services.reconciler import InvoiceReconciler
+from services.llm.admission import AdmissionController
+from services.llm.openai_compat import OpenAICompatClient
+from services.llm.pacing import ProviderPacer
+from services.llm.summarizer import ConversationSummarizer
+from services.llm.supervisor import GenerationSupervisor
+from services.llm.orchestrator import Orchestrator
+from services.voice import SpeechkitClient, TranscriptionCache, VoicePrefilter, VoiceTranscriber
+
+
+MIGRATIONS_DIR = str(Path(__file__).resolve().parent.parent / "migrations")
+
+
+def _split(total: int, share: int) -> int:
+    # 0 means "unlimited / learn from headers" and stays 0
+    if total <= 0 or share <= 1:
+        return total
+    return max(1, math.ceil(total / share))
+
+
+@dataclass
+class Runtime:
+    """Everything a process needs to answer updates, built the same way everywhere."""
+
+    settings: Settings
+    db: aiosqlite.Connection
+    # runs only services.db.transaction() units (payments, expiry, inbox drain), so
+    # handlers committing on `db` can't split or roll back one of them
+    tx_db: aiosqlite.Connection
+    bot: Bot
+    deepseek: OpenAICompatClient
+    perplexity: OpenAICompatClient
+    admission: AdmissionController
+    summarizer: ConversationSummarizer | None
+    orchestrator: Orchestrator
+    supervisor: GenerationSupervisor
+    cryptopay: CryptoPayClient
+    invoices: InvoiceIssuer
+    edits: EditScheduler
+    broadcasts: BroadcastEngine
+    reconciler: InvoiceReconciler
+    inbox: CryptoPayInbox
+    notifications: NotificationSender
+    expiry: ExpiryScheduler
+    deferred: DeferredQueue | None = None
+    voice: VoiceTranscriber | None = None
+    profiler: SamplingProfiler = field(default_factory=SamplingProfiler)
+
+    def workflow(self) -> Dict[str, Any]:
+        """Keyword arguments every handler receives."""
+        return dict(
+            db=self.db,
+            settings=self.settings,
+            orchestrator=self.orchestrator,
+            supervisor=self.supervisor,
+            deferred=self.deferred,
+            edits=self.edits,
+            broadcasts=self.broadcasts,
+            voice=self.voice,
+            cryptopay=self.cryptopay,
+            invoices=self.invoices,
+            profiler=self.profiler,
+        )
+
+    def on_worker_message(self, msg: Dict[str, Any]) -> None:
+        """Requests from update workers for work that lives in the ingress."""
+        kind = msg.get("t")
+        if kind == "deferred" and self.deferred is not None:
+            self.deferred.notify()
+        elif kind == "broadcast":
+            asyncio.create_task(self._start_broadcast(int(msg["id"])))
+
+    async def _start_broadcast(self, broadcast_id: int) -> None:
+        b = await broadcast_repo.get_broadcast(self.db, broadcast_id)
+        if b is not None:
+            self.broadcasts.start(b)
+
+    def stats(self) -> Dict[str, Callable[[], Any]]:
+        return {
+            "admission": self.admission.stats,
+            "generations": self.supervisor.stats,
+            "summarizer": self.summarizer.stats if self.summarizer else dict,
+            "deferred": self.deferred.stats if self.deferred else dict,
+            "edits": self.edits.stats,
+            "broadcasts": self.broadcasts.stats,
+            "invoices": self.reconciler.stats,
+            "invoice_reuse": self.invoices.stats,
+            "cryptopay_inbox": self.inbox.stats,
+            "outbox": self.notifications.stats,
+            "expiry": self.expiry.stats,
+            "voice": self.voice.stats if self.voice else dict,
+            "tracing": tracing.stats,
+            "profiler": self.profiler.stats,
+            "pacing": lambda: {
+                "deepseek": self.deepseek.pacer.snapshot(),
+                "perplexity": self.perplexity.pacer.snapshot(),
+            },
+        }
+
+    def register_metrics(self) -> None:
+        """queue_depth gauges for what every process runs."""
+        for provider in ("deepseek", "perplexity"):
+            QUEUE_DEPTH.labels(f"llm_{provider}").set_function(
+                lambda p=provider: self.admission.stats().get(p, {}).get("queued", 0)
+            )
+        if self.deferred is not None:
+            QUEUE_DEPTH.labels("deferred").set_function(lambda: self.deferred.depth)
+
+    def register_background_metrics(self) -> None:
+        """queue_depth gauges for the workers only the ingress starts."""
+        QUEUE_DEPTH.labels("cryptopay_inbox").set_function(lambda: self.inbox.depth)
+        QUEUE_DEPTH.labels("outbox").set_function(lambda: self.notifications.depth)
+        QUEUE_DEPTH.labels("expiry").set_function(lambda: self.expiry.stats()["scheduled"])
+
+    async def close(self) -> None:
+        if self.summarizer is not None:
+            with suppress(Exception):
+                await self.summarizer.close()
+        if self.deferred is not None:
+            with suppress(Exception):
+                await self.deferred.close()
+        with suppress(Exception):
+            await self.inbox.close()
+        with suppress(Exception):
+            await self.expiry.close()
+        with suppress(Exception):
+            await self.notifications.close()
+        with suppress(Exception):
+            await self.broadcasts.close()
+        with suppress(Exception):
+            await self.edits.close()
+        if self.voice is not None:
+            with suppress(Exception):
+                await self.voice.close()
+        with suppress(Exception):
+            await self.bot.session.close()
+        with suppress(Exception):
+            await self.tx_db.close()
+        with suppress(Exception):
+            await self.db.close()
+
+
+async def build_runtime(
+    settings: Settings,
+    *,
+    share: int = 1,
+    migrate: bool = True,
+    with_deferred: bool = True,
+) -> Runtime:
+    """Build clients, controllers and the bot.
+
+    `share` is the number of processes splitting the provider quotas and the
+    Telegram edit budget; each one gets its fraction.
+    """
+    Path(settings.data_dir).mkdir(parents=True, exist_ok=True)
+
+    tracing.configure(
+        settings.trace_file,
+        sample_rate=settings.trace_sample_rate,
+        slow_ms=settings.trace_slow_ms,
+        max_mb=settings.trace_max_mb,
+    )
+
+    db = await connect(settings.db_path)
+    if migrate:
+        await apply_migrations(db, MIGRATIONS_DIR)
+    tx_db = await connect(settings.db_path)
+
+    deepseek = OpenAICompatClient(
+        api_key=settings.deepseek_api_key,
+        base_url=settings.deepseek_base_url,
+        default_model=settings.deepseek_model,
+        pacer=ProviderPacer(
+            "deepseek",
+            rpm=_split(settings.deepseek_rpm, share),
+            tpm=_split(settings.deepseek_tpm, share),
+        ),
+    )
+    perplexity = OpenAICompatClient(
+        api_key=settings.perplexity_api_key,
+        base_url=settings.perplexity_base_url,
+        default_model=settings.perplexity_model,
+        pacer=ProviderPacer(
+            "perplexity",
+            rpm=_split(settings.perplexity_rpm, share),
+            tpm=_split(settings.perplexity_tpm, share),
+        ),
+    )
+
+    admission = AdmissionController(
+        {
+            "deepseek": _split(settings.llm_concurrency_deepseek, share),
+            "perplexity": _split(settings.llm_concurrency_perplexity, share),
+        }
+    )
+    summarizer = (
+        ConversationSummarizer(deepseek, settings, admission=admission) if settings.enable_summarizer else None
+    )
+    orchestrator = Orchestrator(
+        deepseek=deepseek,
+        perplexity=perplexity,
+        settings=settings,
+        admission=admission,
+        summarizer=summarizer,
+    )
+    supervisor = GenerationSupervisor(settings.generation_policy)
+
+    cryptopay = CryptoPayClient(
+        api_token=settings.cryptopay_api_token,
+        base_url=settings.cryptopay_base_url,
+    )
+
+    bot = Bot(
+        token=settings.bot_token,
+        default=DefaultBotProperties(
+            parse_mode=ParseMode.HTML,
+            link_preview_is_disabled=True,
+        ),
+    )
+    bot.session.middleware(TelegramApiMetricsMiddleware())
+
+    edits = EditScheduler(
+        global_per_sec=settings.edits_global_per_sec / max(1, share),
+        min_interval=settings.edits_min_interval_sec,
+        max_interval=settings.edits_max_interval_sec,
+    )
+
+    # started only where the web server runs (by main), like the inbox
+    notifications = NotificationSender(
+        bot,
+        db,
+        per_sec=settings.outbox_per_sec,
+        batch_size=settings.outbox_batch_size,
+    )
+
+    rt = Runtime(
+        settings=settings,
+        db=db,
+        tx_db=tx_db,
+        bot=bot,
+        deepseek=deepseek,
+        perplexity=perplexity,
+        admission=admission,
+        summarizer=summarizer,
+        orchestrator=orchestrator,
+        supervisor=supervisor,
+        cryptopay=cryptopay,
+        invoices=InvoiceIssuer(db, cryptopay, min_valid_sec=settings.invoice_reuse_min_valid_sec),
+        edits=edits,
+        # broadcasts only run in the single process / the ingress, never split
+        broadcasts=BroadcastEngine(
+            bot,
+            db,
+            per_sec=settings.broadcast_per_sec,
+            concurrency=settings.broadcast_concurrency,
+            batch_size=settings.broadcast_batch_size,
+        ),
+        reconciler=InvoiceReconciler(
+            tx_db,
+            cryptopay,
+            sender=notifications,
+            batch_size=settings.invoice_sync_batch,
+            expiry_grace_sec=settings.invoice_expiry_grace_sec,
+        ),
+        # drained only where the web server runs (started by main)
+        inbox=CryptoPayInbox(
+            db,
+            tx_db,
+            lambda e: handle_invoice_status(tx_db, e.invoice_id, e.status, e.payload, sender=notifications),
+        ),
+        notifications=notifications,
+        expiry=ExpiryScheduler(
+            tx_db,
+            sender=notifications,
+            remind_before_sec=settings.renewal_reminder_hours * 3600,
+            timezone=settings.timezone,
+        ),
+    )
+
+    if settings.enable_voice:
+        rt.voice = VoiceTranscriber(
+            SpeechkitClient(
+                api_key=settings.speechkit_api_key or "",
+                folder_id=settings.speechkit_folder_id or "",
+                lang=settings.speechkit_lang,
+                topic=settings.speechkit_topic,
+                timeout_sec=settings.speechkit_timeout_sec,
+            ),
+            TranscriptionCache(
+                db,
+                memory_items=settings.voice_cache_memory_items,
+                db_items=settings.voice_cache_db_items,
+            ),
+            max_segment_sec=settings.stt_max_segment_sec,
+            max_segment_bytes=settings.stt_max_segment_bytes,
+            parallelism=settings.stt_parallelism,
+            stream_upload=settings.stt_stream_upload,
+            prefilter=(
+                VoicePrefilter(
+                    min_duration_sec=settings.stt_min_duration_sec,
+                    min_bitrate=settings.stt_min_bitrate,
+                    min_speech_sec=settings.stt_min_speech_sec,
+                    active_bitrate=settings.stt_active_bitrate,
+                )
+                if settings.stt_prefilter
+                else None
+            ),
+        )
+
+    if with_deferred and settings.enable_deferred_mode:
+        rt.deferred = DeferredQueue(
+            db,
+            lambda job: run_deferred_job(bot, db, settings, orchestrator, job),
+            workers=settings.deferred_workers,
+        )
+        await rt.deferred.start()
+
+    rt.register_metrics()
+    return rt
@@ -0,0 +1,296 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import signal
+import struct
+import sys
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+
+log = logging.getLogger("sharding")
+
+# Frames on the unix socket: 4-byte big-endian length + UTF-8 JSON.
+#   worker -> ingress: {"t": "hello", "shard": i, "pid": ...}
+#   ingress -> worker: {"t": "update", "seq": n, "key": user_id, "sent": <monotonic>, "update": {...}}
+#   worker -> ingress: {"t": "ack", "seq": n, "ipc": sec, "handled": sec}
+#   worker -> ingress: {"t": "stats", "stats": {...}, "metrics": [...]}
+#   worker -> ingress: {"t": "deferred", "job": id}, {"t": "broadcast", "id": id}
+_HEADER = struct.Struct(">I")
+MAX_FRAME = 8 * 1024 * 1024
+
+RESTART_BACKOFF_MAX = 30.0
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    """Jump consistent hash (Lamping & Veach).
+
+    Going from N to N+1 buckets moves only 1/(N+1) of the keys.
+    """
+    key &= 0xFFFFFFFFFFFFFFFF
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+
+def encode_frame(obj: Dict[str, Any]) -> bytes:
+    payload = json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return _HEADER.pack(len(payload)) + payload
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Optional[Dict[str, Any]]:
+    """Next frame, or None when the peer went away."""
+    try:
+        head = await reader.readexactly(_HEADER.size)
+        (size,) = _HEADER.unpack(head)
+        if size > MAX_FRAME:
+            raise ValueError(f"frame too large: {size}")
+        return json.loads(await reader.readexactly(size))
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+
+
+def _percentile_ms(vals: Deque[float], q: float) -> float:
+    if not vals:
+        return 0.0
+    s = sorted(vals)
+    return round(s[min(len(s) - 1, int(q * len(s)))] * 1000, 3)
+
+
+class _Shard:
+    def __init__(self, index: int, max_inflight: int):
+        self.index = index
+        self.max_inflight = max_inflight
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.write_lock = asyncio.Lock()
+        self.connected = asyncio.Event()
+        self.slots = asyncio.Semaphore(max_inflight)
+        self.inflight: Dict[int, float] = {}
+        self.proc: Optional[asyncio.subprocess.Process] = None
+        self.pid = 0
+        self.restarts = 0
+        self.forwarded = 0
+        self.acked = 0
+        self.dropped = 0
+        self.ipc: Deque[float] = deque(maxlen=1000)
+        self.roundtrip: Deque[float] = deque(maxlen=1000)
+        self.worker_stats: Dict[str, Any] = {}
+        self.worker_metrics: List[dict] = []
+
+    def settle(self, seq: int) -> Optional[float]:
+        sent = self.inflight.pop(seq, None)
+        if sent is not None:
+            self.slots.release()
+        return sent
+
+    def stats(self) -> dict:
+        return {
+            "pid": self.pid,
+            "connected": self.connected.is_set(),
+            "restarts": self.restarts,
+            "forwarded": self.forwarded,
+            "acked": self.acked,
+            "dropped": self.dropped,
+            "inflight": len(self.inflight),
+            "ipc_p50_ms": _percentile_ms(self.ipc, 0.50),
+            "ipc_p95_ms": _percentile_ms(self.ipc, 0.95),
+            "roundtrip_p50_ms": _percentile_ms(self.roundtrip, 0.50),
+            "roundtrip_p95_ms": _percentile_ms(self.roundtrip, 0.95),
+            "worker": self.worker_stats,
+        }
+
+
+class ShardRouter:
+    """Ingress side: spawns N `bot.worker` processes and feeds them updates.
+
+    The shard is picked by a consistent hash of the user id, so one user's
+    updates always land on the same worker, which runs them in order. Each
+    worker holds at most `max_inflight` unacknowledged updates; past that
+    `forward` waits. That pushes back on polling only when updates are
+    forwarded one at a time (start_polling with handle_as_tasks=False);
+    the webhook bounds its own pending tasks.
+    """
+
+    def __init__(
+        self,
+        *,
+        workers: int,
+        socket_path: str,
+        max_inflight: int = 64,
+        on_message: Callable[[Dict[str, Any]], None] | None = None,
+    ):
+        self.socket_path = socket_path
+        self.on_message = on_message
+        self._shards: List[_Shard] = [_Shard(i, max_inflight) for i in range(workers)]
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._supervisors: List[asyncio.Task] = []
+        self._readers: set[asyncio.Task] = set()
+        self._closing = False
+        self._seq = 0
+
+    def shard_for(self, key: int) -> int:
+        return jump_hash(key, len(self._shards))
+
+    async def start(self) -> None:
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self._server = await asyncio.start_unix_server(self._on_connect, path=self.socket_path)
+        self._supervisors = [asyncio.create_task(self._supervise(s)) for s in self._shards]
+
+    async def _supervise(self, shard: _Shard) -> None:
+        while not self._closing:
+            started = time.monotonic()
+            shard.proc = await asyncio.create_subprocess_exec(
+                sys.executable,
+                "-m",
+                "bot.worker",
+                "--shard",
+                str(shard.index),
+                "--workers",
+                str(len(self._shards)),
+                "--socket",
+                self.socket_path,
+            )
+            shard.pid = shard.proc.pid
+            rc = await shard.proc.wait()
+            if self._closing:
+                return
+            shard.restarts += 1
+            # a worker that keeps crashing on start shouldn't spin the CPU
+            backoff = 0.0 if time.monotonic() - started > 60 else min(RESTART_BACKOFF_MAX, 2.0**shard.restarts)
+            log.warning("worker %s exited with %s, restarting in %.0fs", shard.index, rc, backoff)
+            await asyncio.sleep(backoff)
+
+    async def _on_connect(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        if task is not None:
+            self._readers.add(task)
+        hello = await read_frame(reader)
+        if not hello or hello.get("t") != "hello" or not 0 <= int(hello.get("shard", -1)) < len(self._shards):
+            writer.close()
+            return
+
+        shard = self._shards[int(hello["shard"])]
+        shard.writer = writer
+        shard.pid = int(hello.get("pid") or shard.pid)
+        shard.connected.set()
+        log.info("worker %s connected (pid %s)", shard.index, shard.pid)
+        try:
+            while True:
+                msg = await read_frame(reader)
+                if msg is None:
+                    break
+                kind = msg.get("t")
+                if kind == "ack":
+                    sent = shard.settle(int(msg["seq"]))
+                    if sent is not None:
+                        shard.acked += 1
+                        shard.roundtrip.append(time.monotonic() - sent)
+                        shard.ipc.append(float(msg.get("ipc") or 0.0))
+                elif kind == "stats":
+                    shard.worker_stats = msg.get("stats") or {}
+                    shard.worker_metrics = msg.get("metrics") or []
+                elif self.on_message is not None:
+                    self.on_message(msg)
+        finally:
+            if shard.writer is writer:
+                shard.writer = None
+                shard.connected.clear()
+                lost = list(shard.inflight)
+                for seq in lost:
+                    shard.settle(seq)
+                shard.dropped += len(lost)
+                if lost:
+                    log.warning("worker %s went away with %s updates in flight", shard.index, len(lost))
+            writer.close()
+            if task is not None:
+                self._readers.discard(task)
+
+    async def forward(self, key: int, update: Dict[str, Any]) -> None:
+        shard = self._shards[self.shard_for(key)]
+        await shard.slots.acquire()
+        await shard.connected.wait()
+        writer = shard.writer
+        if writer is None:
+            shard.slots.release()
+            shard.dropped += 1
+            return
+
+        self._seq += 1
+        seq = self._seq
+        # CLOCK_MONOTONIC is system-wide on Linux, so the worker can diff it
+        sent = time.monotonic()
+        shard.inflight[seq] = sent
+        try:
+            async with shard.write_lock:
+                writer.write(encode_frame({"t": "update", "seq": seq, "key": key, "sent": sent, "update": update}))
+                await writer.drain()
+        except (ConnectionError, RuntimeError):
+            # the reader side notices the disconnect and settles this seq
+            return
+        shard.forwarded += 1
+
+    async def close(self, timeout: float = 10.0) -> None:
+        self._closing = True
+        procs = [s.proc for s in self._shards if s.proc is not None and s.proc.returncode is None]
+        for p in procs:
+            p.send_signal(signal.SIGINT)
+        if procs:
+            try:
+                await asyncio.wait_for(asyncio.gather(*(p.wait() for p in procs)), timeout=timeout)
+            except asyncio.TimeoutError:
+                for p in procs:
+                    if p.returncode is None:
+                        p.kill()
+        for t in self._supervisors:
+            t.cancel()
+        await asyncio.gather(*self._supervisors, return_exceptions=True)
+        if self._server is not None:
+            self._server.close()
+        for t in list(self._readers):
+            t.cancel()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    def stats(self) -> dict:
+        return {str(s.index): s.stats() for s in self._shards}
+
+    def metric_dumps(self) -> List[Tuple[Dict[str, str], List[dict]]]:
+        """Workers' last reported metrics, labelled by shard, for /metrics."""
+        return [({"shard": str(s.index)}, s.worker_metrics) for s in self._shards]
+
+
+class ShardForwardMiddleware(BaseMiddleware):
+    """Outer update middleware of the ingress dispatcher: hands the update to
+    a worker instead of running handlers here.
+
+    Registered after aiogram's user-context middleware, so `event_from_user`
+    is already resolved.
+    """
+
+    def __init__(self, router: ShardRouter):
+        self.router = router
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        if not isinstance(event, Update):
+            return await handler(event, data)
+        user = data.get("event_from_user")
+        chat = data.get("event_chat")
+        key = user.id if user else (chat.id if chat else 0)
+        await self.router.forward(key, event.model_dump(mode="json", by_alias=True, exclude_none=True))
+        return None
@@ -39,6 +39,11 @@ PAYMENT_SUCCESS = (
     "Подписка активирована. Добро пожаловать в Premium."
 )
 
+RENEWAL_REMINDER = (
+    "⏳ <b>Premium заканчивается {date}</b>\n\n"
+    "Продли в «💎 Подписка» — новые дни добавятся к текущему сроку."
+)
+
 PAYMENT_EXPIRED = (
     "⌛️ <b>Счет просрочен</b>\n"
     "Если хочешь — создай новый в «💎 Подписка»."
@@ -49,6 +54,17 @@ GENERIC_ERROR = (
     "Попробуй ещё раз. Если ошибка повторяется — напиши /start."
 )
 
+QUEUE_POSITION = "⏳ <i>Ты в очереди: #{position}, примерно {eta} сек.</i>"
+
+GENERATION_SUPERSEDED = "↩️ <i>Ответ отменён — отвечаю на новое сообщение.</i>"
+
+DEFERRED_ACCEPTED = (
+    "🗂 <b>Запрос №{job_id} принят</b>\n\n"
+    "Он тяжёлый (WEB-исследование / длинный текст) — готовлю ответ в фоне и пришлю его отдельным сообщением."
+)
+
+DEFERRED_READY = "✅ <b>Ответ на запрос №{job_id}</b>"
+
 PROFILE_TEMPLATE = """👤 <b>Профиль</b>
 
 • Тариф: <b>{plan}</b>
@@ -103,3 +119,18 @@ MEDICAL_DISCLAIMER = (
     "⚕️ <b>Дисклеймер</b>: это образовательная информация и не замена очной консультации врача.\n"
     "Если есть выраженное ухудшение, сильная боль, кровотечение, одышка, неврологические симптомы — обращайся за неотложной помощью."
 )
+
+BROADCAST_USAGE = "Использование: <code>/broadcast текст рассылки</code> (HTML-разметка сохраняется)"
+BROADCAST_STARTED = "📣 Рассылка <b>#{id}</b> запущена. Статус: /broadcast_status"
+BROADCAST_STATUS_EMPTY = "Рассылок ещё не было."
+BROADCAST_STATUS_LINE = "#{id} · {kind} · {status} — ✅ {sent} · ⛔ {blocked} · ⚠️ {failed}"
+
+PROFILE_USAGE = "Использование: <code>/profile 10</code> — профилировать процесс N секунд (1–{max})"
+PROFILE_STARTED = "⏱ Профилирую {seconds} с…"
+PROFILE_BUSY = "Профилировщик уже запущен, подожди."
+
+TIMEZONE_CURRENT = """🕒 Твой часовой пояс: <b>{tz}</b>
+
+Чтобы поменять: <code>/timezone Europe/Moscow</code> или <code>/timezone +3</code>"""
+TIMEZONE_SET = "🕒 Часовой пояс: <b>{tz}</b>. Чек-ин будет приходить по твоему местному времени."
+TIMEZONE_BAD = "Не знаю такой часовой пояс 🤔 Пример: <code>/timezone Europe/Moscow</code> или <code>/timezone +3</code>"
@@ -0,0 +1,181 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import logging
+import os
+import time
+from contextlib import suppress
+from typing import Any, Dict, Set
+
+from aiogram import Dispatcher
+from aiogram.types import Update
+
+from bot.config import Settings
+from bot.logging_conf import setup_logging
+from bot.middlewares import TracingMiddleware, UpdateLatencyMiddleware
+from bot.routers import setup_routers
+from bot.runtime import build_runtime
+from bot.sharding import encode_frame, read_frame
+from services import deferred as deferred_repo
+from services.llm.supervisor import HANDLER_TURN
+from services.metrics import REGISTRY
+
+
+STATS_EVERY_SEC = 5.0
+CONNECT_ATTEMPTS = 50
+
+
+class _DeferredViaIngress:
+    """Deferred jobs are drained by the ingress process; a worker only
+    enqueues them and pokes the ingress."""
+
+    def __init__(self, db, send):
+        self.db = db
+        self.send = send
+
+    async def submit(self, *, user_id: int, chat_id: int, text: str) -> int:
+        job_id = await deferred_repo.enqueue(self.db, user_id=user_id, chat_id=chat_id, text=text)
+        await self.send({"t": "deferred", "job": job_id})
+        return job_id
+
+
+class _BroadcastsViaIngress:
+    """Broadcasts run in the ingress at the full Telegram budget."""
+
+    def __init__(self, send):
+        self.send = send
+        self._tasks: Set[asyncio.Task] = set()
+
+    def start(self, b) -> asyncio.Task:
+        # sync like BroadcastEngine.start, so callers never await it
+        t = asyncio.create_task(self.send({"t": "broadcast", "id": b.id}))
+        self._tasks.add(t)
+        t.add_done_callback(self._tasks.discard)
+        return t
+
+
+async def run_worker(shard: int, workers: int, socket_path: str) -> None:
+    settings = Settings()
+    setup_logging(settings.log_level)
+    log = logging.getLogger(f"worker.{shard}")
+
+    # migrations were applied by the ingress before we were spawned
+    runtime = await build_runtime(settings, share=workers, migrate=False, with_deferred=False)
+
+    dp = Dispatcher()
+    dp.include_router(setup_routers())
+    update_latency = UpdateLatencyMiddleware()
+    dp.update.outer_middleware(update_latency)
+    dp.update.outer_middleware(TracingMiddleware())
+
+    for attempt in range(CONNECT_ATTEMPTS):
+        try:
+            reader, writer = await asyncio.open_unix_connection(socket_path)
+            break
+        except (FileNotFoundError, ConnectionError):
+            await asyncio.sleep(0.1 * (attempt + 1))
+    else:
+        raise RuntimeError(f"ingress socket {socket_path} is not available")
+
+    send_lock = asyncio.Lock()
+
+    async def send(obj: Dict[str, Any]) -> None:
+        async with send_lock:
+            writer.write(encode_frame(obj))
+            await writer.drain()
+
+    workflow = runtime.workflow()
+    if settings.enable_deferred_mode:
+        workflow["deferred"] = _DeferredViaIngress(runtime.db, send)
+    workflow["broadcasts"] = _BroadcastsViaIngress(send)
+
+    tasks: Set[asyncio.Task] = set()
+    # per user: set when that user's latest update is handled (or has handed
+    # its answer to the supervisor); the next one waits for it
+    turns: Dict[int, asyncio.Event] = {}
+
+    async def handle(
+        seq: int,
+        sent: float,
+        raw: Dict[str, Any],
+        key: int,
+        prev: asyncio.Event | None,
+        turn: asyncio.Event,
+    ) -> None:
+        ipc = max(0.0, time.monotonic() - sent)
+        started = time.monotonic()
+        try:
+            if prev is not None:
+                await prev.wait()
+            started = time.monotonic()
+            HANDLER_TURN.set(turn)
+            update = Update.model_validate(raw, context={"bot": runtime.bot})
+            await dp.feed_update(runtime.bot, update, **workflow)
+        except Exception:
+            log.exception("update %s failed", raw.get("update_id"))
+        finally:
+            turn.set()
+            if turns.get(key) is turn:
+                del turns[key]
+            with suppress(ConnectionError, RuntimeError):
+                await send({"t": "ack", "seq": seq, "ipc": ipc, "handled": time.monotonic() - started})
+
+    async def report() -> None:
+        while True:
+            await asyncio.sleep(STATS_EVERY_SEC)
+            out: Dict[str, Any] = {"pending": len(tasks), "updates": update_latency.stats()}
+            for name, fn in runtime.stats().items():
+                with suppress(Exception):
+                    out[name] = fn()
+            with suppress(ConnectionError, RuntimeError):
+                await send({"t": "stats", "stats": out, "metrics": REGISTRY.dump()})
+
+    await send({"t": "hello", "shard": shard, "pid": os.getpid()})
+    log.info("worker %s/%s ready", shard, workers)
+    reporter = asyncio.create_task(report())
+    await dp.emit_startup(bot=runtime.bot, **workflow)
+    try:
+        while True:
+            msg = await read_frame(reader)
+            if msg is None:
+                log.warning("ingress closed the connection")
+                break
+            if msg.get("t") != "update":
+                continue
+            # one task per update, but a user's updates run one after another,
+            # in the order the ingress sent them
+            key = int(msg.get("key") or 0)
+            prev = turns.get(key)
+            turn = turns[key] = asyncio.Event()
+            t = asyncio.create_task(handle(int(msg["seq"]), float(msg["sent"]), msg["update"], key, prev, turn))
+            tasks.add(t)
+            t.add_done_callback(tasks.discard)
+    finally:
+        reporter.cancel()
+        if tasks:
+            await asyncio.wait(set(tasks), timeout=10)
+        with suppress(Exception):
+            await dp.emit_shutdown(bot=runtime.bot, **workflow)
+        writer.close()
+        await runtime.close()
+
+
+def main() -> None:
+    p = argparse.ArgumentParser(description="BlackBoxGPT update worker (spawned by bot.main when WORKERS > 0)")
+    p.add_argument("--shard", type=int, required=True)
+    p.add_argument("--workers", type=int, required=True)
+    p.add_argument("--socket", required=True)
+    args = p.parse_args()
+
+    with suppress(ImportError):
+        import uvloop
+
+        uvloop.install()
+
+    with suppress(KeyboardInterrupt):
+        asyncio.run(run_worker(args.shard, args.workers, args.socket))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,2 @@
+-- id of the last memory row folded into users.long_memory
+ALTER TABLE users ADD COLUMN long_memory_upto INTEGER NOT NULL DEFAULT 0;
@@ -0,0 +1,15 @@
+CREATE TABLE IF NOT EXISTS deferred_jobs(
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  user_id INTEGER NOT NULL,
+  chat_id INTEGER NOT NULL,
+  text TEXT NOT NULL,
+  status TEXT NOT NULL DEFAULT 'queued', -- queued | running | done | failed
+  attempts INTEGER NOT NULL DEFAULT 0,
+  created_at INTEGER NOT NULL,
+  started_at INTEGER NOT NULL DEFAULT 0,
+  finished_at INTEGER NOT NULL DEFAULT 0,
+  error TEXT NOT NULL DEFAULT '',
+  FOREIGN KEY(user_id) REFERENCES users(user_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_deferred_jobs_status ON deferred_jobs(status, id);
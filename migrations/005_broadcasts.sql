@@ -0,0 +1,21 @@
+-- users who blocked the bot are skipped by broadcasts until they write again
+ALTER TABLE users ADD COLUMN blocked INTEGER NOT NULL DEFAULT 0;
+
+CREATE TABLE IF NOT EXISTS broadcasts(
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  kind TEXT NOT NULL,                      -- checkin | admin
+  run_key TEXT NOT NULL,                   -- checkin:YYYY-MM-DD, admin:<ts>; a rerun resumes instead of resending
+  text TEXT NOT NULL,
+  audience TEXT NOT NULL,                  -- all | checkin
+  status TEXT NOT NULL DEFAULT 'running',  -- running | done
+  last_user_id INTEGER NOT NULL DEFAULT 0, -- keyset cursor: every recipient <= this was handled
+  sent INTEGER NOT NULL DEFAULT 0,
+  failed INTEGER NOT NULL DEFAULT 0,
+  blocked INTEGER NOT NULL DEFAULT 0,
+  created_by INTEGER,
+  created_at INTEGER NOT NULL,
+  finished_at INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_broadcasts_run_key ON broadcasts(run_key);
+CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts(status);
@@ -0,0 +1,6 @@
+-- per-user check-ins: local timezone (IANA name, '' = server TIMEZONE) and the next due time
+ALTER TABLE users ADD COLUMN tz TEXT NOT NULL DEFAULT '';
+-- 0 = not scheduled yet; the scheduler fills it in without sending
+ALTER TABLE users ADD COLUMN checkin_next_at INTEGER NOT NULL DEFAULT 0;
+
+CREATE INDEX IF NOT EXISTS idx_users_checkin_due ON users(checkin_enabled, checkin_next_at);
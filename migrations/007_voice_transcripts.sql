@@ -0,0 +1,7 @@
+-- second tier of the voice transcription cache (first one is an in-memory LRU)
+CREATE TABLE IF NOT EXISTS voice_transcripts(
+  file_unique_id TEXT PRIMARY KEY,
+  text TEXT NOT NULL,
+  duration INTEGER NOT NULL DEFAULT 0,
+  created_at INTEGER NOT NULL
+);
@@ -0,0 +1,7 @@
+-- local expiry: invoices are created with expires_in, so we know when they die without asking CryptoPay
+ALTER TABLE invoices ADD COLUMN expires_at INTEGER NOT NULL DEFAULT 0;
+UPDATE invoices SET expires_at = created_at + 3600 WHERE expires_at = 0;
+
+-- keyset sweeps over active invoices: WHERE status=? ORDER BY created_at, invoice_id
+DROP INDEX IF EXISTS idx_invoices_status;
+CREATE INDEX IF NOT EXISTS idx_invoices_status_created ON invoices(status, created_at);
@@ -0,0 +1,16 @@
+-- CryptoPay webhooks land here first; a worker applies them. One row per (invoice, status):
+-- a retried or duplicated delivery is an INSERT OR IGNORE no-op.
+CREATE TABLE IF NOT EXISTS cryptopay_inbox(
+  invoice_id INTEGER NOT NULL,
+  status TEXT NOT NULL,
+  payload TEXT NOT NULL DEFAULT '{}',
+  state TEXT NOT NULL DEFAULT 'pending', -- pending | done | failed
+  attempts INTEGER NOT NULL DEFAULT 0,
+  received_at INTEGER NOT NULL,
+  next_at INTEGER NOT NULL DEFAULT 0,    -- retry backoff
+  processed_at INTEGER NOT NULL DEFAULT 0,
+  error TEXT NOT NULL DEFAULT '',
+  PRIMARY KEY(invoice_id, status)
+);
+
+CREATE INDEX IF NOT EXISTS idx_cryptopay_inbox_pending ON cryptopay_inbox(state, next_at);
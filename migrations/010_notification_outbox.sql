@@ -0,0 +1,16 @@
+-- user notifications written in the same transaction as the state change that causes them;
+-- a sender drains it with rate limiting and retries
+CREATE TABLE IF NOT EXISTS notification_outbox(
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  chat_id INTEGER NOT NULL,
+  kind TEXT NOT NULL DEFAULT '',          -- payment_success | referral_bonus | payment_expired | ...
+  text TEXT NOT NULL,
+  status TEXT NOT NULL DEFAULT 'pending', -- pending | sent | failed
+  attempts INTEGER NOT NULL DEFAULT 0,
+  next_at INTEGER NOT NULL DEFAULT 0,
+  created_at INTEGER NOT NULL,
+  sent_at INTEGER NOT NULL DEFAULT 0,
+  error TEXT NOT NULL DEFAULT ''
+);
+
+CREATE INDEX IF NOT EXISTS idx_notification_outbox_due ON notification_outbox(status, next_at);
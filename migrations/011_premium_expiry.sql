@@ -0,0 +1,5 @@
+-- expiry scheduler loads upcoming expiries with a range scan: WHERE plan='premium' AND premium_until <= ?
+CREATE INDEX IF NOT EXISTS idx_users_plan_until ON users(plan, premium_until);
+
+-- premium_until the renewal reminder went out for; an extension moves premium_until and re-arms it
+ALTER TABLE users ADD COLUMN renewal_reminded_until INTEGER NOT NULL DEFAULT 0;
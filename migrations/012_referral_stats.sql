@@ -0,0 +1,16 @@
+-- /start <code> looks users up by ref_code
+CREATE UNIQUE INDEX IF NOT EXISTS idx_users_ref_code ON users(ref_code);
+
+-- per-referrer counters kept up to date on signup / premium start / premium end
+CREATE TABLE IF NOT EXISTS referral_stats(
+  user_id INTEGER PRIMARY KEY,
+  total INTEGER NOT NULL DEFAULT 0,    -- users who signed up with this referrer
+  premium INTEGER NOT NULL DEFAULT 0   -- of them, currently on plan='premium'
+);
+
+-- backfill
+INSERT OR REPLACE INTO referral_stats(user_id, total, premium)
+SELECT referrer_id, COUNT(*), SUM(plan = 'premium')
+FROM users
+WHERE referrer_id IS NOT NULL
+GROUP BY referrer_id;
@@ -0,0 +1,4 @@
+-- a repeated tap on a plan button reuses the user's still-valid invoice:
+-- WHERE status='active' AND user_id=? AND months=? AND amount=? AND asset=? AND expires_at > ?
+CREATE INDEX IF NOT EXISTS idx_invoices_user_pending ON invoices(user_id, months, amount, asset, expires_at)
+WHERE status = 'active';
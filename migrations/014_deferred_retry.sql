@@ -0,0 +1,6 @@
+-- a failed job waits before its next attempt: claim_next takes WHERE status='queued' AND not_before <= now
+ALTER TABLE deferred_jobs ADD COLUMN not_before INTEGER NOT NULL DEFAULT 0;
+
+-- a retry resumes after the last step that went through instead of generating and sending again
+ALTER TABLE deferred_jobs ADD COLUMN answer TEXT NOT NULL DEFAULT '';
+ALTER TABLE deferred_jobs ADD COLUMN delivered INTEGER NOT NULL DEFAULT 0;
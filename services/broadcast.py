@@ -0,0 +1,297 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import aiosqlite
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+
+
+log = logging.getLogger("broadcast")
+
+AUDIENCES = {
+    "all": "blocked = 0",
+    "checkin": "checkin_enabled = 1 AND blocked = 0",
+}
+
+MAX_SEND_ATTEMPTS = 3
+
+OUTCOME_SENT = "sent"
+OUTCOME_FAILED = "failed"
+OUTCOME_BLOCKED = "blocked"
+
+
+@dataclass
+class Broadcast:
+    id: int
+    kind: str
+    run_key: str
+    text: str
+    audience: str
+    status: str
+    last_user_id: int
+    sent: int
+    failed: int
+    blocked: int
+    created_at: int
+    finished_at: int
+
+
+def _row_to_broadcast(r: aiosqlite.Row) -> Broadcast:
+    return Broadcast(
+        id=r["id"],
+        kind=r["kind"],
+        run_key=r["run_key"],
+        text=r["text"],
+        audience=r["audience"],
+        status=r["status"],
+        last_user_id=r["last_user_id"],
+        sent=r["sent"],
+        failed=r["failed"],
+        blocked=r["blocked"],
+        created_at=r["created_at"],
+        finished_at=r["finished_at"],
+    )
+
+
+async def create_or_get(
+    db: aiosqlite.Connection,
+    *,
+    kind: str,
+    run_key: str,
+    text: str,
+    audience: str,
+    created_by: int | None = None,
+) -> Broadcast:
+    """Same run_key -> same row, so a rerun picks up at its cursor."""
+    if audience not in AUDIENCES:
+        raise ValueError(f"unknown audience: {audience}")
+    await db.execute(
+        """
+        INSERT OR IGNORE INTO broadcasts(kind, run_key, text, audience, created_by, created_at)
+        VALUES(?, ?, ?, ?, ?, ?)
+        """,
+        (kind, run_key, text, audience, created_by, int(time.time())),
+    )
+    await db.commit()
+    async with db.execute("SELECT * FROM broadcasts WHERE run_key=?", (run_key,)) as cur:
+        return _row_to_broadcast(await cur.fetchone())
+
+
+async def get_broadcast(db: aiosqlite.Connection, broadcast_id: int) -> Optional[Broadcast]:
+    async with db.execute("SELECT * FROM broadcasts WHERE id=?", (broadcast_id,)) as cur:
+        r = await cur.fetchone()
+        return _row_to_broadcast(r) if r else None
+
+
+async def list_recent(db: aiosqlite.Connection, limit: int = 5) -> List[Broadcast]:
+    async with db.execute("SELECT * FROM broadcasts ORDER BY id DESC LIMIT ?", (limit,)) as cur:
+        return [_row_to_broadcast(r) for r in await cur.fetchall()]
+
+
+async def list_unfinished(db: aiosqlite.Connection) -> List[Broadcast]:
+    async with db.execute("SELECT * FROM broadcasts WHERE status='running' ORDER BY id") as cur:
+        return [_row_to_broadcast(r) for r in await cur.fetchall()]
+
+
+async def recipients_after(db: aiosqlite.Connection, audience: str, after_user_id: int, limit: int) -> List[int]:
+    """One keyset page of recipients, walking the users primary key."""
+    async with db.execute(
+        f"SELECT user_id FROM users WHERE user_id > ? AND {AUDIENCES[audience]} ORDER BY user_id LIMIT ?",
+        (after_user_id, limit),
+    ) as cur:
+        return [int(r["user_id"]) for r in await cur.fetchall()]
+
+
+async def save_batch(
+    db: aiosqlite.Connection,
+    b: Broadcast,
+    *,
+    blocked_ids: List[int],
+    done: bool = False,
+) -> None:
+    """Cursor, counters and newly blocked users in one transaction."""
+    if blocked_ids:
+        await db.executemany("UPDATE users SET blocked=1 WHERE user_id=?", [(u,) for u in blocked_ids])
+    await db.execute(
+        """
+        UPDATE broadcasts
+        SET last_user_id=?, sent=?, failed=?, blocked=?, status=?, finished_at=?
+        WHERE id=?
+        """,
+        (
+            b.last_user_id,
+            b.sent,
+            b.failed,
+            b.blocked,
+            "done" if done else "running",
+            b.finished_at if done else 0,
+            b.id,
+        ),
+    )
+    await db.commit()
+
+
+class SendPacer:
+    """Spaces sends evenly at `per_sec`; a global 429 pushes everything back."""
+
+    def __init__(self, per_sec: float):
+        self.interval = 1.0 / per_sec if per_sec > 0 else 0.0
+        self._next = 0.0
+
+    async def wait(self) -> None:
+        now = time.monotonic()
+        at = max(now, self._next)
+        self._next = at + self.interval
+        if at > now:
+            await asyncio.sleep(at - now)
+
+    def pause(self, seconds: float) -> None:
+        self._next = max(self._next, time.monotonic() + seconds)
+
+
+class BroadcastEngine:
+    """Sends one text to an audience at a bounded rate, resumably.
+
+    Recipients are read in keyset pages of `batch_size`; each page is sent
+    with up to `concurrency` requests in flight, then the cursor, counters
+    and blocked users are written in one commit. After a crash at most one
+    page is resent.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        db: aiosqlite.Connection,
+        *,
+        per_sec: float = 25.0,
+        concurrency: int = 16,
+        batch_size: int = 500,
+    ):
+        self.bot = bot
+        self.db = db
+        self.per_sec = per_sec
+        self.concurrency = max(1, concurrency)
+        self.batch_size = max(1, batch_size)
+        self._pacer = SendPacer(per_sec)
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self.retry_after = 0
+        self.sent = 0
+
+    def start(self, b: Broadcast) -> asyncio.Task:
+        """Run in the background; a broadcast already running here is not started twice."""
+        t = self._tasks.get(b.id)
+        if t is None or t.done():
+            t = asyncio.create_task(self._run_logged(b))
+            self._tasks[b.id] = t
+            t.add_done_callback(lambda _: self._tasks.pop(b.id, None))
+        return t
+
+    async def resume_unfinished(self) -> int:
+        pending = await list_unfinished(self.db)
+        for b in pending:
+            log.info("resuming broadcast %s (%s) after user %s", b.id, b.run_key, b.last_user_id)
+            self.start(b)
+        return len(pending)
+
+    async def _run_logged(self, b: Broadcast) -> Broadcast:
+        try:
+            return await self.run(b)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("broadcast %s failed", b.id)
+            return b
+
+    async def run(self, b: Broadcast) -> Broadcast:
+        if b.status == "done":
+            return b
+        started = time.monotonic()
+        while True:
+            batch = await recipients_after(self.db, b.audience, b.last_user_id, self.batch_size)
+            if not batch:
+                break
+            outcomes = await self.deliver_many(batch, b.text)
+            blocked_ids = [u for u, o in zip(batch, outcomes) if o == OUTCOME_BLOCKED]
+            b.sent += outcomes.count(OUTCOME_SENT)
+            b.failed += outcomes.count(OUTCOME_FAILED)
+            b.blocked += len(blocked_ids)
+            b.last_user_id = batch[-1]
+            await save_batch(self.db, b, blocked_ids=blocked_ids)
+            if len(batch) < self.batch_size:
+                break
+
+        b.status = "done"
+        b.finished_at = int(time.time())
+        await save_batch(self.db, b, blocked_ids=[], done=True)
+        log.info(
+            "broadcast %s done in %.1fs: sent=%s failed=%s blocked=%s",
+            b.id,
+            time.monotonic() - started,
+            b.sent,
+            b.failed,
+            b.blocked,
+        )
+        return b
+
+    async def deliver_many(self, user_ids: List[int], text: str) -> List[str]:
+        """Send to a page of users under the engine's rate; one outcome per user."""
+        sem = asyncio.Semaphore(self.concurrency)
+
+        async def deliver(user_id: int) -> str:
+            async with sem:
+                return await self._deliver(user_id, text)
+
+        return list(await asyncio.gather(*(deliver(u) for u in user_ids)))
+
+    async def _deliver(self, user_id: int, text: str) -> str:
+        # 429 is Telegram pacing us, not a delivery failure: wait as told and
+        # retry without spending an attempt, so a long flood wait never marks
+        # the user failed and moves the cursor past them
+        attempts = 0
+        while True:
+            await self._pacer.wait()
+            try:
+                await self.bot.send_message(user_id, text)
+                self.sent += 1
+                return OUTCOME_SENT
+            except TelegramRetryAfter as e:
+                self.retry_after += 1
+                self._pacer.pause(float(e.retry_after))
+            except (TelegramNetworkError, TelegramServerError):
+                attempts += 1
+                if attempts >= MAX_SEND_ATTEMPTS:
+                    return OUTCOME_FAILED
+            except TelegramForbiddenError:
+                # blocked the bot / deactivated
+                return OUTCOME_BLOCKED
+            except TelegramBadRequest as e:
+                if "chat not found" in str(e).lower():
+                    return OUTCOME_BLOCKED
+                return OUTCOME_FAILED
+            except Exception:
+                return OUTCOME_FAILED
+
+    async def close(self) -> None:
+        for t in list(self._tasks.values()):
+            t.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        self._tasks.clear()
+
+    def stats(self) -> dict:
+        return {
+            "running": sorted(self._tasks),
+            "per_sec": self.per_sec,
+            "sent": self.sent,
+            "retry_after_429": self.retry_after,
+        }
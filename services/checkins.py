@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+import hashlib
+import re
+from datetime import datetime, timedelta
+from typing import Iterable, List, Optional, Tuple
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+import aiosqlite
+
+
+_OFFSET_RE = re.compile(r"^(?:utc|gmt)?\s*([+-])(\d{1,2})$", re.IGNORECASE)
+
+
+def jitter_seconds(user_id: int, window_sec: int) -> int:
+    """Stable per-user offset in [0, window): the same slot every day."""
+    if window_sec <= 0:
+        return 0
+    h = hashlib.blake2b(str(user_id).encode("ascii"), digest_size=8).digest()
+    return int.from_bytes(h, "big") % window_sec
+
+
+def parse_timezone(value: str) -> Optional[str]:
+    """IANA name ('Europe/Berlin') or a whole-hour offset ('+3', 'UTC-5')."""
+    value = (value or "").strip()
+    m = _OFFSET_RE.match(value)
+    if m:
+        hours = int(m.group(2))
+        if hours > 14:
+            return None
+        if hours == 0:
+            return "UTC"
+        # POSIX-style Etc zones have the sign inverted
+        return f"Etc/GMT{'-' if m.group(1) == '+' else '+'}{hours}"
+    try:
+        ZoneInfo(value)
+    except (ZoneInfoNotFoundError, ValueError):
+        return None
+    return value
+
+
+def next_checkin_at(
+    user_id: int,
+    tz: str,
+    *,
+    hour: int,
+    minute: int,
+    window_sec: int,
+    after: int,
+) -> int:
+    """Next local `hour:minute` + the user's jitter strictly after `after` (unix ts)."""
+    zone = ZoneInfo(tz)
+    offset = timedelta(seconds=jitter_seconds(user_id, window_sec))
+    day = datetime.fromtimestamp(after, tz=zone).date()
+    for _ in range(3):
+        slot = datetime(day.year, day.month, day.day, hour, minute, tzinfo=zone) + offset
+        ts = int(slot.timestamp())
+        if ts > after:
+            return ts
+        day += timedelta(days=1)
+    return after + 24 * 3600
+
+
+async def unscheduled(db: aiosqlite.Connection, limit: int) -> List[Tuple[int, str]]:
+    async with db.execute(
+        "SELECT user_id, tz FROM users WHERE checkin_enabled=1 AND checkin_next_at=0 LIMIT ?",
+        (limit,),
+    ) as cur:
+        return [(int(r["user_id"]), r["tz"] or "") for r in await cur.fetchall()]
+
+
+async def due(db: aiosqlite.Connection, now: int, limit: int) -> List[Tuple[int, str, bool]]:
+    """Users whose check-in is due: an index range scan, O(log n + k)."""
+    async with db.execute(
+        """
+        SELECT user_id, tz, blocked FROM users
+        WHERE checkin_enabled=1 AND checkin_next_at > 0 AND checkin_next_at <= ?
+        ORDER BY checkin_next_at
+        LIMIT ?
+        """,
+        (now, limit),
+    ) as cur:
+        return [(int(r["user_id"]), r["tz"] or "", bool(r["blocked"])) for r in await cur.fetchall()]
+
+
+async def reschedule(
+    db: aiosqlite.Connection,
+    next_at: Iterable[Tuple[int, int]],
+    *,
+    blocked_ids: Iterable[int] = (),
+) -> None:
+    """New due times (and users found blocked) in one commit."""
+    blocked = [(u,) for u in blocked_ids]
+    if blocked:
+        await db.executemany("UPDATE users SET blocked=1 WHERE user_id=?", blocked)
+    await db.executemany(
+        "UPDATE users SET checkin_next_at=? WHERE user_id=?",
+        [(ts, u) for u, ts in next_at],
+    )
+    await db.commit()
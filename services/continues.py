@@ -8,6 +8,8 @@ from typing import List, Optional
 
 import aiosqlite
 
+from services.metrics import db_timed
+
 
 @dataclass
 class ContinueState:
@@ -22,6 +24,7 @@ def new_token() -> str:
     return secrets.token_urlsafe(16)
 
 
+@db_timed
 async def create(db: aiosqlite.Connection, user_id: int, parts: list[str]) -> ContinueState:
     token = new_token()
     await db.execute(
@@ -32,6 +35,7 @@ async def create(db: aiosqlite.Connection, user_id: int, parts: list[str]) -> Co
     return ContinueState(token=token, user_id=user_id, parts=parts, idx=0, created_at=int(time.time()))
 
 
+@db_timed
 async def get(db: aiosqlite.Connection, token: str) -> Optional[ContinueState]:
     async with db.execute("SELECT * FROM continues WHERE token=?", (token,)) as cur:
         r = await cur.fetchone()
@@ -44,11 +48,13 @@ async def get(db: aiosqlite.Connection, token: str) -> Optional[ContinueState]:
     return ContinueState(token=r["token"], user_id=r["user_id"], parts=parts, idx=r["idx"], created_at=r["created_at"])
 
 
+@db_timed
 async def bump(db: aiosqlite.Connection, token: str) -> None:
     await db.execute("UPDATE continues SET idx = idx + 1 WHERE token=?", (token,))
     await db.commit()
 
 
+@db_timed
 async def delete(db: aiosqlite.Connection, token: str) -> None:
     await db.execute("DELETE FROM continues WHERE token=?", (token,))
     await db.commit()
@@ -89,12 +89,20 @@ class CryptoPayClient:
             raw=result,
         )
 
-    async def get_invoices(self, invoice_ids: list[int] | None = None, status: str | None = None) -> list[Invoice]:
+    async def get_invoices(
+        self,
+        invoice_ids: list[int] | None = None,
+        status: str | None = None,
+        count: int | None = None,
+    ) -> list[Invoice]:
         params: dict[str, Any] = {}
         if invoice_ids:
             params["invoice_ids"] = ",".join(str(i) for i in invoice_ids)
         if status:
             params["status"] = status
+        if count:
+            # the API returns 100 items unless asked for more (max 1000)
+            params["count"] = min(1000, count)
 
         result = await self._request("getInvoices", params)
         items = result.get("items", [])
@@ -0,0 +1,227 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Deque, List
+
+import aiosqlite
+
+from services.db import transaction
+
+
+log = logging.getLogger("cryptopay_inbox")
+
+BATCH_SIZE = 100
+MAX_ATTEMPTS = 5
+# a failed event is retried after RETRY_BASE_SEC * 2**attempts
+RETRY_BASE_SEC = 10
+# idle worker wakes up this often to pick up retries that came due
+POLL_SEC = 30
+
+
+@dataclass
+class InboxEvent:
+    invoice_id: int
+    status: str
+    payload: dict[str, Any]
+    attempts: int
+    received_at: int
+
+
+async def record(
+    db: aiosqlite.Connection,
+    invoice_id: int,
+    status: str,
+    payload: dict[str, Any],
+    *,
+    commit: bool = True,
+) -> bool:
+    """Store a webhook event; False when this (invoice, status) was already received."""
+    cur = await db.execute(
+        "INSERT OR IGNORE INTO cryptopay_inbox(invoice_id, status, payload, received_at) VALUES(?, ?, ?, ?)",
+        (invoice_id, status, json.dumps(payload, ensure_ascii=False), int(time.time())),
+    )
+    if commit:
+        await db.commit()
+    return bool(cur.rowcount)
+
+
+async def due_events(db: aiosqlite.Connection, now: int, limit: int) -> List[InboxEvent]:
+    async with db.execute(
+        """
+        SELECT invoice_id, status, payload, attempts, received_at FROM cryptopay_inbox
+        WHERE state='pending' AND next_at <= ?
+        ORDER BY next_at, received_at
+        LIMIT ?
+        """,
+        (now, limit),
+    ) as cur:
+        rows = await cur.fetchall()
+    out = []
+    for r in rows:
+        try:
+            payload = json.loads(r["payload"] or "{}")
+        except Exception:
+            payload = {}
+        out.append(InboxEvent(r["invoice_id"], r["status"], payload, r["attempts"], r["received_at"]))
+    return out
+
+
+async def count_pending(db: aiosqlite.Connection) -> int:
+    async with db.execute("SELECT COUNT(*) AS c FROM cryptopay_inbox WHERE state='pending'") as cur:
+        return int((await cur.fetchone())["c"])
+
+
+async def finish_batch(
+    db: aiosqlite.Connection,
+    done: List[InboxEvent],
+    failed: List[tuple[InboxEvent, str]],
+    *,
+    commit: bool = True,
+) -> None:
+    """Mark a drained batch in one commit; failures go back with backoff or give up."""
+    now = int(time.time())
+    await db.executemany(
+        "UPDATE cryptopay_inbox SET state='done', processed_at=?, attempts=attempts+1 WHERE invoice_id=? AND status=?",
+        [(now, e.invoice_id, e.status) for e in done],
+    )
+    await db.executemany(
+        """
+        UPDATE cryptopay_inbox SET state=?, attempts=attempts+1, next_at=?, error=?, processed_at=?
+        WHERE invoice_id=? AND status=?
+        """,
+        [
+            (
+                "failed" if e.attempts + 1 >= MAX_ATTEMPTS else "pending",
+                now + RETRY_BASE_SEC * 2**e.attempts,
+                err[:500],
+                now if e.attempts + 1 >= MAX_ATTEMPTS else 0,
+                e.invoice_id,
+                e.status,
+            )
+            for e, err in failed
+        ],
+    )
+    if commit:
+        await db.commit()
+
+
+def _percentile_ms(vals: Deque[float], q: float) -> float:
+    if not vals:
+        return 0.0
+    s = sorted(vals)
+    return round(s[min(len(s) - 1, int(q * len(s)))] * 1000, 2)
+
+
+EventHandler = Callable[[InboxEvent], Awaitable[None]]
+
+
+class CryptoPayInbox:
+    """Webhook side: persist and return. Worker side: apply events in batches.
+
+    The HTTP handler only verifies, inserts and acks, so CryptoPay never
+    waits on premium activation, Telegram sends or referral rewards, and
+    a flood of retries costs one ignored insert each.
+
+    Acks insert on `db`, the ordinary autocommit connection, so they never
+    queue behind a transaction() unit. The worker drains on `tx_db`, which
+    the handler's status changes share, so its writes go through
+    transaction().
+    """
+
+    def __init__(
+        self,
+        db: aiosqlite.Connection,
+        tx_db: aiosqlite.Connection,
+        handler: EventHandler,
+        *,
+        batch_size: int = BATCH_SIZE,
+    ):
+        self.db = db
+        self.tx_db = tx_db
+        self.handler = handler
+        self.batch_size = max(1, batch_size)
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self.received = 0
+        self.duplicates = 0
+        self.processed = 0
+        self.failed = 0
+        self.depth = 0
+        self._ack: Deque[float] = deque(maxlen=1000)
+        self._lag: Deque[float] = deque(maxlen=500)
+
+    async def start(self) -> None:
+        self.depth = await count_pending(self.tx_db)
+        self._task = asyncio.create_task(self._worker())
+        if self.depth:
+            self._wakeup.set()
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def submit(self, invoice_id: int, status: str, payload: dict[str, Any], *, started: float) -> bool:
+        """Called from the webhook; `started` is when the request came in (monotonic)."""
+        inserted = await record(self.db, invoice_id, status, payload)
+        if inserted:
+            self.received += 1
+            self.depth += 1
+            self._wakeup.set()
+        else:
+            self.duplicates += 1
+        self._ack.append(time.monotonic() - started)
+        return inserted
+
+    async def _worker(self) -> None:
+        while True:
+            events = await due_events(self.tx_db, int(time.time()), self.batch_size)
+            if not events:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), POLL_SEC)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._drain(events)
+
+    async def _drain(self, events: List[InboxEvent]) -> None:
+        done: List[InboxEvent] = []
+        failed: List[tuple[InboxEvent, str]] = []
+        for e in events:
+            try:
+                await self.handler(e)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                log.exception("inbox event %s/%s failed", e.invoice_id, e.status)
+                failed.append((e, str(exc)))
+            else:
+                done.append(e)
+                self._lag.append(max(0, int(time.time()) - e.received_at))
+        async with transaction(self.tx_db):
+            await finish_batch(self.tx_db, done, failed, commit=False)
+        self.processed += len(done)
+        gave_up = sum(1 for e, _ in failed if e.attempts + 1 >= MAX_ATTEMPTS)
+        self.failed += gave_up
+        self.depth = max(0, self.depth - len(done) - gave_up)
+
+    def stats(self) -> dict:
+        lag = sorted(self._lag)
+        return {
+            "received": self.received,
+            "duplicates": self.duplicates,
+            "processed": self.processed,
+            "failed": self.failed,
+            "depth": self.depth,
+            "ack_p50_ms": _percentile_ms(self._ack, 0.50),
+            "ack_p99_ms": _percentile_ms(self._ack, 0.99),
+            "lag_p50_sec": lag[len(lag) // 2] if lag else 0,
+            "lag_max_sec": lag[-1] if lag else 0,
+        }
@@ -1,8 +1,11 @@
 from __future__ import annotations
 
+import asyncio
 import os
+import weakref
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import Iterable
+from typing import AsyncIterator, Iterable
 
 import aiosqlite
 
@@ -24,6 +27,33 @@ async def connect(db_path: str) -> aiosqlite.Connection:
     return db
 
 
+_tx_locks: "weakref.WeakKeyDictionary[aiosqlite.Connection, asyncio.Lock]" = weakref.WeakKeyDictionary()
+
+
+@asynccontextmanager
+async def transaction(db: aiosqlite.Connection) -> AsyncIterator[aiosqlite.Connection]:
+    """One multi-statement unit of work: committed on success, rolled back on error.
+
+    Meant for a connection that only runs such units (Runtime.tx_db): a commit
+    or rollback from an unrelated handler on a shared connection would cut a
+    unit in half. Units on one connection run one at a time, and BEGIN
+    IMMEDIATE takes SQLite's write lock up front, so writers on other
+    connections wait for the commit instead of interleaving. Repository calls
+    inside pass commit=False.
+    """
+    lock = _tx_locks.get(db)
+    if lock is None:
+        lock = _tx_locks[db] = asyncio.Lock()
+    async with lock:
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            await db.rollback()
+            raise
+        await db.commit()
+
+
 async def apply_migrations(db: aiosqlite.Connection, migrations_dir: str) -> None:
     await db.execute(MIGRATIONS_TABLE_SQL)
     await db.commit()
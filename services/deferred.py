@@ -0,0 +1,244 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Deque, List, Optional
+
+import aiosqlite
+
+from services import tracing
+from services.llm.features import TextFeatures
+
+
+log = logging.getLogger("deferred")
+
+MAX_ATTEMPTS = 3
+# a failed job is retried after RETRY_BASE_SEC * 4**(attempts - 1)
+RETRY_BASE_SEC = 15
+# idle workers look for retries that came due this often
+POLL_SEC = 5
+
+
+@dataclass
+class DeferredJob:
+    id: int
+    user_id: int
+    chat_id: int
+    text: str
+    status: str
+    attempts: int
+    created_at: int
+    started_at: int
+    finished_at: int
+    error: str
+    answer: str = ""  # saved once generated, so a retry doesn't generate again
+    delivered: int = 0  # messages already sent to the chat
+
+
+def _row_to_job(r: aiosqlite.Row) -> DeferredJob:
+    return DeferredJob(
+        id=r["id"],
+        user_id=r["user_id"],
+        chat_id=r["chat_id"],
+        text=r["text"],
+        status=r["status"],
+        attempts=r["attempts"],
+        created_at=r["created_at"],
+        started_at=r["started_at"],
+        finished_at=r["finished_at"],
+        error=r["error"],
+        answer=r["answer"],
+        delivered=r["delivered"],
+    )
+
+
+def predict_heavy(features: TextFeatures, mode: str, settings: Any) -> bool:
+    """Pro answers that will do web research or chew through a long input."""
+    if mode != "pro":
+        return False
+    return features.needs_web or features.length >= settings.deferred_min_chars
+
+
+async def enqueue(db: aiosqlite.Connection, *, user_id: int, chat_id: int, text: str) -> int:
+    cur = await db.execute(
+        "INSERT INTO deferred_jobs(user_id, chat_id, text, status, created_at) VALUES(?, ?, ?, 'queued', ?)",
+        (user_id, chat_id, text, int(time.time())),
+    )
+    await db.commit()
+    return int(cur.lastrowid)
+
+
+async def claim_next(db: aiosqlite.Connection) -> Optional[DeferredJob]:
+    now = int(time.time())
+    async with db.execute(
+        "SELECT * FROM deferred_jobs WHERE status='queued' AND not_before <= ? ORDER BY id LIMIT 1",
+        (now,),
+    ) as cur:
+        r = await cur.fetchone()
+    if not r:
+        return None
+    await db.execute(
+        "UPDATE deferred_jobs SET status='running', started_at=?, attempts=attempts+1 WHERE id=?",
+        (now, r["id"]),
+    )
+    await db.commit()
+    job = _row_to_job(r)
+    job.status = "running"
+    job.started_at = now
+    job.attempts += 1
+    return job
+
+
+async def finish(db: aiosqlite.Connection, job_id: int, status: str, error: str = "") -> None:
+    await db.execute(
+        "UPDATE deferred_jobs SET status=?, finished_at=?, error=? WHERE id=?",
+        (status, int(time.time()), error[:500], job_id),
+    )
+    await db.commit()
+
+
+async def retry_later(db: aiosqlite.Connection, job_id: int, delay: int, error: str = "") -> None:
+    await db.execute(
+        "UPDATE deferred_jobs SET status='queued', not_before=?, error=? WHERE id=?",
+        (int(time.time()) + delay, error[:500], job_id),
+    )
+    await db.commit()
+
+
+async def save_answer(db: aiosqlite.Connection, job: DeferredJob, answer: str) -> None:
+    await db.execute("UPDATE deferred_jobs SET answer=? WHERE id=?", (answer, job.id))
+    await db.commit()
+    job.answer = answer
+
+
+async def mark_delivered(db: aiosqlite.Connection, job: DeferredJob, delivered: int) -> None:
+    await db.execute("UPDATE deferred_jobs SET delivered=? WHERE id=?", (delivered, job.id))
+    await db.commit()
+    job.delivered = delivered
+
+
+async def requeue_running(db: aiosqlite.Connection) -> int:
+    """Jobs interrupted by a restart go back to the queue."""
+    cur = await db.execute("UPDATE deferred_jobs SET status='queued' WHERE status='running'")
+    await db.commit()
+    return cur.rowcount or 0
+
+
+async def count_queued(db: aiosqlite.Connection) -> int:
+    async with db.execute("SELECT COUNT(*) AS c FROM deferred_jobs WHERE status='queued'") as cur:
+        return int((await cur.fetchone())["c"])
+
+
+def _percentile(sorted_vals: List[float], q: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    return sorted_vals[min(len(sorted_vals) - 1, int(q * len(sorted_vals)))]
+
+
+JobHandler = Callable[[DeferredJob], Awaitable[None]]
+
+
+class DeferredQueue:
+    """SQLite-backed job queue drained by a bounded pool of workers."""
+
+    def __init__(self, db: aiosqlite.Connection, handler: JobHandler, *, workers: int = 2):
+        self.db = db
+        self.handler = handler
+        self.workers = max(1, workers)
+        self._wakeup = asyncio.Event()
+        self._claim_lock = asyncio.Lock()
+        self._tasks: List[asyncio.Task] = []
+        self.depth = 0
+        self.running = 0
+        self.done = 0
+        self.failed = 0
+        self._wait: Deque[float] = deque(maxlen=500)
+        self._latency: Deque[float] = deque(maxlen=500)
+
+    async def start(self) -> None:
+        restored = await requeue_running(self.db)
+        if restored:
+            log.info("requeued %s interrupted jobs", restored)
+        self.depth = await count_queued(self.db)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        if self.depth:
+            self._wakeup.set()
+
+    async def close(self) -> None:
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, *, user_id: int, chat_id: int, text: str) -> int:
+        job_id = await enqueue(self.db, user_id=user_id, chat_id=chat_id, text=text)
+        self.depth += 1
+        self._wakeup.set()
+        return job_id
+
+    def notify(self) -> None:
+        """Another process enqueued a job into the same table."""
+        self.depth += 1
+        self._wakeup.set()
+
+    async def _claim(self) -> Optional[DeferredJob]:
+        async with self._claim_lock:
+            job = await claim_next(self.db)
+            if job is None:
+                self._wakeup.clear()
+            else:
+                self.depth = max(0, self.depth - 1)
+            return job
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self._claim()
+            if job is None:
+                # new jobs set the event; backed-off retries are picked up by the poll
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), POLL_SEC)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self.running += 1
+            self._wait.append(max(0, job.started_at - job.created_at))
+            try:
+                with tracing.trace("deferred_job", job_id=job.id, user_id=job.user_id):
+                    await self.handler(job)
+            except asyncio.CancelledError:
+                # shutting down: the job stays 'running' and is requeued on start
+                raise
+            except Exception as e:
+                log.exception("deferred job %s failed", job.id)
+                if job.attempts < MAX_ATTEMPTS:
+                    await retry_later(self.db, job.id, RETRY_BASE_SEC * 4 ** (job.attempts - 1), str(e))
+                    self.depth += 1
+                else:
+                    await finish(self.db, job.id, "failed", str(e))
+                    self.failed += 1
+            else:
+                await finish(self.db, job.id, "done")
+                self.done += 1
+                self._latency.append(max(0, int(time.time()) - job.created_at))
+            finally:
+                self.running -= 1
+
+    def stats(self) -> dict:
+        wait = sorted(self._wait)
+        lat = sorted(self._latency)
+        return {
+            "workers": self.workers,
+            "depth": self.depth,
+            "running": self.running,
+            "done": self.done,
+            "failed": self.failed,
+            "wait_p50_sec": _percentile(wait, 0.50),
+            "wait_p95_sec": _percentile(wait, 0.95),
+            "latency_p50_sec": _percentile(lat, 0.50),
+            "latency_p95_sec": _percentile(lat, 0.95),
+            "latency_p99_sec": _percentile(lat, 0.99),
+        }
@@ -0,0 +1,229 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram.exceptions import TelegramRetryAfter
+
+from services import tracing
+
+EditFn = Callable[[str], Awaitable[Any]]
+
+
+class _ChatPace:
+    """Pacing shared by every stream in one chat: Telegram's limit is per chat."""
+
+    __slots__ = ("next_at", "streams")
+
+    def __init__(self) -> None:
+        self.next_at = 0.0
+        self.streams = 0
+
+
+class EditSession:
+    """One streaming message. Only the latest submitted preview is ever sent."""
+
+    def __init__(self, scheduler: "EditScheduler", chat_id: int, edit: EditFn, pace: _ChatPace):
+        self.scheduler = scheduler
+        self.chat_id = chat_id
+        self.edit = edit
+        self.pace = pace
+        self.pending: Optional[str] = None
+        self.last_sent: Optional[str] = None
+        # streams of one chat take turns: the least recently edited goes first
+        self.sent_at = 0.0
+        self.closed = False
+        self.inflight: Optional[asyncio.Task] = None
+        # edits are sent from the scheduler's task; keep them in the request's trace
+        self.trace = tracing.capture()
+
+    def submit(self, text: str) -> None:
+        if self.closed:
+            return
+        if self.pending is not None:
+            self.scheduler.coalesced += 1
+        self.pending = text
+        self.scheduler.submitted += 1
+        self.scheduler._wakeup.set()
+
+    async def close(self) -> None:
+        """Drop whatever is pending and wait for an edit already on the wire.
+
+        The caller is about to send the final text; a late preview must not
+        overwrite it.
+        """
+        if not self.closed:
+            self.closed = True
+            if self.pending is not None:
+                self.scheduler.coalesced += 1
+                self.pending = None
+            self.scheduler._unregister(self)
+        if self.inflight is not None and not self.inflight.done():
+            await asyncio.wait({self.inflight})
+
+
+class EditScheduler:
+    """Central pacing of streaming-preview edits.
+
+    - global budget of edits per second across all chats;
+    - per-chat interval, shared by all streams in that chat (a group, or a
+      deferred answer next to a live one), that grows with the number of
+      active chats;
+    - pending previews are coalesced, identical text is never resent;
+    - TelegramRetryAfter pauses the chat (and the whole sender if it's global).
+    """
+
+    def __init__(self, *, global_per_sec: float = 25.0, min_interval: float = 0.9, max_interval: float = 5.0):
+        self.global_per_sec = global_per_sec
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self._sessions: Dict[int, EditSession] = {}
+        self._chats: Dict[int, _ChatPace] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._paused_until = 0.0
+        self._tokens = global_per_sec
+        self._tokens_at = time.monotonic()
+
+        self.submitted = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.skipped_noop = 0
+        self.retry_after = 0
+        self.failed = 0
+        self._window_start = time.monotonic()
+        self._window_sent = 0
+        self.edits_per_sec = 0.0
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def register(self, chat_id: int, edit: EditFn) -> EditSession:
+        self.start()
+        pace = self._chats.get(chat_id)
+        if pace is None:
+            pace = self._chats[chat_id] = _ChatPace()
+        pace.streams += 1
+        s = EditSession(self, chat_id, edit, pace)
+        self._sessions[id(s)] = s
+        return s
+
+    def _unregister(self, s: EditSession) -> None:
+        if self._sessions.pop(id(s), None) is None:
+            return
+        s.pace.streams -= 1
+        if s.pace.streams <= 0 and self._chats.get(s.chat_id) is s.pace:
+            del self._chats[s.chat_id]
+
+    def chat_interval(self) -> float:
+        # spread the global budget across active chats
+        active = max(1, len(self._chats))
+        return min(self.max_interval, max(self.min_interval, active / self.global_per_sec))
+
+    def _take_token(self, now: float) -> float:
+        self._tokens = min(self.global_per_sec, self._tokens + (now - self._tokens_at) * self.global_per_sec)
+        self._tokens_at = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) / self.global_per_sec
+
+    def _next_due(self, now: float) -> Optional[EditSession]:
+        best: Optional[EditSession] = None
+        for s in self._sessions.values():
+            if s.pending is None or (s.inflight is not None and not s.inflight.done()):
+                continue
+            if best is None or (s.pace.next_at, s.sent_at) < (best.pace.next_at, best.sent_at):
+                best = s
+        return best
+
+    async def _run(self) -> None:
+        while True:
+            now = time.monotonic()
+            s = self._next_due(now)
+            if s is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            wait = max(s.pace.next_at - now, self._paused_until - now)
+            if wait <= 0:
+                wait = self._take_token(now)
+            if wait > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            text = s.pending
+            s.pending = None
+            if text is None or s.closed:
+                continue
+            if text == s.last_sent:
+                self.skipped_noop += 1
+                continue
+
+            s.sent_at = time.monotonic()
+            s.pace.next_at = s.sent_at + self.chat_interval()
+            s.inflight = asyncio.create_task(self._send(s, text))
+
+    async def _send(self, s: EditSession, text: str) -> None:
+        try:
+            with tracing.attach(s.trace):
+                await s.edit(text)
+            s.last_sent = text
+            self._count_sent()
+        except TelegramRetryAfter as e:
+            self.retry_after += 1
+            delay = float(e.retry_after)
+            # the whole chat waits, not just this stream
+            s.pace.next_at = max(s.pace.next_at, time.monotonic() + delay)
+            if delay > self.max_interval:
+                # flood control on the bot as a whole — back off everything
+                self._paused_until = time.monotonic() + delay
+            if s.pending is None and not s.closed:
+                s.pending = text
+        except Exception:
+            self.failed += 1
+        finally:
+            # the chat may have a newer preview waiting for this edit to finish
+            self._wakeup.set()
+
+    def _count_sent(self) -> None:
+        self.sent += 1
+        self._window_sent += 1
+        now = time.monotonic()
+        elapsed = now - self._window_start
+        if elapsed >= 5.0:
+            self.edits_per_sec = self._window_sent / elapsed
+            self._window_start = now
+            self._window_sent = 0
+
+    def stats(self) -> dict:
+        return {
+            "active_sessions": len(self._sessions),
+            "active_chats": len(self._chats),
+            "chat_interval_sec": round(self.chat_interval(), 3),
+            "edits_per_sec": round(self.edits_per_sec, 2),
+            "submitted": self.submitted,
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "coalesce_ratio": round(self.coalesced / self.submitted, 3) if self.submitted else 0.0,
+            "skipped_noop": self.skipped_noop,
+            "retry_after_429": self.retry_after,
+            "failed": self.failed,
+            "paused_for_sec": round(max(0.0, self._paused_until - time.monotonic()), 3),
+        }
@@ -0,0 +1,170 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import logging
+import time
+from datetime import datetime
+from typing import List, Tuple
+from zoneinfo import ZoneInfo
+
+import aiosqlite
+
+from bot import texts
+from services import outbox
+from services import subscriptions as subs_repo
+from services.db import transaction
+from services.outbox import NotificationSender
+
+
+log = logging.getLogger("expiry")
+
+# how far ahead the heap is filled from the index, and how often it is refilled
+HORIZON_SEC = 3600
+RELOAD_SEC = 600
+LOAD_LIMIT = 1000
+# downgrades / reminders applied per statement batch
+BATCH = 500
+
+KIND_EXPIRE = 0
+KIND_REMIND = 1
+
+
+class ExpiryScheduler:
+    """Downgrades premium users the moment they expire; reminds them a bit before.
+
+    Upcoming expiries (and reminder times) within HORIZON_SEC are loaded
+    through the (plan, premium_until) index into a min-heap; the loop sleeps
+    until the earliest one, then applies everything due in batched
+    statements. Entries made stale by a renewal are filtered by the
+    conditional UPDATEs, and renewals land in the heap on the next reload.
+    """
+
+    def __init__(
+        self,
+        db: aiosqlite.Connection,
+        *,
+        sender: NotificationSender | None = None,
+        remind_before_sec: int = 24 * 3600,
+        timezone: str = "UTC",
+    ):
+        self.db = db
+        self.sender = sender
+        self.remind_before_sec = remind_before_sec
+        self.timezone = timezone
+        self._heap: List[Tuple[int, int, int, int]] = []  # (fire_at, kind, user_id, premium_until)
+        self._loaded_until = 0
+        self._next_reload = 0.0
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self.downgraded = 0
+        self.reminded = 0
+        self.reloads = 0
+        self._lag_max = 0
+
+    async def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _reload(self, now: int) -> None:
+        horizon = now + HORIZON_SEC
+        expiries = await subs_repo.upcoming_expiries(self.db, horizon, LOAD_LIMIT)
+        loaded_until = horizon
+        if len(expiries) == LOAD_LIMIT:
+            # a backlog (e.g. after downtime): take it in chunks, reload once it's worked off
+            loaded_until = expiries[-1][1]
+        heap = [(until, KIND_EXPIRE, user_id, until) for user_id, until in expiries]
+
+        if self.remind_before_sec > 0:
+            reminders = await subs_repo.upcoming_reminders(
+                self.db, now, min(loaded_until, horizon) + self.remind_before_sec, LOAD_LIMIT
+            )
+            heap += [(until - self.remind_before_sec, KIND_REMIND, user_id, until) for user_id, until in reminders]
+            if len(reminders) == LOAD_LIMIT:
+                loaded_until = min(loaded_until, reminders[-1][1] - self.remind_before_sec)
+
+        heapq.heapify(heap)
+        self._heap = heap
+        self._loaded_until = loaded_until
+        self._next_reload = time.monotonic() + RELOAD_SEC
+        self.reloads += 1
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                now = int(time.time())
+                if time.monotonic() >= self._next_reload or now >= self._loaded_until:
+                    await self._reload(now)
+                await self._fire_due(now)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("expiry tick failed")
+                # start over from the index, but don't spin on a persistent error
+                self._next_reload = 0.0
+                await asyncio.sleep(5)
+                continue
+
+            sleep = max(0.0, self._next_reload - time.monotonic())
+            if self._heap:
+                sleep = min(sleep, max(0, self._heap[0][0] - time.time()))
+            sleep = min(sleep, max(0, self._loaded_until - time.time()))
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(0.05, sleep))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _fire_due(self, now: int) -> None:
+        expire: List[int] = []
+        remind: List[Tuple[int, int]] = []
+        while self._heap and self._heap[0][0] <= now:
+            fire_at, kind, user_id, until = heapq.heappop(self._heap)
+            if kind == KIND_EXPIRE:
+                self._lag_max = max(self._lag_max, now - fire_at)
+                expire.append(user_id)
+            elif until > now:
+                remind.append((user_id, until))
+
+        for i in range(0, len(expire), BATCH):
+            async with transaction(self.db):
+                done = await subs_repo.downgrade_expired(self.db, expire[i : i + BATCH], now=now, commit=False)
+            self.downgraded += len(done)
+            if done:
+                log.info("premium expired for %d users", len(done))
+
+        for i in range(0, len(remind), BATCH):
+            await self._remind(remind[i : i + BATCH])
+
+    async def _remind(self, batch: List[Tuple[int, int]]) -> None:
+        until_by_user = dict(batch)
+        async with transaction(self.db):
+            due = await subs_repo.mark_reminded(self.db, batch, commit=False)
+            for user_id in due:
+                date = datetime.fromtimestamp(until_by_user[user_id], tz=ZoneInfo(self.timezone)).strftime("%d.%m.%Y %H:%M")
+                await outbox.enqueue(
+                    self.db,
+                    user_id,
+                    texts.RENEWAL_REMINDER.format(date=date),
+                    kind=outbox.KIND_RENEWAL_REMINDER,
+                    commit=False,
+                )
+        self.reminded += len(due)
+        if due and self.sender is not None:
+            self.sender.notify()
+
+    def stats(self) -> dict:
+        return {
+            "scheduled": len(self._heap),
+            "next_at": self._heap[0][0] if self._heap else 0,
+            "loaded_until": self._loaded_until,
+            "reloads": self.reloads,
+            "downgraded": self.downgraded,
+            "reminded": self.reminded,
+            "fire_lag_max_sec": self._lag_max,
+        }
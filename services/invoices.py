@@ -3,10 +3,12 @@ from __future__ import annotations
 import json
 import time
 from dataclasses import dataclass
-from typing import Any, Optional
+from typing import Any, List, Optional, Sequence, Tuple
 
 import aiosqlite
 
+from services.metrics import db_timed
+
 
 @dataclass
 class InvoiceRow:
@@ -21,8 +23,40 @@ class InvoiceRow:
     paid_at: int
     rewarded: int
     raw_json: dict[str, Any]
+    expires_at: int = 0
+
+
+@dataclass
+class StatusChange:
+    invoice_id: int
+    status: str
+    paid_at: int = 0
+    raw: dict[str, Any] | None = None
 
 
+def _row_to_invoice(r: aiosqlite.Row) -> InvoiceRow:
+    try:
+        raw = json.loads(r["raw_json"] or "{}")
+    except Exception:
+        raw = {}
+    keys = r.keys()
+    return InvoiceRow(
+        invoice_id=r["invoice_id"],
+        user_id=r["user_id"],
+        months=r["months"],
+        amount=float(r["amount"]),
+        asset=r["asset"],
+        status=r["status"],
+        pay_url=r["pay_url"],
+        created_at=r["created_at"],
+        paid_at=r["paid_at"],
+        rewarded=int(r["rewarded"]) if "rewarded" in keys else 0,
+        raw_json=raw,
+        expires_at=int(r["expires_at"]) if "expires_at" in keys else 0,
+    )
+
+
+@db_timed
 async def insert(
     db: aiosqlite.Connection,
     *,
@@ -34,13 +68,15 @@ async def insert(
     status: str,
     pay_url: str | None,
     raw: dict[str, Any],
+    expires_in: int = 0,
 ) -> None:
+    now = int(time.time())
     # rewarded column may not exist during early migrations; keep resilient
     try:
         await db.execute(
             """
-            INSERT OR REPLACE INTO invoices(invoice_id, user_id, months, amount, asset, status, pay_url, created_at, paid_at, rewarded, raw_json)
-            VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, 0, ?)
+            INSERT OR REPLACE INTO invoices(invoice_id, user_id, months, amount, asset, status, pay_url, created_at, paid_at, rewarded, raw_json, expires_at)
+            VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, 0, ?, ?)
             """,
             (
                 invoice_id,
@@ -50,9 +86,10 @@ async def insert(
                 asset,
                 status,
                 pay_url,
-                int(time.time()),
+                now,
                 0,
                 json.dumps(raw, ensure_ascii=False),
+                now + expires_in if expires_in > 0 else 0,
             ),
         )
     except aiosqlite.OperationalError:
@@ -69,7 +106,7 @@ async def insert(
                 asset,
                 status,
                 pay_url,
-                int(time.time()),
+                now,
                 0,
                 json.dumps(raw, ensure_ascii=False),
             ),
@@ -77,85 +114,118 @@ async def insert(
     await db.commit()
 
 
-async def update_status(
-    db: aiosqlite.Connection,
-    invoice_id: int,
-    status: str,
-    *,
-    paid_at: int = 0,
-    raw: dict[str, Any] | None = None,
-) -> None:
-    raw_str = json.dumps(raw, ensure_ascii=False) if raw is not None else None
-    if raw_str is None:
-        await db.execute("UPDATE invoices SET status=?, paid_at=? WHERE invoice_id=?", (status, paid_at, invoice_id))
-    else:
-        await db.execute(
-            "UPDATE invoices SET status=?, paid_at=?, raw_json=? WHERE invoice_id=?",
-            (status, paid_at, raw_str, invoice_id),
-        )
-    await db.commit()
-
-
-async def mark_rewarded(db: aiosqlite.Connection, invoice_id: int) -> None:
+@db_timed
+async def mark_rewarded(db: aiosqlite.Connection, invoice_id: int, *, commit: bool = True) -> None:
     try:
         await db.execute("UPDATE invoices SET rewarded=1 WHERE invoice_id=?", (invoice_id,))
-        await db.commit()
+        if commit:
+            await db.commit()
     except aiosqlite.OperationalError:
         return
 
 
-async def get_pending(db: aiosqlite.Connection, limit: int = 50) -> list[InvoiceRow]:
+@db_timed
+async def get_by_id(db: aiosqlite.Connection, invoice_id: int) -> Optional[InvoiceRow]:
+    async with db.execute("SELECT * FROM invoices WHERE invoice_id=?", (invoice_id,)) as cur:
+        r = await cur.fetchone()
+    return _row_to_invoice(r) if r else None
+
+
+@db_timed
+async def find_reusable(
+    db: aiosqlite.Connection,
+    *,
+    user_id: int,
+    months: int,
+    amount: float,
+    asset: str,
+    valid_after: int,
+) -> Optional[InvoiceRow]:
+    """The user's active invoice for this plan and price that is still valid at
+    `valid_after`, latest-expiring first (partial index idx_invoices_user_pending)."""
+    async with db.execute(
+        """
+        SELECT * FROM invoices
+        WHERE status='active' AND user_id=? AND months=? AND amount=? AND asset=? AND expires_at > ?
+        ORDER BY expires_at DESC
+        LIMIT 1
+        """,
+        (user_id, months, amount, asset, valid_after),
+    ) as cur:
+        r = await cur.fetchone()
+    return _row_to_invoice(r) if r else None
+
+
+@db_timed
+async def active_page(
+    db: aiosqlite.Connection,
+    after: Tuple[int, int] | None,
+    limit: int,
+) -> list[InvoiceRow]:
+    """Active invoices in (created_at, invoice_id) order after the `after` key:
+    an index range scan on (status, created_at), no OFFSET."""
+    if after is None:
+        after = (-1, -1)
     async with db.execute(
-        "SELECT * FROM invoices WHERE status IN ('active') ORDER BY created_at DESC LIMIT ?",
-        (limit,),
+        """
+        SELECT * FROM invoices
+        WHERE status='active' AND (created_at > ? OR (created_at = ? AND invoice_id > ?))
+        ORDER BY created_at, invoice_id
+        LIMIT ?
+        """,
+        (after[0], after[0], after[1], limit),
     ) as cur:
         rows = await cur.fetchall()
-
-    out: list[InvoiceRow] = []
-    for r in rows:
-        try:
-            raw = json.loads(r["raw_json"] or "{}")
-        except Exception:
-            raw = {}
-        rewarded = int(r["rewarded"]) if "rewarded" in r.keys() else 0
-        out.append(
-            InvoiceRow(
-                invoice_id=r["invoice_id"],
-                user_id=r["user_id"],
-                months=r["months"],
-                amount=float(r["amount"]),
-                asset=r["asset"],
-                status=r["status"],
-                pay_url=r["pay_url"],
-                created_at=r["created_at"],
-                paid_at=r["paid_at"],
-                rewarded=rewarded,
-                raw_json=raw,
-            )
-        )
-    return out
+    return [_row_to_invoice(r) for r in rows]
 
 
-async def get_by_id(db: aiosqlite.Connection, invoice_id: int) -> Optional[InvoiceRow]:
-    async with db.execute("SELECT * FROM invoices WHERE invoice_id=?", (invoice_id,)) as cur:
+@db_timed
+async def oldest_active_created_at(db: aiosqlite.Connection) -> int:
+    async with db.execute("SELECT MIN(created_at) AS m FROM invoices WHERE status='active'") as cur:
         r = await cur.fetchone()
-    if not r:
-        return None
-    try:
-        raw = json.loads(r["raw_json"] or "{}")
-    except Exception:
-        raw = {}
-    rewarded = int(r["rewarded"]) if "rewarded" in r.keys() else 0
-    return InvoiceRow(
-        invoice_id=r["invoice_id"],
-        user_id=r["user_id"],
-        months=r["months"],
-        amount=float(r["amount"]),
-        asset=r["asset"],
-        status=r["status"],
-        pay_url=r["pay_url"],
-        created_at=r["created_at"],
-        paid_at=r["paid_at"],
-        rewarded=rewarded,
-        raw_json=raw,
-    )
+    return int(r["m"] or 0) if r else 0
+
+
+@db_timed
+async def overdue(db: aiosqlite.Connection, before: int, limit: int) -> list[InvoiceRow]:
+    """Active invoices whose expires_at passed before `before`."""
+    async with db.execute(
+        """
+        SELECT * FROM invoices
+        WHERE status='active' AND expires_at > 0 AND expires_at <= ?
+        ORDER BY created_at, invoice_id
+        LIMIT ?
+        """,
+        (before, limit),
+    ) as cur:
+        rows = await cur.fetchall()
+    return [_row_to_invoice(r) for r in rows]
+
+
+@db_timed
+async def apply_status_changes(
+    db: aiosqlite.Connection,
+    changes: Sequence[StatusChange],
+    *,
+    commit: bool = True,
+) -> List[int]:
+    """Apply status changes in one transaction; returns the ids that actually changed.
+
+    'paid' is final and a change to the current status is a no-op, so the
+    webhook and the reconciler racing on one invoice apply it once.
+    """
+    changed: List[int] = []
+    for c in changes:
+        raw_str = json.dumps(c.raw, ensure_ascii=False) if c.raw is not None else None
+        cur = await db.execute(
+            """
+            UPDATE invoices SET status=?, paid_at=?, raw_json=COALESCE(?, raw_json)
+            WHERE invoice_id=? AND status NOT IN (?, 'paid')
+            """,
+            (c.status, c.paid_at, raw_str, c.invoice_id, c.status),
+        )
+        if cur.rowcount:
+            changed.append(c.invoice_id)
+    if commit:
+        await db.commit()
+    return changed
@@ -5,77 +5,129 @@ from datetime import datetime
 from zoneinfo import ZoneInfo
 
 import aiosqlite
-from aiogram import Bot
 
-from services.crypto_pay import CryptoPayClient
+from services import checkins as checkins_repo
+from services.db import transaction
+from services import outbox
+from services.broadcast import OUTCOME_BLOCKED, OUTCOME_SENT, BroadcastEngine
 from services import invoices as invoices_repo
 from services import subscriptions as subs_repo
 from services import users as users_repo
+from services.metrics import INVOICE_STATUS, JOB_RUN, timed
+from services.outbox import NotificationSender
 from bot import texts
 
 
 REF_REWARD_DAYS = 7  # бонус за оплатившего реферала
 
 
-async def _notify(bot: Bot, user_id: int, text: str) -> None:
-    try:
-        await bot.send_message(user_id, text)
-    except Exception:
+async def settle_paid_invoice(db: aiosqlite.Connection, row: invoices_repo.InvoiceRow) -> None:
+    """Side effects of an invoice that has just turned 'paid' (exactly once per invoice).
+
+    Writes premium, the referral reward and the notifications without
+    committing: the caller's transaction() commits them together with the
+    status change.
+    """
+    new_until = await subs_repo.activate_premium(db, row.user_id, row.months, commit=False)
+    dt = datetime.fromtimestamp(new_until, tz=ZoneInfo("UTC")).strftime("%Y-%m-%d")
+    await outbox.enqueue(
+        db,
+        row.user_id,
+        texts.PAYMENT_SUCCESS + f"\n\n📅 До: <b>{dt}</b>",
+        kind=outbox.KIND_PAYMENT_SUCCESS,
+        commit=False,
+    )
+
+    # referral reward (one-time per invoice)
+    if row.rewarded == 0:
+        payer = await users_repo.get_user(db, row.user_id)
+        if payer and payer.referrer_id:
+            reward_seconds = REF_REWARD_DAYS * 24 * 3600
+            ref_until = await users_repo.add_premium(db, payer.referrer_id, reward_seconds, commit=False)
+            ref_dt = datetime.fromtimestamp(ref_until, tz=ZoneInfo("UTC")).strftime("%Y-%m-%d")
+            await invoices_repo.mark_rewarded(db, row.invoice_id, commit=False)
+            await outbox.enqueue(
+                db,
+                payer.referrer_id,
+                f"🎁 <b>Бонус за реферала</b>\n\nТвой друг оплатил Premium — тебе начислено <b>+{REF_REWARD_DAYS} дней</b>.\n📅 Теперь до: <b>{ref_dt}</b>",
+                kind=outbox.KIND_REFERRAL_BONUS,
+                commit=False,
+            )
+
+
+@timed(JOB_RUN, "handle_invoice_status")
+async def handle_invoice_status(
+    db: aiosqlite.Connection,
+    invoice_id: int,
+    status: str,
+    raw: dict,
+    *,
+    sender: NotificationSender | None = None,
+) -> None:
+    if status not in ("paid", "expired"):
         return
-
-
-async def handle_invoice_status(bot: Bot, db: aiosqlite.Connection, invoice_id: int, status: str, raw: dict) -> None:
     row = await invoices_repo.get_by_id(db, invoice_id)
     if not row:
         return
 
-    if status == "paid" and row.status != "paid":
-        paid_at = int(time.time())
-        await invoices_repo.update_status(db, invoice_id, "paid", paid_at=paid_at, raw=raw)
-
-        new_until = await subs_repo.activate_premium(db, row.user_id, row.months)
-        dt = datetime.fromtimestamp(new_until, tz=ZoneInfo("UTC")).strftime("%Y-%m-%d")
-        await _notify(bot, row.user_id, texts.PAYMENT_SUCCESS + f"\n\n📅 До: <b>{dt}</b>")
-
-        # referral reward (one-time per invoice)
-        if row.rewarded == 0:
-            payer = await users_repo.get_user(db, row.user_id)
-            if payer and payer.referrer_id:
-                reward_seconds = REF_REWARD_DAYS * 24 * 3600
-                ref_until = await users_repo.add_premium(db, payer.referrer_id, reward_seconds)
-                ref_dt = datetime.fromtimestamp(ref_until, tz=ZoneInfo("UTC")).strftime("%Y-%m-%d")
-                await invoices_repo.mark_rewarded(db, invoice_id)
-                await _notify(
-                    bot,
-                    payer.referrer_id,
-                    f"🎁 <b>Бонус за реферала</b>\n\nТвой друг оплатил Premium — тебе начислено <b>+{REF_REWARD_DAYS} дней</b>.\n📅 Теперь до: <b>{ref_dt}</b>",
-                )
-
-    elif status == "expired" and row.status != "expired":
-        await invoices_repo.update_status(db, invoice_id, "expired", raw=raw)
-        await _notify(bot, row.user_id, texts.PAYMENT_EXPIRED)
-
-
-async def sync_active_invoices(bot: Bot, db: aiosqlite.Connection, cryptopay: CryptoPayClient) -> None:
-    pending = await invoices_repo.get_pending(db, limit=50)
-    if not pending:
-        return
-    ids = [p.invoice_id for p in pending]
-    try:
-        items = await cryptopay.get_invoices(invoice_ids=ids)
-    except Exception:
-        return
-
-    for inv in items:
-        await handle_invoice_status(bot, db, inv.invoice_id, inv.status, inv.raw)
-
-
-async def downgrade_expired_subscriptions(db: aiosqlite.Connection) -> int:
-    return await subs_repo.downgrade_expired(db)
-
-
-async def send_daily_checkins(bot: Bot, db: aiosqlite.Connection) -> None:
-    async with db.execute("SELECT user_id FROM users WHERE checkin_enabled = 1") as cur:
-        rows = await cur.fetchall()
-    for r in rows:
-        await _notify(bot, int(r["user_id"]), texts.CHECKIN_PROMPT)
+    change = invoices_repo.StatusChange(
+        invoice_id,
+        status,
+        paid_at=int(time.time()) if status == "paid" else row.paid_at,
+        raw=raw,
+    )
+    async with transaction(db):
+        # conditional update: a retried webhook or the reconciler got there first -> nothing to do
+        if not await invoices_repo.apply_status_changes(db, [change], commit=False):
+            return
+        if status == "paid":
+            await settle_paid_invoice(db, row)
+        else:
+            await outbox.enqueue(db, row.user_id, texts.PAYMENT_EXPIRED, kind=outbox.KIND_PAYMENT_EXPIRED, commit=False)
+    INVOICE_STATUS.labels(status).inc()
+    if sender is not None:
+        sender.notify()
+
+
+CHECKIN_BATCH = 500
+
+
+@timed(JOB_RUN, "send_due_checkins")
+async def send_due_checkins(engine: BroadcastEngine, settings) -> int:
+    """Every minute: send check-ins whose per-user slot has come, book the next one."""
+    db = engine.db
+    now = int(time.time())
+
+    def slot(user_id: int, tz: str, after: int) -> int:
+        return checkins_repo.next_checkin_at(
+            user_id,
+            tz or settings.timezone,
+            hour=settings.checkin_hour,
+            minute=settings.checkin_minute,
+            window_sec=settings.checkin_window_min * 60,
+            after=after,
+        )
+
+    # just enabled, changed timezone or predates the schedule: book without sending
+    while True:
+        rows = await checkins_repo.unscheduled(db, CHECKIN_BATCH)
+        if not rows:
+            break
+        await checkins_repo.reschedule(db, [(u, slot(u, tz, now)) for u, tz in rows])
+
+    sent = 0
+    while True:
+        rows = await checkins_repo.due(db, now, CHECKIN_BATCH)
+        if not rows:
+            break
+        # blocked users are only moved to their next slot, so they don't stay "due"
+        targets = [u for u, _, blocked in rows if not blocked]
+        outcomes = await engine.deliver_many(targets, texts.CHECKIN_PROMPT)
+        blocked_ids = [u for u, o in zip(targets, outcomes) if o == OUTCOME_BLOCKED]
+        sent += outcomes.count(OUTCOME_SENT)
+        await checkins_repo.reschedule(
+            db,
+            [(u, slot(u, tz, now)) for u, tz, _ in rows],
+            blocked_ids=blocked_ids,
+        )
+    return sent
@@ -7,6 +7,7 @@ from zoneinfo import ZoneInfo
 
 import aiosqlite
 
+from services import tracing
 from services import users as users_repo
 
 
@@ -20,7 +21,13 @@ def today_str(tz: str) -> str:
     return datetime.now(ZoneInfo(tz)).strftime("%Y-%m-%d")
 
 
+@tracing.traced("limits.ensure_plan_fresh")
 async def ensure_plan_fresh(db: aiosqlite.Connection, user_id: int) -> users_repo.User:
+    """The user row, created if missing.
+
+    Expired premium is downgraded by the expiry scheduler; until it gets
+    there, every check here compares premium_until with the clock anyway.
+    """
     u = await users_repo.get_user(db, user_id)
     if not u:
         # Defensive: some entry-points may call limits before user creation.
@@ -29,16 +36,10 @@ async def ensure_plan_fresh(db: aiosqlite.Connection, user_id: int) -> users_rep
         u = await users_repo.get_user(db, user_id)
         if not u:
             raise RuntimeError("User not found")
-
-    now = int(time.time())
-    if u.plan == "premium" and u.premium_until <= now:
-        # auto-downgrade
-        await users_repo.set_plan(db, user_id, "basic", 0)
-        u = await users_repo.get_user(db, user_id)
-        assert u is not None
     return u
 
 
+@tracing.traced("limits.peek")
 async def peek(
     db: aiosqlite.Connection,
     user_id: int,
@@ -69,6 +70,7 @@ async def peek(
     return LimitResult(ok=True, reason=None)
 
 
+@tracing.traced("limits.consume")
 async def consume(
     db: aiosqlite.Connection,
     user_id: int,
@@ -103,3 +105,29 @@ async def consume(
 
     await users_repo.bump_trial_used(db, user_id, 1)
     return LimitResult(ok=True, reason=None)
+
+
+@tracing.traced("limits.refund")
+async def refund(
+    db: aiosqlite.Connection,
+    user_id: int,
+    *,
+    timezone: str,
+    is_admin: bool = False,
+) -> None:
+    """Give back one request taken by `consume` (e.g. the answer was cancelled)."""
+    if is_admin:
+        return
+
+    u = await users_repo.get_user(db, user_id)
+    if not u:
+        return
+
+    if u.plan == "premium" and u.premium_until > int(time.time()):
+        t = today_str(timezone)
+        if u.daily_date == t and u.daily_used > 0:
+            await users_repo.set_daily_usage(db, user_id, daily_used=u.daily_used - 1, daily_date=t)
+        return
+
+    if u.trial_used > 0:
+        await users_repo.bump_trial_used(db, user_id, -1)
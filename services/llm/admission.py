@@ -0,0 +1,216 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, Optional
+
+from services import tracing
+
+
+PRIORITY_ADMIN = 0
+PRIORITY_PREMIUM = 1
+PRIORITY_BASIC = 2
+PRIORITY_BACKGROUND = 3  # summaries and other work nobody is waiting on
+
+QUEUE_REPORT_INTERVAL = 2.0
+
+# on_wait(position, eta_seconds) — position is 1-based
+OnWait = Callable[[int, float], Awaitable[None]]
+
+
+def _percentile(sorted_vals: list[float], q: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    idx = min(len(sorted_vals) - 1, int(q * len(sorted_vals)))
+    return sorted_vals[idx]
+
+
+def priority_for(*, is_admin: bool, is_premium: bool) -> int:
+    if is_admin:
+        return PRIORITY_ADMIN
+    if is_premium:
+        return PRIORITY_PREMIUM
+    return PRIORITY_BASIC
+
+
+@dataclass(eq=False)
+class _Waiter:
+    user_id: int
+    priority: int
+    fut: asyncio.Future
+    enqueued_at: float
+
+
+@dataclass
+class _ProviderGate:
+    limit: int
+    active: int = 0
+    # priority -> user_id -> waiters (round-robin over users inside a class)
+    classes: Dict[int, "OrderedDict[int, Deque[_Waiter]]"] = field(default_factory=dict)
+    avg_hold: float = 5.0
+    waits: Deque[float] = field(default_factory=lambda: deque(maxlen=1000))
+    admitted: int = 0
+    queued_total: int = 0
+
+    def queued(self) -> int:
+        return sum(len(q) for users in self.classes.values() for q in users.values())
+
+    def push(self, w: _Waiter) -> None:
+        users = self.classes.setdefault(w.priority, OrderedDict())
+        users.setdefault(w.user_id, deque()).append(w)
+        self.queued_total += 1
+
+    def pop_next(self) -> Optional[_Waiter]:
+        for prio in sorted(self.classes):
+            users = self.classes[prio]
+            while users:
+                user_id, q = next(iter(users.items()))
+                w = q.popleft()
+                if q:
+                    users.move_to_end(user_id)
+                else:
+                    del users[user_id]
+                if not w.fut.done():
+                    return w
+            del self.classes[prio]
+        return None
+
+    def remove(self, w: _Waiter) -> None:
+        users = self.classes.get(w.priority)
+        if not users:
+            return
+        q = users.get(w.user_id)
+        if not q:
+            return
+        try:
+            q.remove(w)
+        except ValueError:
+            return
+        if not q:
+            del users[w.user_id]
+        if not users:
+            del self.classes[w.priority]
+
+    def position(self, w: _Waiter) -> int:
+        ahead = 0
+        for prio, users in self.classes.items():
+            if prio < w.priority:
+                ahead += sum(len(q) for q in users.values())
+        users = self.classes.get(w.priority) or OrderedDict()
+        own = users.get(w.user_id)
+        if own is None or w not in own:
+            return ahead + 1
+        my_round = own.index(w)
+        order = list(users.keys())
+        my_turn = order.index(w.user_id)
+        for turn, (uid, q) in enumerate(users.items()):
+            # a user's k-th waiter is served in round k; within a round users go in order
+            rounds_before = min(len(q), my_round + (1 if turn < my_turn else 0))
+            if uid != w.user_id:
+                ahead += rounds_before
+        return ahead + my_round + 1
+
+    def eta(self, position: int) -> float:
+        waves = (position - 1) // max(1, self.limit) + 1
+        return waves * self.avg_hold
+
+
+class AdmissionController:
+    """Per-provider concurrency limit with priority classes.
+
+    Admins go first, then premium, then basic. Inside a class users are served
+    round-robin, so one chatty user can't starve the others.
+    """
+
+    def __init__(self, limits: dict[str, int]):
+        self._gates: dict[str, _ProviderGate] = {name: _ProviderGate(limit=max(1, int(n))) for name, n in limits.items()}
+
+    def _gate(self, provider: str) -> _ProviderGate:
+        gate = self._gates.get(provider)
+        if gate is None:
+            gate = _ProviderGate(limit=8)
+            self._gates[provider] = gate
+        return gate
+
+    def _wake(self, gate: _ProviderGate) -> None:
+        while gate.active < gate.limit:
+            w = gate.pop_next()
+            if w is None:
+                return
+            gate.active += 1
+            w.fut.set_result(None)
+
+    async def _acquire(self, gate: _ProviderGate, user_id: int, priority: int, on_wait: OnWait | None) -> None:
+        if gate.active < gate.limit and not gate.classes:
+            gate.active += 1
+            gate.waits.append(0.0)
+            return
+
+        loop = asyncio.get_running_loop()
+        w = _Waiter(user_id=user_id, priority=priority, fut=loop.create_future(), enqueued_at=time.monotonic())
+        gate.push(w)
+        last_pos = 0
+        try:
+            while not w.fut.done():
+                pos = gate.position(w)
+                if on_wait and pos != last_pos:
+                    last_pos = pos
+                    try:
+                        await on_wait(pos, gate.eta(pos))
+                    except Exception:
+                        pass
+                await asyncio.wait({w.fut}, timeout=QUEUE_REPORT_INTERVAL)
+        except BaseException:
+            if w.fut.done() and not w.fut.cancelled():
+                # slot was granted right as we were cancelled — hand it on
+                gate.active -= 1
+                self._wake(gate)
+            else:
+                w.fut.cancel()
+                gate.remove(w)
+            raise
+        gate.waits.append(time.monotonic() - w.enqueued_at)
+
+    def _release(self, gate: _ProviderGate, held: float) -> None:
+        gate.active -= 1
+        gate.admitted += 1
+        gate.avg_hold += (held - gate.avg_hold) * 0.1
+        self._wake(gate)
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        provider: str,
+        *,
+        user_id: int,
+        priority: int = PRIORITY_BASIC,
+        on_wait: OnWait | None = None,
+    ) -> AsyncIterator[None]:
+        gate = self._gate(provider)
+        with tracing.span("admission.wait", provider=provider):
+            await self._acquire(gate, user_id, priority, on_wait)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(gate, time.monotonic() - started)
+
+    def stats(self) -> dict:
+        out: dict = {}
+        for name, gate in self._gates.items():
+            waits = sorted(gate.waits)
+            out[name] = {
+                "limit": gate.limit,
+                "active": gate.active,
+                "queued": gate.queued(),
+                "queued_total": gate.queued_total,
+                "admitted": gate.admitted,
+                "avg_hold_sec": round(gate.avg_hold, 3),
+                "wait_p50_sec": round(_percentile(waits, 0.50), 3),
+                "wait_p95_sec": round(_percentile(waits, 0.95), 3),
+                "wait_max_sec": round(waits[-1], 3) if waits else 0.0,
+            }
+        return out
@@ -0,0 +1,71 @@
+from __future__ import annotations
+
+import re
+from collections import Counter
+from dataclasses import dataclass
+
+
+# Every keyword pattern used for routing/style is a whole word (\b...\b), so
+# one tokenizing pass plus set lookups replaces the separate regex scans.
+_WORD_RE = re.compile(r"\w+")
+_EMOJI_RE = re.compile(r"[\U0001F300-\U0001FAFF\u2600-\u27BF]")
+# multi-word forms, only searched when their parts are present
+_DOSE_RE = re.compile(r"\b\d+\s?(?:мг|mg|мл|ml|таб|капс)\b")
+_CHECKIN_RE = re.compile(r"\bчек\s?-?ин\b")
+
+_MEDICAL_WORDS = frozenset((
+    "болит", "боль", "температур", "кашел", "насморк", "давлен", "пульс", "тошнит", "рвот", "понос",
+    "диаре", "сыпь", "аллерг", "анализ", "симптом", "врач", "лекарств", "таблет", "антибиот", "дозировк",
+    "мг", "ml", "мл",
+))
+_DISCIPLINE_WORDS = frozenset((
+    "дисциплин", "режим", "привычк", "цели", "план", "мотивац", "продуктив", "сон", "тренировк",
+    "чекин", "отчет", "отчёт",
+))
+_WEB_WORDS = frozenset((
+    "сегодня", "сейчас", "последн", "новост", "актуал", "цена", "стоимост", "курс", "ставк", "расписан",
+    "закон", "регламент", "обновлен", "2024", "2025", "2026", "2027", "2028", "2029", "президент", "ceo",
+))
+_PROFANITY_WORDS = frozenset(("бля", "сука", "нах", "хуй", "пизд", "ёб", "еба", "заеб", "пох", "мудак"))
+_DOSE_UNITS = ("мг", "mg", "мл", "ml", "таб", "капс")
+
+
+@dataclass(frozen=True)
+class TextFeatures:
+    medical: bool = False
+    dosage: bool = False  # asks about doses ("доз…" or "500 мг")
+    discipline: bool = False
+    needs_web: bool = False
+    emoji: int = 0
+    profanity: int = 0
+    length: int = 0
+
+
+def analyze(text: str) -> TextFeatures:
+    """Scan the text once and collect every flag/counter the pipeline needs."""
+    text = text or ""
+    low = text.lower()
+    counts = Counter(_WORD_RE.findall(low))
+    words = counts.keys()
+
+    profanity = 0
+    if not words.isdisjoint(_PROFANITY_WORDS):
+        profanity = sum(counts[w] for w in _PROFANITY_WORDS if w in counts)
+
+    discipline = not words.isdisjoint(_DISCIPLINE_WORDS)
+    if not discipline and "чек" in low and "ин" in low:
+        discipline = bool(_CHECKIN_RE.search(low))
+
+    dosage = "доз" in low
+    if not dosage and any(u in low for u in _DOSE_UNITS):
+        dosage = bool(_DOSE_RE.search(low))
+
+    return TextFeatures(
+        medical=not words.isdisjoint(_MEDICAL_WORDS),
+        dosage=dosage,
+        discipline=discipline,
+        needs_web=not words.isdisjoint(_WEB_WORDS),
+        emoji=len(_EMOJI_RE.findall(text)),
+        profanity=profanity,
+        length=len(text.strip()),
+    )
@@ -1,12 +1,19 @@
 from __future__ import annotations
 
 import json
+import time
 from dataclasses import dataclass
 from typing import Any, AsyncIterator, Dict, List, Optional
 
 import httpx
 
+from services.llm.pacing import ProviderPacer, estimate_tokens
 from services.llm.streaming import sse_content
+from services import tracing
+from services.metrics import LLM_REQUEST
+
+# how many times a 429 is retried locally (only when a pacer is attached)
+MAX_THROTTLE_RETRIES = 3
 
 
 class LLMError(RuntimeError):
@@ -20,10 +27,22 @@ class LLMResponse:
 
 
 class OpenAICompatClient:
-    def __init__(self, *, api_key: str, base_url: str, default_model: str, extra_headers: dict[str, str] | None = None):
+    def __init__(
+        self,
+        *,
+        api_key: str,
+        base_url: str,
+        default_model: str,
+        extra_headers: dict[str, str] | None = None,
+        pacer: ProviderPacer | None = None,
+        transport: httpx.AsyncBaseTransport | None = None,
+        name: str = "",
+    ):
+        self.name = name or (pacer.name if pacer is not None else "llm")
         self.api_key = api_key
         self.base_url = base_url.rstrip("/")
         self.default_model = default_model
+        self.pacer = pacer
         self._client = httpx.AsyncClient(
             base_url=self.base_url,
             headers={
@@ -32,8 +51,17 @@ class OpenAICompatClient:
                 **(extra_headers or {}),
             },
             timeout=60.0,
+            transport=transport,
         )
 
+    def _should_retry(self, resp: httpx.Response, attempt: int) -> bool:
+        if self.pacer is not None:
+            self.pacer.observe(resp.headers, resp.status_code)
+        return resp.status_code == 429 and self.pacer is not None and attempt < MAX_THROTTLE_RETRIES
+
+    def _observe(self, kind: str, status: str, started: float) -> None:
+        LLM_REQUEST.labels(self.name, kind, status).observe(time.perf_counter() - started)
+
     async def aclose(self) -> None:
         await self._client.aclose()
 
@@ -48,7 +76,24 @@ class OpenAICompatClient:
         if extra:
             payload.update(extra)
 
-        resp = await self._client.post("/chat/completions", json=payload)
+        est = estimate_tokens(messages, max_tokens)
+        attempt = 0
+        while True:
+            if self.pacer is not None:
+                await self.pacer.acquire(est)
+            started = time.perf_counter()
+            with tracing.span("llm.chat", provider=self.name, model=payload["model"]) as sp:
+                try:
+                    resp = await self._client.post("/chat/completions", json=payload)
+                except Exception:
+                    self._observe("chat", "error", started)
+                    raise
+                self._observe("chat", str(resp.status_code), started)
+                sp.set(status=resp.status_code)
+            if not self._should_retry(resp, attempt):
+                break
+            attempt += 1
+
         if resp.status_code >= 400:
             raise LLMError(f"HTTP {resp.status_code}: {resp.text[:500]}")
         data = resp.json()
@@ -56,6 +101,10 @@ class OpenAICompatClient:
             content = data["choices"][0]["message"]["content"] or ""
         except Exception:
             raise LLMError(f"Bad response: {json.dumps(data)[:500]}")
+        if self.pacer is not None:
+            used = (data.get("usage") or {}).get("total_tokens")
+            if isinstance(used, int):
+                self.pacer.record_usage(est, used)
         return LLMResponse(content=content, raw=data)
 
     async def chat_stream(self, *, messages: list[dict[str, str]], model: str | None = None, temperature: float = 0.2, max_tokens: int = 1200, extra: dict[str, Any] | None = None) -> AsyncIterator[str]:
@@ -69,9 +118,27 @@ class OpenAICompatClient:
         if extra:
             payload.update(extra)
 
-        async with self._client.stream("POST", "/chat/completions", json=payload) as resp:
-            if resp.status_code >= 400:
-                txt = await resp.aread()
-                raise LLMError(f"HTTP {resp.status_code}: {txt[:500]}")
-            async for chunk in sse_content(resp):
-                yield chunk
+        est = estimate_tokens(messages, max_tokens)
+        attempt = 0
+        while True:
+            if self.pacer is not None:
+                await self.pacer.acquire(est)
+            started = time.perf_counter()
+            status = "error"
+            # not bound: the consumer's work between chunks is not part of this request
+            try:
+                with tracing.span("llm.stream", bind=False, provider=self.name, model=payload["model"]) as s:
+                    async with self._client.stream("POST", "/chat/completions", json=payload) as resp:
+                        status = str(resp.status_code)
+                        s.set(status=resp.status_code)
+                        if self._should_retry(resp, attempt):
+                            attempt += 1
+                            continue
+                        if resp.status_code >= 400:
+                            txt = await resp.aread()
+                            raise LLMError(f"HTTP {resp.status_code}: {txt[:500]}")
+                        async for chunk in sse_content(resp):
+                            yield chunk
+                        return
+            finally:
+                self._observe("stream", status, started)
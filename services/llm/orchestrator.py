@@ -1,50 +1,27 @@
 from __future__ import annotations
 
 import re
+import time
+from contextlib import aclosing, nullcontext
 from dataclasses import dataclass
-from typing import Any, Awaitable, Callable
+from typing import Any, AsyncContextManager, Awaitable, Callable
 
 import aiosqlite
 
+from services.llm.admission import PRIORITY_BASIC, AdmissionController, OnWait
+from services.llm.features import TextFeatures, analyze
 from services.llm.openai_compat import OpenAICompatClient
 from services.llm import prompts
 from services.llm.postprocess import clean_text, escape_html, split_parts
 from services.llm.style import style_prompt
+from services.llm.summarizer import ConversationSummarizer
+from services.llm.supervisor import GenerationProgress
 from services import memory as memory_repo
+from services import tracing
+from services.metrics import ANSWER_FIRST_TOKEN, ANSWER_TOTAL, FORMATTER_PASS
 
 
-_MEDICAL_RE = re.compile(
-    r"\b(болит|боль|температур|кашел|насморк|давлен|пульс|тошнит|рвот|понос|диаре|сыпь|аллерг|анализ|симптом|врач|лекарств|таблет|антибиот|дозировк|мг|ml|мл)\b",
-    re.IGNORECASE,
-)
-
-_DOSAGE_RE = re.compile(r"\b(\d+\s?(мг|mg|мл|ml|таб|капс))\b", re.IGNORECASE)
-
-_DISCIPLINE_RE = re.compile(
-    r"\b(дисциплин|режим|привычк|цели|план|мотивац|продуктив|сон|тренировк|чек\s?-?ин|отч[её]т)\b",
-    re.IGNORECASE,
-)
-
-_NEEDS_WEB_RE = re.compile(
-    r"\b(сегодня|сейчас|последн|новост|актуал|цена|стоимост|курс|ставк|расписан|закон|регламент|обновлен|202[4-9]|президент|ceo)\b",
-    re.IGNORECASE,
-)
-
-
-def _is_medical(text: str) -> bool:
-    return bool(_MEDICAL_RE.search(text))
-
-
-def _wants_dosage(text: str) -> bool:
-    return "доз" in text.lower() or bool(_DOSAGE_RE.search(text))
-
-
-def _is_discipline(text: str) -> bool:
-    return bool(_DISCIPLINE_RE.search(text))
-
-
-def _needs_web(text: str) -> bool:
-    return bool(_NEEDS_WEB_RE.search(text))
+STREAM_MAX_TOKENS = 1800
 
 
 def _sanitize_telegram_html(html_text: str) -> str:
@@ -57,6 +34,19 @@ class Orchestrator:
     deepseek: OpenAICompatClient
     perplexity: OpenAICompatClient
     settings: Any  # Settings
+    admission: AdmissionController | None = None
+    summarizer: ConversationSummarizer | None = None
+
+    def _slot(
+        self,
+        provider: str,
+        user_id: int,
+        priority: int,
+        on_wait: OnWait | None = None,
+    ) -> AsyncContextManager[None]:
+        if self.admission is None:
+            return nullcontext()
+        return self.admission.slot(provider, user_id=user_id, priority=priority, on_wait=on_wait)
 
     async def build_messages(
         self,
@@ -67,22 +57,32 @@ class Orchestrator:
         user_text: str,
         *,
         extra_system: str = "",
+        features: TextFeatures | None = None,
+        long_memory: str = "",
+        memory_upto: int = 0,
     ) -> list[dict[str, str]]:
+        f = features or analyze(user_text)
         sys = prompts.UNIVERSAL_SYSTEM if mode == "universal" else prompts.PRO_SYSTEM
         sys += "\n" + style_prompt(user_style)
 
-        if mode == "pro" and _is_discipline(user_text):
+        if mode == "pro" and f.discipline:
             sys += "\n" + prompts.DISCIPLINE_SYSTEM
 
-        if _is_medical(user_text):
+        if f.medical:
             sys += "\n" + prompts.MEDICAL_GUARD
 
         if extra_system:
             sys += "\n" + extra_system
 
+        if long_memory:
+            sys += "\n\n" + prompts.LONG_MEMORY_PREFIX + long_memory
+
         msgs: list[dict[str, str]] = [{"role": "system", "content": sys}]
 
-        recent = await memory_repo.get_recent(db, user_id, self.settings.max_context_messages)
+        # turns already folded into long_memory are not resent
+        recent = await memory_repo.get_recent(
+            db, user_id, self.settings.max_context_messages, after_id=memory_upto
+        )
         for m in recent:
             if m.role not in ("user", "assistant"):
                 continue
@@ -91,7 +91,14 @@ class Orchestrator:
         msgs.append({"role": "user", "content": clean_text(user_text)[:4000]})
         return msgs
 
-    async def research(self, user_text: str) -> str:
+    async def research(
+        self,
+        user_text: str,
+        *,
+        user_id: int = 0,
+        priority: int = PRIORITY_BASIC,
+        on_queue: OnWait | None = None,
+    ) -> str:
         if not self.settings.enable_pro_research or not self.settings.perplexity_api_key:
             return ""
 
@@ -103,18 +110,19 @@ class Orchestrator:
             f"Запрос: {user_text}"
         )
 
-        resp = await self.perplexity.chat(
-            messages=[
-                {"role": "system", "content": "Ты исследователь. Не выдумывай источники."},
-                {"role": "user", "content": q},
-            ],
-            temperature=0.1,
-            max_tokens=900,
-            extra={
-                "search_recency_filter": "week",
-                "web_search_options": {"search_context_size": "high"},
-            },
-        )
+        async with self._slot("perplexity", user_id, priority, on_queue):
+            resp = await self.perplexity.chat(
+                messages=[
+                    {"role": "system", "content": "Ты исследователь. Не выдумывай источники."},
+                    {"role": "user", "content": q},
+                ],
+                temperature=0.1,
+                max_tokens=900,
+                extra={
+                    "search_recency_filter": "week",
+                    "web_search_options": {"search_context_size": "high"},
+                },
+            )
         return clean_text(resp.content)
 
     async def answer_stream(
@@ -125,15 +133,24 @@ class Orchestrator:
         user_style: dict[str, Any],
         user_text: str,
         on_delta: Callable[[str], Awaitable[None]] | None = None,
+        *,
+        priority: int = PRIORITY_BASIC,
+        on_queue: OnWait | None = None,
+        progress: GenerationProgress | None = None,
+        features: TextFeatures | None = None,
+        long_memory: str = "",
+        memory_upto: int = 0,
     ) -> str:
-        if _is_medical(user_text) and _wants_dosage(user_text):
+        started = time.perf_counter()
+        f = features or analyze(user_text)
+        if f.medical and f.dosage:
             return clean_text(
                 "Я не могу безопасно давать точные дозировки и схемы лечения по переписке. "
                 "Могу помочь разобраться, какие вопросы задать врачу, какие красные флаги важны, "
                 "и как безопасно действовать до очной консультации."
             )
 
-        use_perplexity_primary = mode == "pro" and bool(self.settings.perplexity_api_key) and _needs_web(user_text)
+        use_perplexity_primary = mode == "pro" and bool(self.settings.perplexity_api_key) and f.needs_web
 
         if use_perplexity_primary:
             messages = await self.build_messages(
@@ -143,14 +160,29 @@ class Orchestrator:
                 user_style,
                 user_text,
                 extra_system="Если используешь WEB — в конце добавь блок «Источники» с 3–8 ссылками.",
+                features=f,
+                long_memory=long_memory,
+                memory_upto=memory_upto,
             )
         else:
-            messages = await self.build_messages(db, user_id, mode, user_style, user_text)
+            messages = await self.build_messages(
+                db,
+                user_id,
+                mode,
+                user_style,
+                user_text,
+                features=f,
+                long_memory=long_memory,
+                memory_upto=memory_upto,
+            )
 
             research_block = ""
             if mode == "pro":
                 try:
-                    research_block = await self.research(user_text)
+                    with tracing.span("research"):
+                        research_block = await self.research(
+                            user_text, user_id=user_id, priority=priority, on_queue=on_queue
+                        )
                 except Exception:
                     research_block = ""
 
@@ -158,13 +190,15 @@ class Orchestrator:
                 messages.insert(1, {"role": "system", "content": "WEB-данные (для проверки фактов):\n" + research_block})
 
         client = self.perplexity if use_perplexity_primary else self.deepseek
+        provider = "perplexity" if use_perplexity_primary else "deepseek"
 
         raw = ""
-        async for delta in client.chat_stream(
+        first_token = True
+        stream = client.chat_stream(
             messages=messages,
             model=(self.settings.perplexity_model if use_perplexity_primary else self.settings.deepseek_model),
             temperature=0.2,
-            max_tokens=1800,
+            max_tokens=STREAM_MAX_TOKENS,
             extra=(
                 {
                     "search_recency_filter": "week",
@@ -173,33 +207,50 @@ class Orchestrator:
                 if use_perplexity_primary
                 else None
             ),
-        ):
-            raw += delta
-            if on_delta:
-                preview = escape_html(clean_text(raw)[-1200:])
-                await on_delta(preview)
+        )
+        # aclosing: a cancelled generation closes the SSE response right away
+        with tracing.span("stream", provider=provider) as sp:
+            async with self._slot(provider, user_id, priority, on_queue), aclosing(stream):
+                async for delta in stream:
+                    if first_token and delta:
+                        first_token = False
+                        ttft = time.perf_counter() - started
+                        ANSWER_FIRST_TOKEN.labels(provider).observe(ttft)
+                        sp.set(first_token_ms=round(ttft * 1000, 1))
+                    raw += delta
+                    if progress is not None:
+                        progress.chars = len(raw)
+                    if on_delta:
+                        preview = escape_html(clean_text(raw)[-1200:])
+                        await on_delta(preview)
+            sp.set(chars=len(raw))
 
         raw = clean_text(raw)
 
         # editor pass -> HTML (DeepSeek)
         if self.settings.enable_formatter_pass and self.settings.deepseek_api_key:
+            formatter_started = time.perf_counter()
             try:
-                edited = await self.deepseek.chat(
-                    messages=[
-                        {"role": "system", "content": prompts.EDITOR_SYSTEM},
-                        {"role": "user", "content": raw},
-                    ],
-                    model=self.settings.deepseek_model,
-                    temperature=0.15,
-                    max_tokens=1400,
-                )
+                with tracing.span("formatter"):
+                    async with self._slot("deepseek", user_id, priority):
+                        edited = await self.deepseek.chat(
+                            messages=[
+                                {"role": "system", "content": prompts.EDITOR_SYSTEM},
+                                {"role": "user", "content": raw},
+                            ],
+                            model=self.settings.deepseek_model,
+                            temperature=0.15,
+                            max_tokens=1400,
+                        )
                 html_out = clean_text(edited.content)
             except Exception:
                 html_out = escape_html(raw)
+            FORMATTER_PASS.observe(time.perf_counter() - formatter_started)
         else:
             html_out = escape_html(raw)
 
         html_out = _sanitize_telegram_html(html_out)
+        ANSWER_TOTAL.labels(provider).observe(time.perf_counter() - started)
         return html_out
 
     def split_for_telegram(self, html_text: str) -> list[str]:
@@ -0,0 +1,189 @@
+from __future__ import annotations
+
+import asyncio
+import re
+import time
+from dataclasses import dataclass, field
+from email.utils import parsedate_to_datetime
+from typing import Mapping, Optional
+
+
+# "1s", "6m0s", "20ms", "1h2m3.5s" (OpenAI style) or a plain number of seconds
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_UNIT_SEC = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+MAX_PACING_DELAY = 60.0
+
+
+def parse_duration(value: str | None) -> Optional[float]:
+    if not value:
+        return None
+    v = value.strip()
+    try:
+        return max(0.0, float(v))
+    except ValueError:
+        pass
+    parts = _DURATION_RE.findall(v)
+    if parts:
+        return sum(float(n) * _UNIT_SEC[u] for n, u in parts)
+    return None
+
+
+def parse_retry_after(value: str | None, *, now: float | None = None) -> Optional[float]:
+    """Retry-After is either delta-seconds or an HTTP-date."""
+    if not value:
+        return None
+    sec = parse_duration(value)
+    if sec is not None:
+        return sec
+    try:
+        dt = parsedate_to_datetime(value)
+    except Exception:
+        return None
+    return max(0.0, dt.timestamp() - (now if now is not None else time.time()))
+
+
+def _int_header(headers: Mapping[str, str], name: str) -> Optional[int]:
+    v = headers.get(name)
+    if v is None:
+        return None
+    try:
+        return int(float(v))
+    except ValueError:
+        return None
+
+
+@dataclass
+class TokenBucket:
+    """Refills `capacity` per minute. capacity == 0 means unlimited."""
+
+    capacity: float
+    tokens: float = 0.0
+    updated: float = field(default_factory=time.monotonic)
+
+    def __post_init__(self) -> None:
+        self.tokens = self.capacity
+
+    @property
+    def rate(self) -> float:
+        return self.capacity / 60.0
+
+    def refill(self, now: float) -> None:
+        if self.capacity <= 0:
+            return
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay_for(self, amount: float, now: float) -> float:
+        if self.capacity <= 0:
+            return 0.0
+        self.refill(now)
+        # a single request bigger than the bucket only has to wait for a full bucket
+        need = min(amount, self.capacity) - self.tokens
+        return need / self.rate if need > 0 else 0.0
+
+    def take(self, amount: float) -> None:
+        if self.capacity > 0:
+            self.tokens -= amount
+
+    def set_limit(self, capacity: float) -> None:
+        if capacity > 0 and capacity != self.capacity:
+            self.tokens = min(self.tokens, capacity) if self.capacity > 0 else capacity
+            self.capacity = capacity
+
+    def clamp(self, remaining: float) -> None:
+        if self.capacity > 0:
+            self.tokens = min(self.tokens, remaining)
+
+
+class ProviderPacer:
+    """Client-side quota pacing for one upstream provider.
+
+    Keeps requests-per-minute and tokens-per-minute buckets, and corrects them
+    from the provider's x-ratelimit-* headers. A 429 with Retry-After blocks
+    the whole provider until the given moment; callers wait instead of failing.
+    """
+
+    def __init__(self, name: str, *, rpm: int = 0, tpm: int = 0):
+        self.name = name
+        self.requests = TokenBucket(capacity=float(rpm))
+        self.tokens = TokenBucket(capacity=float(tpm))
+        self.blocked_until = 0.0
+        self.throttled = 0
+        self.delayed = 0
+        self.delay_total = 0.0
+        self.last_headers: dict[str, str] = {}
+
+    def delay_for(self, est_tokens: int, now: float | None = None) -> float:
+        now = time.monotonic() if now is None else now
+        return max(
+            self.blocked_until - now,
+            self.requests.delay_for(1, now),
+            self.tokens.delay_for(est_tokens, now),
+            0.0,
+        )
+
+    async def acquire(self, est_tokens: int) -> float:
+        waited = 0.0
+        while True:
+            delay = min(self.delay_for(est_tokens), MAX_PACING_DELAY)
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+            waited += delay
+        self.requests.take(1)
+        self.tokens.take(est_tokens)
+        if waited:
+            self.delayed += 1
+            self.delay_total += waited
+        return waited
+
+    def observe(self, headers: Mapping[str, str], status_code: int) -> None:
+        now = time.monotonic()
+        rl = {k.lower(): v for k, v in headers.items() if k.lower().startswith("x-ratelimit-") or k.lower() == "retry-after"}
+        if rl:
+            self.last_headers = rl
+
+        for bucket, kind in ((self.requests, "requests"), (self.tokens, "tokens")):
+            limit = _int_header(rl, f"x-ratelimit-limit-{kind}")
+            if limit is not None:
+                bucket.set_limit(float(limit))
+            remaining = _int_header(rl, f"x-ratelimit-remaining-{kind}")
+            if remaining is None:
+                continue
+            bucket.refill(now)
+            bucket.clamp(float(remaining))
+            if remaining <= 0:
+                reset = parse_duration(rl.get(f"x-ratelimit-reset-{kind}"))
+                if reset:
+                    self.blocked_until = max(self.blocked_until, now + reset)
+
+        if status_code == 429:
+            self.throttled += 1
+            retry = parse_retry_after(rl.get("retry-after"))
+            self.blocked_until = max(self.blocked_until, now + (retry if retry is not None else 1.0))
+
+    def record_usage(self, est_tokens: int, used_tokens: int) -> None:
+        """Correct the token bucket once the real usage is known."""
+        self.tokens.take(used_tokens - est_tokens)
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        self.requests.refill(now)
+        self.tokens.refill(now)
+        return {
+            "rpm_limit": self.requests.capacity,
+            "rpm_available": round(self.requests.tokens, 2),
+            "tpm_limit": self.tokens.capacity,
+            "tpm_available": round(self.tokens.tokens, 1),
+            "blocked_for_sec": round(max(0.0, self.blocked_until - now), 3),
+            "throttled_429": self.throttled,
+            "delayed_requests": self.delayed,
+            "delay_total_sec": round(self.delay_total, 3),
+            "last_headers": dict(self.last_headers),
+        }
+
+
+def estimate_tokens(messages: list[dict[str, str]], max_tokens: int) -> int:
+    # ~4 chars per token is close enough for pacing
+    return sum(len(m.get("content") or "") for m in messages) // 4 + max_tokens
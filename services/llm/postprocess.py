@@ -2,7 +2,8 @@ from __future__ import annotations
 
 import re
 import html
-from typing import List
+from html.parser import HTMLParser
+from typing import List, Tuple
 
 
 _CONTROL_CHARS = re.compile(r"[\x00-\x08\x0B\x0C\x0E-\x1F\x7F]")
@@ -24,24 +25,247 @@ def escape_html(text: str) -> str:
     return html.escape(text, quote=False)
 
 
+# Telegram counts message length in UTF-16 code units of the visible text
+TELEGRAM_TEXT_LIMIT = 4096
+
+_TOKEN_RE = re.compile(
+    r"(?P<tag></?[a-zA-Z][a-zA-Z0-9-]*(?:\s[^<>]*)?>)"
+    r"|(?P<entity>&(?:#\d+|#x[0-9a-fA-F]+|[a-zA-Z][a-zA-Z0-9]*);)"
+    r"|(?P<sep>[ \t]*\n(?:[ \t]*\n)+|[ \t]*\n|[ \t]+)"
+    r"|(?P<text>[^<&\s]+|[<&]|\s)"
+)
+_TAG_NAME_RE = re.compile(r"</?([a-zA-Z][a-zA-Z0-9-]*)")
+_EMPTY_PAIR_RE = re.compile(r"<([a-zA-Z][a-zA-Z0-9-]*)(?:\s[^<>]*)?></\1>")
+_SENTENCE_END = frozenset(".!?…")
+
+# break preference: paragraph, line, sentence, word
+_RANK_PARAGRAPH, _RANK_LINE, _RANK_SENTENCE, _RANK_WORD = range(4)
+# a preferred break is only taken if the part is at least this full
+_MIN_FILL = 0.3
+
+
+def utf16_len(text: str) -> int:
+    if text.isascii():
+        return len(text)
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _units(html_text: str):
+    """(kind, raw, visible utf-16 length, tag name | sep rank)"""
+    prev = ""
+    for m in _TOKEN_RE.finditer(html_text):
+        kind = m.lastgroup
+        raw = m.group()
+        if kind == "tag":
+            name = _TAG_NAME_RE.match(raw).group(1).lower()
+            yield ("close" if raw[1] == "/" else "open", raw, 0, name)
+        elif kind == "entity":
+            yield "text", raw, utf16_len(html.unescape(raw)), None
+            prev = ";"
+        elif kind == "sep":
+            if raw.count("\n") >= 2:
+                rank = _RANK_PARAGRAPH
+            elif "\n" in raw:
+                rank = _RANK_LINE
+            elif prev in _SENTENCE_END:
+                rank = _RANK_SENTENCE
+            else:
+                rank = _RANK_WORD
+            yield "sep", raw, utf16_len(raw), rank
+        else:
+            yield "text", raw, utf16_len(raw), None
+            prev = raw[-1]
+
+
+def _close_tags(stack: List[tuple]) -> str:
+    return "".join(f"</{name}>" for name, _ in reversed(stack))
+
+
+def _strip_tags(text: str) -> str:
+    return re.sub(r"<[^>]+>", "", text)
+
+
+def _clean_part(text: str) -> str:
+    text = text.strip()
+    while True:
+        cleaned = _EMPTY_PAIR_RE.sub("", text)
+        if cleaned == text:
+            return text
+        text = cleaned
+
+
 def split_parts(html_text: str, limit: int = 3500) -> List[str]:
-    if len(html_text) <= limit:
+    """Split Telegram HTML into parts of at most `limit` visible UTF-16 units.
+
+    Cuts at the last paragraph / line / sentence / word break that fits (in
+    that order of preference), never inside a tag or an entity. Tags open
+    at a cut are closed at the end of the part and reopened in the next one.
+    """
+    if utf16_len(html_text) <= limit:
         return [html_text]
 
     parts: List[str] = []
-    buf = ""
-    for block in html_text.split("\n\n"):
-        add = block if not buf else "\n\n" + block
-        if len(buf) + len(add) <= limit:
-            buf += add
-        else:
-            if buf:
-                parts.append(buf)
-            # if block itself too big, hard split
-            while len(block) > limit:
-                parts.append(block[:limit])
-                block = block[limit:]
-            buf = block
-    if buf:
-        parts.append(buf)
+    units: List[tuple] = []  # units of the part being built
+    stack: List[tuple] = []  # (name, raw open tag)
+    breaks: List[tuple] = []  # (rank, index into units, size there, open tags there)
+    size = 0
+
+    queue = list(_units(html_text))
+    queue.reverse()
+
+    def start_part(reopen: List[tuple]) -> None:
+        nonlocal size
+        units.clear()
+        breaks.clear()
+        stack.clear()
+        size = 0
+        for name, raw in reopen:
+            units.append(("open", raw, 0, name))
+            stack.append((name, raw))
+
+    def finish_part(end: int, open_tags: List[tuple]) -> None:
+        text = _clean_part("".join(u[1] for u in units[:end]) + _close_tags(open_tags))
+        if _strip_tags(text).strip():
+            parts.append(text)
+
+    def cut() -> None:
+        """Emit a part at the best break; what followed it goes back to the queue."""
+        chosen = None
+        for rank in range(_RANK_WORD + 1):
+            chosen = next((b for b in reversed(breaks) if b[0] <= rank and b[2] >= limit * _MIN_FILL), None)
+            if chosen:
+                break
+        if chosen is None and breaks:
+            chosen = breaks[-1]
+
+        if chosen is None:
+            # no break at all: cut between units (still never inside a tag or entity)
+            finish_part(len(units), stack)
+            start_part(list(stack))
+            return
+        _, idx, _, open_tags = chosen
+        carry = units[idx + 1 :]
+        finish_part(idx, open_tags)
+        start_part(open_tags)
+        queue.extend(reversed(carry))
+
+    while queue:
+        unit = queue.pop()
+        kind, raw, vlen, extra = unit
+
+        if kind == "open":
+            stack.append((extra, raw))
+            units.append(unit)
+            continue
+        if kind == "close":
+            for i in range(len(stack) - 1, -1, -1):
+                if stack[i][0] == extra:
+                    # also closes anything left open inside it
+                    units.append(("close", _close_tags(stack[i:]), 0, extra))
+                    del stack[i:]
+                    break
+            continue  # a stray closing tag is dropped
+
+        if kind == "sep":
+            if size > 0:
+                breaks.append((extra, len(units), size, list(stack)))
+            units.append(unit)
+            size += vlen
+            if size > limit:
+                # the break itself overflows: it's where we cut (or earlier)
+                cut()
+            continue
+
+        if size + vlen <= limit:
+            units.append(unit)
+            size += vlen
+            continue
+
+        if size > 0:
+            queue.append(unit)
+            cut()
+            continue
+
+        # one word longer than a whole part: split by code points
+        room, used, n = limit, 0, 0
+        for ch in raw:
+            w = 2 if ord(ch) > 0xFFFF else 1
+            if used + w > room:
+                break
+            used += w
+            n += 1
+        if n == 0:
+            n, used = 1, utf16_len(raw[0])
+        if raw[n:]:
+            queue.append(("text", raw[n:], vlen - used, None))
+        units.append(("text", raw[:n], used, None))
+        size += used
+        cut()
+
+    if units:
+        finish_part(len(units), stack)
     return parts
+
+
+class _PartReader(HTMLParser):
+    """Visible characters of a part with the tags open around each one."""
+
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self.stack: List[str] = []
+        self.balanced = True
+        self.chars: List[Tuple[str, Tuple[str, ...]]] = []
+
+    def handle_starttag(self, tag, attrs):
+        self.stack.append(tag)
+
+    def handle_endtag(self, tag):
+        if self.stack and self.stack[-1] == tag:
+            self.stack.pop()
+        else:
+            self.balanced = False
+
+    def handle_data(self, data):
+        fmt = tuple(self.stack)
+        self.chars.extend((ch, fmt) for ch in data if not ch.isspace())
+
+
+def _read(text: str) -> _PartReader:
+    r = _PartReader()
+    r.feed(text)
+    r.close()
+    return r
+
+
+_BARE_AMP_RE = re.compile(r"&(?!#\d+;|#x[0-9a-fA-F]+;|[a-zA-Z][a-zA-Z0-9]*;)")
+
+
+def split_problems(html_text: str, parts: List[str], limit: int) -> List[str]:
+    """Why `parts` is not a valid split_parts() result for well-formed `html_text`.
+
+    Every part must have balanced tags and at most `limit` visible UTF-16
+    units, and no entity may be cut. Joined together the parts must keep
+    every visible character, under the same tags, in order; whitespace at
+    the cuts and the tags closed and reopened there are not compared.
+    Empty list means valid.
+    """
+    problems: List[str] = []
+    got: List[Tuple[str, Tuple[str, ...]]] = []
+    bare = 0
+    for i, part in enumerate(parts):
+        r = _read(part)
+        if not r.balanced or r.stack:
+            problems.append(f"part {i}: unbalanced tags")
+        visible = html.unescape(_strip_tags(part))
+        if utf16_len(visible) > limit:
+            problems.append(f"part {i}: {utf16_len(visible)} UTF-16 units > {limit}")
+        if not visible.strip():
+            problems.append(f"part {i}: empty")
+        bare += len(_BARE_AMP_RE.findall(part))
+        got.extend(r.chars)
+    # a cut entity leaves a bare "&" behind (and breaks the text check below)
+    if bare != len(_BARE_AMP_RE.findall(html_text)):
+        problems.append("an entity was cut")
+    if got != _read(html_text).chars:
+        problems.append("visible text or its formatting changed")
+    return problems
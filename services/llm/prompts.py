@@ -47,3 +47,12 @@ DISCIPLINE_SYSTEM = (
     "Ответ: короткая мотивация (1–2 предложения) + практическая задача (3–7 пунктов). "
     "Без токсичности."
 )
+
+SUMMARY_SYSTEM = (
+    "Ты ведёшь краткую долговременную память о пользователе. "
+    "Объедини текущую память и новые реплики в одну сводку: факты о пользователе, его цели, предпочтения, "
+    "важные решения и открытые вопросы. Без приветствий и воды, пунктами. "
+    "Не выдумывай. Максимум {max_chars} символов."
+)
+
+LONG_MEMORY_PREFIX = "Память о пользователе (сводка прошлых диалогов):\n"
@@ -1,23 +1,22 @@
 from __future__ import annotations
 
-import re
 from dataclasses import dataclass
 from typing import Any, Dict
 
-_EMOJI_RE = re.compile(r"[\U0001F300-\U0001FAFF\u2600-\u27BF]")
-_PROFANITY_RE = re.compile(r"\b(бля|сука|нах|хуй|пизд|ёб|еба|заеб|пох|мудак)\b", re.IGNORECASE)
+from services.llm.features import TextFeatures, analyze
 
 
 def _clamp(v: float, lo: float = 0.0, hi: float = 1.0) -> float:
     return max(lo, min(hi, v))
 
 
-def update_style(style: Dict[str, Any], user_text: str) -> Dict[str, Any]:
+def update_style(style: Dict[str, Any], user_text: str, features: TextFeatures | None = None) -> Dict[str, Any]:
     s = dict(style or {})
 
-    msg_len = len(user_text.strip())
-    emoji = len(_EMOJI_RE.findall(user_text))
-    prof = len(_PROFANITY_RE.findall(user_text))
+    f = features or analyze(user_text)
+    msg_len = f.length
+    emoji = f.emoji
+    prof = f.profanity
 
     n = int(s.get("n", 0)) + 1
     s["n"] = n
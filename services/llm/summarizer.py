@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from contextlib import nullcontext
+from typing import Any, Dict, Set
+
+import aiosqlite
+
+from services.llm import prompts
+from services.llm.admission import PRIORITY_BACKGROUND, AdmissionController
+from services.llm.openai_compat import OpenAICompatClient
+from services.llm.postprocess import clean_text
+from services import memory as memory_repo
+from services import users as users_repo
+
+
+log = logging.getLogger("summarizer")
+
+# don't spend a request on a couple of lines
+MIN_BATCH = 6
+MAX_BATCH = 60
+
+
+class ConversationSummarizer:
+    """Folds turns older than the recent window into users.long_memory.
+
+    Runs in the background after an answer was delivered, debounced per user:
+    a burst of messages produces one summary request.
+    """
+
+    def __init__(self, client: OpenAICompatClient, settings: Any, *, admission: AdmissionController | None = None):
+        self.client = client
+        self.settings = settings
+        self.admission = admission
+        self._pending: Dict[int, asyncio.Task] = {}
+        self._running: Set[int] = set()
+        self.runs = 0
+        self.folded_messages = 0
+        self.errors = 0
+
+    def schedule(self, db: aiosqlite.Connection, user_id: int) -> None:
+        prev = self._pending.pop(user_id, None)
+        if prev is not None:
+            prev.cancel()
+        self._pending[user_id] = asyncio.create_task(self._delayed(db, user_id))
+
+    async def _delayed(self, db: aiosqlite.Connection, user_id: int) -> None:
+        await asyncio.sleep(self.settings.summarize_delay_sec)
+        self._pending.pop(user_id, None)
+        if user_id in self._running:
+            # a summary is being written right now; look again later
+            self.schedule(db, user_id)
+            return
+        self._running.add(user_id)
+        try:
+            await self.summarize(db, user_id)
+        except Exception:
+            self.errors += 1
+            log.exception("summary failed for user %s", user_id)
+        finally:
+            self._running.discard(user_id)
+
+    async def summarize(self, db: aiosqlite.Connection, user_id: int) -> bool:
+        u = await users_repo.get_user(db, user_id)
+        if not u:
+            return False
+
+        keep = self.settings.recent_context_messages
+        msgs = await memory_repo.get_after(db, user_id, u.long_memory_upto, MAX_BATCH + keep)
+        older = [m for m in msgs[: max(0, len(msgs) - keep)] if m.role in ("user", "assistant")]
+        if len(older) < MIN_BATCH:
+            return False
+        upto_id = msgs[len(msgs) - keep - 1].id
+
+        max_chars = self.settings.long_memory_max_chars
+        dialog = "\n".join(
+            f"{'Пользователь' if m.role == 'user' else 'Ассистент'}: {clean_text(m.content)[:800]}" for m in older
+        )
+        user_prompt = f"Текущая память:\n{u.long_memory or '—'}\n\nНовые реплики:\n{dialog}"
+
+        slot = (
+            self.admission.slot("deepseek", user_id=user_id, priority=PRIORITY_BACKGROUND)
+            if self.admission is not None
+            else nullcontext()
+        )
+        async with slot:
+            resp = await self.client.chat(
+                messages=[
+                    {"role": "system", "content": prompts.SUMMARY_SYSTEM.format(max_chars=max_chars)},
+                    {"role": "user", "content": user_prompt},
+                ],
+                temperature=0.1,
+                max_tokens=max(200, max_chars // 2),
+            )
+
+        summary = clean_text(resp.content)[:max_chars]
+        if not summary:
+            return False
+        await users_repo.append_long_memory(db, user_id, summary, upto_id=upto_id)
+        self.runs += 1
+        self.folded_messages += len(older)
+        return True
+
+    async def close(self) -> None:
+        for t in list(self._pending.values()):
+            t.cancel()
+        self._pending.clear()
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "running": len(self._running),
+            "runs": self.runs,
+            "folded_messages": self.folded_messages,
+            "errors": self.errors,
+        }
@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+import asyncio
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, Set
+
+
+POLICY_CANCEL = "cancel"  # new message cancels the running generation
+POLICY_QUEUE = "queue"  # new message waits for the running one to finish
+POLICY_MERGE = "merge"  # running one is cancelled, texts are answered together
+
+POLICIES = (POLICY_CANCEL, POLICY_QUEUE, POLICY_MERGE)
+
+# Set by a feeder that handles one user's updates strictly in order
+# (bot.worker): run() sets the event once the new generation is registered,
+# so the user's next update can go ahead and supersede it instead of waiting
+# for the whole answer.
+HANDLER_TURN: ContextVar[asyncio.Event | None] = ContextVar("handler_turn", default=None)
+
+
+@dataclass
+class GenerationProgress:
+    """Mutable state of one generation, shared between the flow and the supervisor."""
+
+    charged: bool = False  # limits.consume succeeded
+    chars: int = 0  # raw characters streamed so far
+    loading: Any = None  # loader Message, if already sent
+
+
+@dataclass
+class _Generation:
+    text: str
+    task: asyncio.Task
+    progress: GenerationProgress = field(default_factory=GenerationProgress)
+    # earlier tasks that must be over before this one's flow starts
+    waits: Set[asyncio.Task] = field(default_factory=set)
+
+
+FlowFactory = Callable[[str, GenerationProgress], Awaitable[None]]
+
+
+class GenerationSupervisor:
+    """Owns the in-flight answer task of each user.
+
+    `run` returns False when the generation was superseded by a newer message.
+    """
+
+    def __init__(self, policy: str = POLICY_CANCEL):
+        self.policy = policy if policy in POLICIES else POLICY_CANCEL
+        self._current: Dict[int, _Generation] = {}
+        self.started = 0
+        self.cancelled = 0
+        self.queued = 0
+        self.merged = 0
+        self.tokens_saved = 0
+
+    def record_saved(self, tokens: int) -> None:
+        self.tokens_saved += max(0, int(tokens))
+
+    async def _after(self, waits: Set[asyncio.Task], factory: FlowFactory, text: str, progress: GenerationProgress) -> None:
+        if waits:
+            await asyncio.wait(waits)
+        await factory(text, progress)
+
+    async def run(self, user_id: int, text: str, factory: FlowFactory, *, policy: str | None = None) -> bool:
+        policy = policy or self.policy
+        progress = GenerationProgress()
+        prev = self._current.get(user_id)
+        waits: Set[asyncio.Task] = set()
+
+        # no await until the new generation is in _current: a message arriving
+        # meanwhile must see it, not `prev`, or two generations would run
+        if prev is not None and not prev.task.done():
+            # a superseded generation may itself still be waiting on an older one
+            waits = {t for t in prev.waits if not t.done()} | {prev.task}
+            if policy == POLICY_QUEUE:
+                self.queued += 1
+            else:
+                if policy == POLICY_MERGE:
+                    self.merged += 1
+                    text = prev.text + "\n\n" + text
+                self.cancelled += 1
+                prev.task.cancel()
+
+        gen = _Generation(
+            text=text,
+            task=asyncio.create_task(self._after(waits, factory, text, progress)),
+            progress=progress,
+            waits=waits,
+        )
+        self._current[user_id] = gen
+        self.started += 1
+        turn = HANDLER_TURN.get()
+        if turn is not None:
+            turn.set()
+        try:
+            await asyncio.wait({gen.task})
+        except asyncio.CancelledError:
+            gen.task.cancel()
+            raise
+        finally:
+            if self._current.get(user_id) is gen and gen.task.done():
+                del self._current[user_id]
+
+        if gen.task.cancelled():
+            return False
+        gen.task.result()
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "policy": self.policy,
+            "inflight": sum(1 for g in self._current.values() if not g.task.done()),
+            "started": self.started,
+            "cancelled": self.cancelled,
+            "queued": self.queued,
+            "merged": self.merged,
+            "tokens_saved_est": self.tokens_saved,
+        }
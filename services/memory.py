@@ -6,14 +6,18 @@ from typing import List, Tuple
 
 import aiosqlite
 
+from services.metrics import db_timed
+
 
 @dataclass
 class MemoryMessage:
     role: str
     content: str
     ts: int
+    id: int = 0
 
 
+@db_timed
 async def add(db: aiosqlite.Connection, user_id: int, role: str, content: str) -> None:
     await db.execute(
         "INSERT INTO memory(user_id, role, content, ts) VALUES(?, ?, ?, ?)",
@@ -22,11 +26,23 @@ async def add(db: aiosqlite.Connection, user_id: int, role: str, content: str) -
     await db.commit()
 
 
-async def get_recent(db: aiosqlite.Connection, user_id: int, limit: int) -> List[MemoryMessage]:
+@db_timed
+async def get_recent(db: aiosqlite.Connection, user_id: int, limit: int, *, after_id: int = 0) -> List[MemoryMessage]:
     async with db.execute(
-        "SELECT role, content, ts FROM memory WHERE user_id=? ORDER BY ts DESC LIMIT ?",
-        (user_id, limit),
+        "SELECT id, role, content, ts FROM memory WHERE user_id=? AND id>? ORDER BY ts DESC, id DESC LIMIT ?",
+        (user_id, after_id, limit),
     ) as cur:
         rows = await cur.fetchall()
-    msgs = [MemoryMessage(role=r["role"], content=r["content"], ts=r["ts"]) for r in rows]
+    msgs = [MemoryMessage(role=r["role"], content=r["content"], ts=r["ts"], id=r["id"]) for r in rows]
     return list(reversed(msgs))
+
+
+@db_timed
+async def get_after(db: aiosqlite.Connection, user_id: int, after_id: int, limit: int) -> List[MemoryMessage]:
+    """Oldest-first messages with id > after_id."""
+    async with db.execute(
+        "SELECT id, role, content, ts FROM memory WHERE user_id=? AND id>? ORDER BY id ASC LIMIT ?",
+        (user_id, after_id, limit),
+    ) as cur:
+        rows = await cur.fetchall()
+    return [MemoryMessage(role=r["role"], content=r["content"], ts=r["ts"], id=r["id"]) for r in rows]
@@ -0,0 +1,354 @@
+from __future__ import annotations
+
+import functools
+import math
+import time
+from bisect import bisect_left
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Sequence, Tuple, TypeVar
+
+from services import tracing
+
+
+# Everything here is touched from the event loop thread only, so updates are
+# plain attribute arithmetic: no locks, and a labelled child can be bound once
+# (at import or decoration time) to skip even the dict lookup per sample.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+LLM_BUCKETS = (0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 15.0, 30.0, 60.0, 120.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: "_Metric") -> None:
+        if metric.name in self._metrics:
+            raise ValueError(f"metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+
+    def dump(self) -> List[dict]:
+        """JSON-able snapshot, for shipping a worker's metrics to the ingress."""
+        return [m.dump() for m in self._metrics.values()]
+
+    def render(self, *, merged: Iterable[Tuple[Dict[str, str], List[dict]]] = ()) -> str:
+        """Prometheus text format: this process, plus dumps from other processes
+        with their extra labels (e.g. {"shard": "0"})."""
+        by_name: Dict[str, Tuple[dict, List[Tuple[Dict[str, str], dict]]]] = {}
+        for d in self.dump():
+            by_name[d["name"]] = (d, [({}, d)])
+        for extra, dumps in merged:
+            for d in dumps or ():
+                head, parts = by_name.setdefault(d["name"], (d, []))
+                parts.append((extra, d))
+
+        out: List[str] = []
+        for name, (head, parts) in by_name.items():
+            out.append(f"# HELP {name} {_escape_help(head['help'])}")
+            out.append(f"# TYPE {name} {head['type']}")
+            for extra, d in parts:
+                _render_samples(out, d, extra)
+        out.append("")
+        return "\n".join(out)
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), *, registry: Registry = REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], Any] = {}
+        registry.register(self)
+
+    def labels(self, *values: Any) -> Any:
+        child = self._children.get(values)
+        if child is not None:
+            return child
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}, got {key}")
+            child = self._children[key] = self._new_child()
+        return child
+
+    def _new_child(self) -> Any:
+        raise NotImplementedError
+
+    def _sample(self, child: Any) -> Any:
+        raise NotImplementedError
+
+    def dump(self) -> dict:
+        return {
+            "name": self.name,
+            "type": self.kind,
+            "help": self.help,
+            "labelnames": list(self.labelnames),
+            "samples": [[list(k), self._sample(c)] for k, c in list(self._children.items())],
+        }
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self) -> None:
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self) -> _CounterChild:
+        return _CounterChild()
+
+    def _sample(self, child: _CounterChild) -> float:
+        return child.value
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.labels().inc(amount)
+
+
+class _GaugeChild:
+    __slots__ = ("value", "fn")
+
+    def __init__(self) -> None:
+        self.value = 0.0
+        self.fn: Callable[[], float] | None = None
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.value -= amount
+
+    def set_function(self, fn: Callable[[], float]) -> None:
+        """Read at scrape time, e.g. a queue's current depth."""
+        self.fn = fn
+
+    def get(self) -> float:
+        if self.fn is None:
+            return self.value
+        try:
+            return float(self.fn())
+        except Exception:
+            return math.nan
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def _new_child(self) -> _GaugeChild:
+        return _GaugeChild()
+
+    def _sample(self, child: _GaugeChild) -> float:
+        return child.get()
+
+    def set(self, value: float) -> None:
+        self.labels().set(value)
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds: Tuple[float, ...]) -> None:
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        # first bound >= value, i.e. the `le` bucket; the last slot is +Inf
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        *,
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+        registry: Registry = REGISTRY,
+    ):
+        self.buckets = tuple(sorted(float(b) for b in buckets))
+        super().__init__(name, help, labelnames, registry=registry)
+
+    def _new_child(self) -> _HistogramChild:
+        return _HistogramChild(self.buckets)
+
+    def _sample(self, child: _HistogramChild) -> list:
+        return [list(child.counts), child.sum]
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def dump(self) -> dict:
+        d = super().dump()
+        d["buckets"] = list(self.buckets)
+        return d
+
+
+F = TypeVar("F", bound=Callable[..., Awaitable[Any]])
+
+
+def timed(histogram: Histogram, *labels: Any) -> Callable[[F], F]:
+    """Observe an async function's run time (exceptions included)."""
+    child = histogram.labels(*labels)
+
+    def deco(fn: F) -> F:
+        @functools.wraps(fn)
+        async def wrapper(*args: Any, **kwargs: Any) -> Any:
+            started = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                child.observe(time.perf_counter() - started)
+
+        return wrapper  # type: ignore[return-value]
+
+    return deco
+
+
+def db_timed(fn: F) -> F:
+    """Repository function -> db_query_seconds{fn="<module>.<name>"} and a trace span of that name."""
+    name = f"{fn.__module__.rsplit('.', 1)[-1]}.{fn.__name__}"
+    child = DB_QUERY.labels(name)
+
+    @functools.wraps(fn)
+    async def wrapper(*args: Any, **kwargs: Any) -> Any:
+        started = time.perf_counter()
+        try:
+            with tracing.span(name):
+                return await fn(*args, **kwargs)
+        finally:
+            child.observe(time.perf_counter() - started)
+
+    return wrapper  # type: ignore[return-value]
+
+
+def _fmt(v: float) -> str:
+    if math.isnan(v):
+        return "NaN"
+    if math.isinf(v):
+        return "+Inf" if v > 0 else "-Inf"
+    if float(v).is_integer() and abs(v) < 1e15:
+        return str(int(v))
+    return repr(float(v))
+
+
+def _escape_help(s: str) -> str:
+    return s.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def _escape_value(s: str) -> str:
+    return s.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(pairs: Iterable[Tuple[str, str]]) -> str:
+    body = ",".join(f'{k}="{_escape_value(str(v))}"' for k, v in pairs)
+    return "{" + body + "}" if body else ""
+
+
+def _render_samples(out: List[str], d: dict, extra: Dict[str, str]) -> None:
+    name = d["name"]
+    labelnames = d["labelnames"]
+    for values, sample in d["samples"]:
+        base = list(extra.items()) + list(zip(labelnames, values))
+        if d["type"] != "histogram":
+            out.append(f"{name}{_labels(base)} {_fmt(sample)}")
+            continue
+        counts, total = sample
+        acc = 0
+        for bound, c in zip(d["buckets"], counts):
+            acc += c
+            out.append(f"{name}_bucket{_labels(base + [('le', _fmt(bound))])} {acc}")
+        acc += counts[-1]
+        out.append(f"{name}_bucket{_labels(base + [('le', '+Inf')])} {acc}")
+        out.append(f"{name}_sum{_labels(base)} {_fmt(total)}")
+        out.append(f"{name}_count{_labels(base)} {acc}")
+
+
+# --- the bot's metrics ---
+
+ANSWER_FIRST_TOKEN = Histogram(
+    "bot_answer_first_token_seconds",
+    "answer_stream start (memory, research, queueing included) to the first streamed token",
+    ("provider",),
+    buckets=LLM_BUCKETS,
+)
+ANSWER_TOTAL = Histogram(
+    "bot_answer_seconds",
+    "Whole answer_stream, formatter pass included",
+    ("provider",),
+    buckets=LLM_BUCKETS,
+)
+FORMATTER_PASS = Histogram("bot_formatter_pass_seconds", "Editor pass over the streamed answer", buckets=LLM_BUCKETS)
+LLM_REQUEST = Histogram(
+    "llm_request_seconds",
+    "Provider HTTP request; for streams until the last chunk",
+    ("provider", "kind", "status"),
+    buckets=LLM_BUCKETS,
+)
+DB_QUERY = Histogram("db_query_seconds", "Repository call time", ("fn",), buckets=DB_BUCKETS)
+TELEGRAM_API = Histogram("telegram_api_seconds", "Bot API call time", ("method", "status"))
+TELEGRAM_EDITS = Counter("telegram_edits_total", "Answer message edits by outcome", ("outcome",))
+JOB_RUN = Histogram("job_seconds", "Background job run time", ("job",))
+CRYPTOPAY_WEBHOOKS = Counter("cryptopay_webhooks_total", "CryptoPay webhook requests by result", ("result",))
+INVOICE_STATUS = Counter("invoice_status_changes_total", "Invoice status events handled", ("status",))
+INVOICES_ISSUED = Counter("invoices_issued_total", "Payment links handed out", ("source",))
+QUEUE_DEPTH = Gauge("queue_depth", "Items waiting in an internal queue", ("queue",))
+
+
+def _bench(n: int = 200_000) -> None:
+    import asyncio
+
+    reg = Registry()
+    c = Counter("bench_total", "", registry=reg).labels()
+    h = Histogram("bench_seconds", "", ("fn",), registry=reg, buckets=DB_BUCKETS)
+    child = h.labels("x")
+
+    def per_op(fn: Callable[[], Any]) -> float:
+        started = time.perf_counter()
+        for _ in range(n):
+            fn()
+        return (time.perf_counter() - started) / n * 1e9
+
+    empty = per_op(lambda: None)
+    print(f"counter.inc              {per_op(c.inc) - empty:7.1f} ns")
+    print(f"histogram.observe        {per_op(lambda: child.observe(0.003)) - empty:7.1f} ns")
+    print(f"histogram.labels.observe {per_op(lambda: h.labels('x').observe(0.003)) - empty:7.1f} ns")
+
+    async def bare() -> None:
+        return None
+
+    wrapped = timed(h, "y")(bare)
+
+    async def loop(fn: Callable[[], Awaitable[None]]) -> float:
+        started = time.perf_counter()
+        for _ in range(n):
+            await fn()
+        return (time.perf_counter() - started) / n * 1e9
+
+    b = asyncio.run(loop(bare))
+    w = asyncio.run(loop(wrapped))
+    print(f"@timed async wrapper     {w - b:7.1f} ns")
+
+
+if __name__ == "__main__":
+    _bench()
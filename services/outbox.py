@@ -0,0 +1,216 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, List, Tuple
+
+import aiosqlite
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+from services.broadcast import SendPacer
+
+
+log = logging.getLogger("outbox")
+
+MAX_ATTEMPTS = 6
+# a failed send is retried after RETRY_BASE_SEC * 2**attempts (10s .. ~5 min)
+RETRY_BASE_SEC = 10
+POLL_SEC = 15
+
+KIND_PAYMENT_SUCCESS = "payment_success"
+KIND_PAYMENT_EXPIRED = "payment_expired"
+KIND_REFERRAL_BONUS = "referral_bonus"
+KIND_RENEWAL_REMINDER = "renewal_reminder"
+
+
+@dataclass
+class Notification:
+    id: int
+    chat_id: int
+    kind: str
+    text: str
+    attempts: int
+    created_at: int
+
+
+async def enqueue(
+    db: aiosqlite.Connection,
+    chat_id: int,
+    text: str,
+    *,
+    kind: str = "",
+    commit: bool = True,
+) -> int:
+    """Queue a message; with commit=False it becomes part of the caller's transaction."""
+    cur = await db.execute(
+        "INSERT INTO notification_outbox(chat_id, kind, text, created_at) VALUES(?, ?, ?, ?)",
+        (chat_id, kind, text, int(time.time())),
+    )
+    if commit:
+        await db.commit()
+    return int(cur.lastrowid)
+
+
+async def due(db: aiosqlite.Connection, now: int, limit: int) -> List[Notification]:
+    async with db.execute(
+        """
+        SELECT id, chat_id, kind, text, attempts, created_at FROM notification_outbox
+        WHERE status='pending' AND next_at <= ?
+        ORDER BY next_at, id
+        LIMIT ?
+        """,
+        (now, limit),
+    ) as cur:
+        rows = await cur.fetchall()
+    return [Notification(r["id"], r["chat_id"], r["kind"], r["text"], r["attempts"], r["created_at"]) for r in rows]
+
+
+async def pending_summary(db: aiosqlite.Connection) -> Tuple[int, int]:
+    """(pending count, created_at of the oldest pending)."""
+    async with db.execute(
+        "SELECT COUNT(*) AS c, MIN(created_at) AS m FROM notification_outbox WHERE status='pending'"
+    ) as cur:
+        r = await cur.fetchone()
+    return int(r["c"] or 0), int(r["m"] or 0)
+
+
+async def save_results(
+    db: aiosqlite.Connection,
+    sent: List[int],
+    retry: List[Tuple[int, int, str]],
+    failed: List[Tuple[int, str]],
+    *,
+    deferred: List[Tuple[int, int]] = (),
+) -> None:
+    """One commit per drained batch.
+
+    `retry` is (id, next_at, error) and costs an attempt; `deferred` is
+    (id, next_at) for sends pushed back by a 429, which doesn't.
+    """
+    now = int(time.time())
+    await db.executemany(
+        "UPDATE notification_outbox SET status='sent', sent_at=?, attempts=attempts+1 WHERE id=?",
+        [(now, i) for i in sent],
+    )
+    await db.executemany(
+        "UPDATE notification_outbox SET attempts=attempts+1, next_at=?, error=? WHERE id=?",
+        [(at, err[:500], i) for i, at, err in retry],
+    )
+    await db.executemany(
+        "UPDATE notification_outbox SET status='failed', attempts=attempts+1, error=? WHERE id=?",
+        [(err[:500], i) for i, err in failed],
+    )
+    await db.executemany("UPDATE notification_outbox SET next_at=? WHERE id=?", [(at, i) for i, at in deferred])
+    await db.commit()
+
+
+class NotificationSender:
+    """Drains notification_outbox at a bounded rate.
+
+    Network errors and 5xx are retried with exponential backoff, a 429 pauses
+    the sender for its retry_after, and users who blocked the bot are given
+    up on at once. Delivery is at-least-once: a crash mid-batch may resend
+    that batch.
+    """
+
+    def __init__(self, bot: Bot, db: aiosqlite.Connection, *, per_sec: float = 10.0, batch_size: int = 50):
+        self.bot = bot
+        self.db = db
+        self.per_sec = per_sec
+        self.batch_size = max(1, batch_size)
+        self._pacer = SendPacer(per_sec)
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.retry_after = 0
+        self.depth = 0
+        self.oldest_pending_at = 0
+        self._lag: Deque[float] = deque(maxlen=500)
+
+    async def start(self) -> None:
+        self.depth, self.oldest_pending_at = await pending_summary(self.db)
+        self._task = asyncio.create_task(self._worker())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def notify(self) -> None:
+        """Something was enqueued (and committed); don't wait for the next poll."""
+        self._wakeup.set()
+
+    async def _worker(self) -> None:
+        while True:
+            try:
+                batch = await due(self.db, int(time.time()), self.batch_size)
+                if batch:
+                    await self._drain(batch)
+                    continue
+                self.depth, self.oldest_pending_at = await pending_summary(self.db)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("outbox drain failed")
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), POLL_SEC)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _drain(self, batch: List[Notification]) -> None:
+        sent: List[int] = []
+        retry: List[Tuple[int, int, str]] = []
+        failed: List[Tuple[int, str]] = []
+        deferred: List[Tuple[int, int]] = []
+        for n in batch:
+            await self._pacer.wait()
+            try:
+                await self.bot.send_message(n.chat_id, n.text)
+            except asyncio.CancelledError:
+                raise
+            except TelegramRetryAfter as e:
+                self.retry_after += 1
+                self._pacer.pause(float(e.retry_after))
+                deferred.append((n.id, int(time.time()) + int(e.retry_after)))
+            except TelegramForbiddenError as e:
+                failed.append((n.id, str(e)))
+            except TelegramBadRequest as e:
+                # malformed text or a chat that's gone: retrying won't help
+                failed.append((n.id, str(e)))
+            except Exception as e:
+                if n.attempts + 1 >= MAX_ATTEMPTS:
+                    failed.append((n.id, str(e)))
+                else:
+                    retry.append((n.id, int(time.time()) + RETRY_BASE_SEC * 2**n.attempts, str(e)))
+            else:
+                sent.append(n.id)
+                self._lag.append(max(0, int(time.time()) - n.created_at))
+        await save_results(self.db, sent, retry, failed, deferred=deferred)
+        self.sent += len(sent)
+        self.retried += len(retry)
+        self.failed += len(failed)
+        if failed:
+            log.warning("outbox: gave up on %d notifications", len(failed))
+
+    def stats(self) -> dict:
+        lag = sorted(self._lag)
+        return {
+            "per_sec": self.per_sec,
+            "depth": self.depth,
+            "oldest_pending_age_sec": max(0, int(time.time()) - self.oldest_pending_at) if self.oldest_pending_at else 0,
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed,
+            "retry_after_429": self.retry_after,
+            "lag_p50_sec": lag[len(lag) // 2] if lag else 0,
+            "lag_p95_sec": lag[min(len(lag) - 1, int(0.95 * len(lag)))] if lag else 0,
+            "lag_max_sec": lag[-1] if lag else 0,
+        }
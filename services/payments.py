@@ -1,12 +1,21 @@
 from __future__ import annotations
 
+import asyncio
+import logging
 import time
 from dataclasses import dataclass
+from typing import Dict, Tuple
 
 import aiosqlite
 
 from services.crypto_pay import CryptoPayClient, Invoice
 from services import invoices as invoices_repo
+from services.metrics import INVOICES_ISSUED
+
+
+log = logging.getLogger("payments")
+
+INVOICE_TTL_SEC = 3600
 
 
 def invoice_payload(user_id: int, months: int) -> str:
@@ -28,7 +37,7 @@ async def create_subscription_invoice(
         asset="USDT",
         description=description,
         payload=payload,
-        expires_in=3600,
+        expires_in=INVOICE_TTL_SEC,
         allow_comments=False,
         allow_anonymous=True,
     )
@@ -42,5 +51,88 @@ async def create_subscription_invoice(
         status=inv.status,
         pay_url=inv.bot_invoice_url,
         raw=inv.raw,
+        expires_in=INVOICE_TTL_SEC,
     )
     return inv
+
+
+def _row_to_api_invoice(row: invoices_repo.InvoiceRow) -> Invoice:
+    return Invoice(
+        invoice_id=row.invoice_id,
+        status=row.status,
+        amount=f"{row.amount:.2f}",
+        asset=row.asset,
+        bot_invoice_url=row.pay_url,
+        payload=row.raw_json.get("payload"),
+        raw=row.raw_json,
+    )
+
+
+class InvoiceIssuer:
+    """Hands out a payment link for a plan tap, creating an invoice only when needed.
+
+    A user's active invoice for the same plan and price is reused while it has
+    at least `min_valid_sec` left, so double taps and back-and-forth through
+    the menu don't each cost a createInvoice call (and another active invoice
+    for the reconciler to poll). Concurrent taps for the same key share one
+    lookup/create.
+    """
+
+    def __init__(self, db: aiosqlite.Connection, cryptopay: CryptoPayClient, *, min_valid_sec: int = 600):
+        self.db = db
+        self.cryptopay = cryptopay
+        # don't hand out a link that dies while the user is still in the wallet app
+        self.min_valid_sec = max(0, min(min_valid_sec, INVOICE_TTL_SEC - 60))
+        self._inflight: Dict[Tuple[int, int, float], asyncio.Task] = {}
+        self.created = 0
+        self.reused = 0
+        self.coalesced = 0
+
+    async def issue(self, *, user_id: int, months: int, amount_usdt: float) -> Invoice:
+        key = (user_id, months, amount_usdt)
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._issue(user_id, months, amount_usdt))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.coalesced += 1
+            INVOICES_ISSUED.labels("coalesced").inc()
+        return await asyncio.shield(task)
+
+    async def _issue(self, user_id: int, months: int, amount_usdt: float) -> Invoice:
+        row = await invoices_repo.find_reusable(
+            self.db,
+            user_id=user_id,
+            months=months,
+            amount=amount_usdt,
+            asset="USDT",
+            valid_after=int(time.time()) + self.min_valid_sec,
+        )
+        if row is not None and row.pay_url:
+            self.reused += 1
+            INVOICES_ISSUED.labels("reused").inc()
+            log.debug("reusing invoice %s for user %s", row.invoice_id, user_id)
+            return _row_to_api_invoice(row)
+
+        inv = await create_subscription_invoice(
+            self.db,
+            self.cryptopay,
+            user_id=user_id,
+            months=months,
+            amount_usdt=amount_usdt,
+        )
+        self.created += 1
+        INVOICES_ISSUED.labels("created").inc()
+        return inv
+
+    def stats(self) -> dict:
+        avoided = self.reused + self.coalesced
+        requested = avoided + self.created
+        return {
+            "created": self.created,
+            "reused": self.reused,
+            "coalesced": self.coalesced,
+            "api_calls_avoided": avoided,
+            "reuse_ratio": round(avoided / requested, 3) if requested else 0.0,
+        }
@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from types import CodeType, FrameType
+from typing import Dict, List, Optional, Tuple
+
+
+# Sampling from a side thread: sys._current_frames() is a snapshot taken
+# under the GIL, so the profiled loop runs unmodified (no settrace, no
+# signal handlers interrupting syscalls) and only pays for one GIL hand-off
+# per sample.
+
+MAX_SECONDS = 60
+DEFAULT_INTERVAL = 0.005
+MAX_DEPTH = 128
+
+# where an idle event loop sits (uvloop waits in C, so its top Python frame
+# is asyncio.run itself); reported apart so the table shows busy time
+_IDLE_FRAMES = {("selectors.py", "select"), ("selectors.py", "poll"), ("runners.py", "run")}
+
+
+class ProfilerBusy(RuntimeError):
+    pass
+
+
+@dataclass
+class Profile:
+    seconds: float
+    interval: float
+    samples: int = 0
+    idle: int = 0
+    stacks: Counter = field(default_factory=Counter)
+
+    def collapsed(self) -> str:
+        """Brendan Gregg's folded format: `root;...;leaf count` per line,
+        ready for flamegraph.pl, speedscope or inferno."""
+        return "".join(f"{stack} {n}\n" for stack, n in self.stacks.most_common())
+
+    def top(self, n: int = 20) -> List[Tuple[str, int, int]]:
+        """(function, self samples, total samples), hottest self time first."""
+        own: Counter = Counter()
+        total: Counter = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            own[frames[-1]] += count
+            for f in set(frames):
+                total[f] += count
+        return [(f, c, total[f]) for f, c in own.most_common(n)]
+
+    def top_table(self, n: int = 20) -> str:
+        busy = max(1, self.samples - self.idle)
+        lines = [
+            f"{self.samples} samples over {self.seconds:.1f}s every {self.interval * 1000:.1f} ms, "
+            f"loop idle {100 * self.idle / max(1, self.samples):.0f}%",
+            f"{'self%':>6} {'total%':>7}  function",
+        ]
+        for func, own, total in self.top(n):
+            lines.append(f"{100 * own / busy:>6.1f} {100 * total / busy:>7.1f}  {func}")
+        return "\n".join(lines)
+
+
+def _label(frame: FrameType) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _is_idle(frame: FrameType) -> bool:
+    return (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in _IDLE_FRAMES
+
+
+class _Sampler(threading.Thread):
+    def __init__(self, target: int, interval: float, profile: Profile):
+        super().__init__(name="profiler", daemon=True)
+        self.target = target
+        self.interval = interval
+        self.profile = profile
+        self.stop = threading.Event()
+
+    def run(self) -> None:
+        labels: Dict[CodeType, str] = {}
+        while not self.stop.wait(self.interval):
+            frame: Optional[FrameType] = sys._current_frames().get(self.target)
+            if frame is None:
+                continue
+            self.profile.samples += 1
+            if _is_idle(frame):
+                self.profile.idle += 1
+                continue
+            stack: List[str] = []
+            while frame is not None and len(stack) < MAX_DEPTH:
+                label = labels.get(frame.f_code)
+                if label is None:
+                    label = labels[frame.f_code] = _label(frame)
+                stack.append(label)
+                frame = frame.f_back
+            stack.reverse()
+            self.profile.stacks[";".join(stack)] += 1
+
+
+class SamplingProfiler:
+    """Profiles the event loop thread of this process on demand, one run at a time."""
+
+    def __init__(self, *, interval: float = DEFAULT_INTERVAL):
+        self.interval = interval
+        self._running = False
+        self.runs = 0
+        self.last_run_at = 0
+
+    async def run(self, seconds: float) -> Profile:
+        if self._running:
+            raise ProfilerBusy("a profile is already being taken")
+        seconds = max(1.0, min(float(seconds), MAX_SECONDS))
+        self._running = True
+        profile = Profile(seconds=seconds, interval=self.interval)
+        sampler = _Sampler(threading.get_ident(), self.interval, profile)
+        try:
+            sampler.start()
+            # the loop keeps serving updates meanwhile; that's what gets sampled
+            await asyncio.sleep(seconds)
+        finally:
+            sampler.stop.set()
+            await asyncio.to_thread(sampler.join)
+            self._running = False
+            self.runs += 1
+            self.last_run_at = int(time.time())
+        return profile
+
+    def stats(self) -> dict:
+        return {"running": self._running, "runs": self.runs, "last_run_at": self.last_run_at}
@@ -0,0 +1,190 @@
+from __future__ import annotations
+
+import logging
+import time
+from collections import deque
+from datetime import datetime
+from typing import Deque, Dict, List
+
+import aiosqlite
+
+from bot import texts
+from services import invoices as invoices_repo
+from services import outbox
+from services.crypto_pay import CryptoPayClient
+from services.db import transaction
+from services.invoices import StatusChange
+from services.jobs import settle_paid_invoice
+from services.metrics import INVOICE_STATUS, JOB_RUN, timed
+from services.outbox import NotificationSender
+
+
+log = logging.getLogger("reconciler")
+
+
+def _provider_paid_at(raw: dict) -> int:
+    """CryptoPay's paid_at (ISO 8601) as a unix ts, 0 if absent."""
+    value = raw.get("paid_at")
+    if not value:
+        return 0
+    try:
+        return int(datetime.fromisoformat(str(value).replace("Z", "+00:00")).timestamp())
+    except ValueError:
+        return 0
+
+
+class InvoiceReconciler:
+    """Brings local invoice statuses in line with CryptoPay when webhooks get lost.
+
+    Each sweep first expires overdue invoices locally (expires_at + grace,
+    no API call), then walks every remaining active invoice with keyset
+    pagination, one getInvoices call per page, and applies the page's status
+    changes, with their premium grants and notifications, in a single
+    transaction.
+    """
+
+    def __init__(
+        self,
+        db: aiosqlite.Connection,
+        cryptopay: CryptoPayClient,
+        *,
+        sender: NotificationSender | None = None,
+        batch_size: int = 100,
+        expiry_grace_sec: int = 600,
+    ):
+        self.db = db
+        self.cryptopay = cryptopay
+        self.sender = sender
+        self.batch_size = max(1, min(1000, batch_size))
+        # an invoice paid in its last seconds still gets polled before we give up on it
+        self.expiry_grace_sec = expiry_grace_sec
+        self.sweeps = 0
+        self.checked = 0
+        self.api_calls = 0
+        self.api_errors = 0
+        self.paid = 0
+        self.expired_remote = 0
+        self.expired_local = 0
+        self.last_sweep_at = 0
+        self.last_sweep_ms = 0.0
+        self.oldest_active_age = 0
+        # provider paid_at -> applied here, for invoices whose webhook never arrived
+        self._paid_lag: Deque[float] = deque(maxlen=500)
+
+    @timed(JOB_RUN, "invoice_reconcile")
+    async def run(self) -> None:
+        started = time.monotonic()
+        now = int(time.time())
+        try:
+            await self._expire_overdue(now)
+            await self._sweep()
+        finally:
+            self.sweeps += 1
+            self.last_sweep_at = now
+            self.last_sweep_ms = round((time.monotonic() - started) * 1000, 1)
+            oldest = await invoices_repo.oldest_active_created_at(self.db)
+            self.oldest_active_age = max(0, int(time.time()) - oldest) if oldest else 0
+
+    async def _expire_overdue(self, now: int) -> None:
+        before = now - self.expiry_grace_sec
+        while True:
+            rows = await invoices_repo.overdue(self.db, before, self.batch_size)
+            if not rows:
+                return
+            async with transaction(self.db):
+                changed = set(
+                    await invoices_repo.apply_status_changes(
+                        self.db,
+                        [StatusChange(r.invoice_id, "expired", paid_at=r.paid_at) for r in rows],
+                        commit=False,
+                    )
+                )
+                for r in rows:
+                    if r.invoice_id in changed:
+                        await self._enqueue_expired(r.user_id)
+            self.expired_local += len(changed)
+            INVOICE_STATUS.labels("expired").inc(len(changed))
+            self._wake_sender(changed)
+
+    async def _sweep(self) -> None:
+        after = None
+        while True:
+            page = await invoices_repo.active_page(self.db, after, self.batch_size)
+            if not page:
+                return
+            after = (page[-1].created_at, page[-1].invoice_id)
+            await self._reconcile_page(page)
+            if len(page) < self.batch_size:
+                return
+
+    async def _reconcile_page(self, page: List[invoices_repo.InvoiceRow]) -> None:
+        by_id: Dict[int, invoices_repo.InvoiceRow] = {r.invoice_id: r for r in page}
+        self.api_calls += 1
+        try:
+            items = await self.cryptopay.get_invoices(invoice_ids=list(by_id), count=len(by_id))
+        except Exception:
+            self.api_errors += 1
+            log.exception("getInvoices failed for %d invoices", len(by_id))
+            return
+        self.checked += len(by_id)
+
+        now = int(time.time())
+        changes = [
+            StatusChange(
+                inv.invoice_id,
+                inv.status,
+                paid_at=now if inv.status == "paid" else by_id[inv.invoice_id].paid_at,
+                raw=inv.raw,
+            )
+            for inv in items
+            if inv.invoice_id in by_id and inv.status in ("paid", "expired")
+        ]
+        if not changes:
+            return
+        async with transaction(self.db):
+            changed = set(await invoices_repo.apply_status_changes(self.db, changes, commit=False))
+            for c in changes:
+                if c.invoice_id not in changed:
+                    continue
+                row = by_id[c.invoice_id]
+                if c.status == "paid":
+                    await settle_paid_invoice(self.db, row)
+                else:
+                    await self._enqueue_expired(row.user_id)
+
+        for c in changes:
+            if c.invoice_id not in changed:
+                continue
+            INVOICE_STATUS.labels(c.status).inc()
+            if c.status == "paid":
+                self.paid += 1
+                provider_at = _provider_paid_at(c.raw or {})
+                if provider_at:
+                    self._paid_lag.append(max(0, now - provider_at))
+            else:
+                self.expired_remote += 1
+        self._wake_sender(changed)
+
+    async def _enqueue_expired(self, user_id: int) -> None:
+        await outbox.enqueue(self.db, user_id, texts.PAYMENT_EXPIRED, kind=outbox.KIND_PAYMENT_EXPIRED, commit=False)
+
+    def _wake_sender(self, changed: set) -> None:
+        if changed and self.sender is not None:
+            self.sender.notify()
+
+    def stats(self) -> dict:
+        lag = sorted(self._paid_lag)
+        return {
+            "sweeps": self.sweeps,
+            "last_sweep_at": self.last_sweep_at,
+            "last_sweep_ms": self.last_sweep_ms,
+            "checked": self.checked,
+            "api_calls": self.api_calls,
+            "api_errors": self.api_errors,
+            "paid": self.paid,
+            "expired_remote": self.expired_remote,
+            "expired_local": self.expired_local,
+            "oldest_active_age_sec": self.oldest_active_age,
+            "paid_lag_p50_sec": lag[len(lag) // 2] if lag else 0,
+            "paid_lag_max_sec": lag[-1] if lag else 0,
+        }
@@ -1,10 +1,16 @@
 from __future__ import annotations
 
-import time
+import logging
 from dataclasses import dataclass
+from typing import Dict, Iterable, List, Tuple
 
 import aiosqlite
 
+from services.metrics import db_timed
+
+
+log = logging.getLogger("referrals")
+
 
 @dataclass
 class RefStats:
@@ -12,15 +18,79 @@ class RefStats:
     premium: int
 
 
+@db_timed
 async def get_ref_stats(db: aiosqlite.Connection, user_id: int) -> RefStats:
-    async with db.execute("SELECT COUNT(*) AS c FROM users WHERE referrer_id = ?", (user_id,)) as cur:
-        total = int((await cur.fetchone())["c"])
+    """One primary-key read of the counters maintained below."""
+    async with db.execute("SELECT total, premium FROM referral_stats WHERE user_id = ?", (user_id,)) as cur:
+        r = await cur.fetchone()
+    if not r:
+        return RefStats(total=0, premium=0)
+    return RefStats(total=int(r["total"]), premium=int(r["premium"]))
+
+
+@db_timed
+async def bump(
+    db: aiosqlite.Connection,
+    referrer_id: int,
+    *,
+    total: int = 0,
+    premium: int = 0,
+) -> None:
+    """Adjust a referrer's counters; no commit, it rides on the caller's transaction."""
+    await db.execute("INSERT OR IGNORE INTO referral_stats(user_id) VALUES(?)", (referrer_id,))
+    await db.execute(
+        "UPDATE referral_stats SET total = MAX(total + ?, 0), premium = MAX(premium + ?, 0) WHERE user_id = ?",
+        (total, premium, referrer_id),
+    )
+
 
-    now = int(time.time())
+@db_timed
+async def bump_premium_many(db: aiosqlite.Connection, referrer_ids: Iterable[int | None], delta: int) -> None:
+    """Premium started/ended for several referees at once (grouped per referrer)."""
+    per_referrer: Dict[int, int] = {}
+    for r in referrer_ids:
+        if r is not None:
+            per_referrer[r] = per_referrer.get(r, 0) + delta
+    for referrer_id, d in per_referrer.items():
+        await bump(db, referrer_id, premium=d)
+
+
+async def _actual(db: aiosqlite.Connection) -> Dict[int, Tuple[int, int]]:
     async with db.execute(
-        "SELECT COUNT(*) AS c FROM users WHERE referrer_id = ? AND plan='premium' AND premium_until > ?",
-        (user_id, now),
+        """
+        SELECT referrer_id, COUNT(*) AS total, SUM(plan = 'premium') AS premium
+        FROM users WHERE referrer_id IS NOT NULL
+        GROUP BY referrer_id
+        """
     ) as cur:
-        premium = int((await cur.fetchone())["c"])
+        return {int(r["referrer_id"]): (int(r["total"]), int(r["premium"] or 0)) for r in await cur.fetchall()}
+
+
+@db_timed
+async def check_ref_stats(db: aiosqlite.Connection, *, fix: bool = False) -> List[Tuple[int, Tuple[int, int], Tuple[int, int]]]:
+    """Compare the counters with a full recount.
+
+    Returns (referrer_id, stored, actual) for every mismatch; with fix=True
+    the stored rows are overwritten with the recount. A full scan: meant for
+    an off-peak job, never the request path.
+    """
+    actual = await _actual(db)
+    async with db.execute("SELECT user_id, total, premium FROM referral_stats") as cur:
+        stored = {int(r["user_id"]): (int(r["total"]), int(r["premium"])) for r in await cur.fetchall()}
+
+    mismatches = []
+    for referrer_id in set(actual) | set(stored):
+        want = actual.get(referrer_id, (0, 0))
+        have = stored.get(referrer_id, (0, 0))
+        if want != have:
+            mismatches.append((referrer_id, have, want))
 
-    return RefStats(total=total, premium=premium)
+    if mismatches:
+        log.warning("referral_stats: %d mismatched referrers", len(mismatches))
+        if fix:
+            await db.executemany(
+                "INSERT OR REPLACE INTO referral_stats(user_id, total, premium) VALUES(?, ?, ?)",
+                [(referrer_id, want[0], want[1]) for referrer_id, _, want in mismatches],
+            )
+            await db.commit()
+    return mismatches
@@ -2,10 +2,13 @@ from __future__ import annotations
 
 import time
 from dataclasses import dataclass
+from typing import List, Sequence, Tuple
 
 import aiosqlite
 
+from services import referrals as refs_repo
 from services import users as users_repo
+from services.metrics import db_timed
 
 
 def months_to_seconds(months: int) -> int:
@@ -14,22 +17,99 @@ def months_to_seconds(months: int) -> int:
     return months * 30 * 24 * 3600
 
 
-async def activate_premium(db: aiosqlite.Connection, user_id: int, months: int) -> int:
+@db_timed
+async def activate_premium(db: aiosqlite.Connection, user_id: int, months: int, *, commit: bool = True) -> int:
     seconds = months_to_seconds(months)
-    return await users_repo.add_premium(db, user_id, seconds)
+    return await users_repo.add_premium(db, user_id, seconds, commit=commit)
 
 
-async def downgrade_expired(db: aiosqlite.Connection) -> int:
-    now = int(time.time())
+@db_timed
+async def upcoming_expiries(db: aiosqlite.Connection, until: int, limit: int) -> List[Tuple[int, int]]:
+    """(user_id, premium_until) of premium users expiring by `until`, soonest first."""
     async with db.execute(
-        "SELECT user_id FROM users WHERE plan='premium' AND premium_until <= ?",
-        (now,),
+        """
+        SELECT user_id, premium_until FROM users
+        WHERE plan='premium' AND premium_until <= ?
+        ORDER BY premium_until
+        LIMIT ?
+        """,
+        (until, limit),
+    ) as cur:
+        return [(int(r["user_id"]), int(r["premium_until"])) for r in await cur.fetchall()]
+
+
+@db_timed
+async def upcoming_reminders(db: aiosqlite.Connection, after: int, until: int, limit: int) -> List[Tuple[int, int]]:
+    """(user_id, premium_until) expiring in (after, until] that haven't been reminded for that date."""
+    async with db.execute(
+        """
+        SELECT user_id, premium_until FROM users
+        WHERE plan='premium' AND premium_until > ? AND premium_until <= ?
+          AND renewal_reminded_until != premium_until
+        ORDER BY premium_until
+        LIMIT ?
+        """,
+        (after, until, limit),
+    ) as cur:
+        return [(int(r["user_id"]), int(r["premium_until"])) for r in await cur.fetchall()]
+
+
+@db_timed
+async def downgrade_expired(
+    db: aiosqlite.Connection,
+    user_ids: Sequence[int],
+    *,
+    now: int | None = None,
+    commit: bool = True,
+) -> List[int]:
+    """Downgrade those of `user_ids` whose premium has run out, in one statement.
+
+    Users who renewed since they were scheduled are left alone.
+    """
+    if not user_ids:
+        return []
+    now = int(time.time()) if now is None else now
+    marks = ",".join("?" * len(user_ids))
+    async with db.execute(
+        f"""
+        SELECT user_id, referrer_id FROM users
+        WHERE user_id IN ({marks}) AND plan='premium' AND premium_until <= ?
+        """,
+        (*user_ids, now),
     ) as cur:
         rows = await cur.fetchall()
+    expired = [int(r["user_id"]) for r in rows]
+    if expired:
+        marks = ",".join("?" * len(expired))
+        await db.execute(
+            f"UPDATE users SET plan='basic', premium_until=0 WHERE user_id IN ({marks}) AND premium_until <= ?",
+            (*expired, now),
+        )
+        await refs_repo.bump_premium_many(db, [r["referrer_id"] for r in rows], -1)
+    if commit:
+        await db.commit()
+    return expired
 
-    count = 0
-    for r in rows:
-        await users_repo.set_plan(db, int(r["user_id"]), "basic", 0)
-        count += 1
 
-    return count
+@db_timed
+async def mark_reminded(
+    db: aiosqlite.Connection,
+    reminders: Sequence[Tuple[int, int]],
+    *,
+    commit: bool = True,
+) -> List[int]:
+    """Record (user_id, premium_until) reminders; returns users still on that premium_until."""
+    out: List[int] = []
+    for user_id, until in reminders:
+        cur = await db.execute(
+            """
+            UPDATE users SET renewal_reminded_until=?
+            WHERE user_id=? AND plan='premium' AND premium_until=? AND renewal_reminded_until != ?
+            """,
+            (until, user_id, until, until),
+        )
+        if cur.rowcount:
+            out.append(user_id)
+    if commit:
+        await db.commit()
+    return out
@@ -0,0 +1,392 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import functools
+import json
+import os
+import random
+import sys
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, TypeVar
+
+
+# Tail-sampled tracing: every update records its spans in memory (a few
+# microseconds each); when the root span ends the trace is kept if it was
+# slow, failed, or won the sample_rate coin toss, and written as one JSON
+# line. Spans travel with the asyncio context, so tasks created inside a
+# handler land in its trace too.
+
+
+@dataclass
+class Span:
+    id: int
+    parent: int
+    name: str
+    start: float  # perf_counter
+    end: float = 0.0
+    attrs: Optional[Dict[str, Any]] = None
+    error: str = ""
+
+    def set(self, **attrs: Any) -> None:
+        if self.attrs is None:
+            self.attrs = {}
+        self.attrs.update(attrs)
+
+
+class _Trace:
+    __slots__ = ("trace_id", "wall_start", "spans", "closed")
+
+    def __init__(self) -> None:
+        self.trace_id = f"{random.getrandbits(64):016x}"
+        self.wall_start = time.time()
+        self.spans: List[Span] = []
+        self.closed = False
+
+
+class _NoopSpan:
+    id = 0
+
+    def set(self, **attrs: Any) -> None:
+        pass
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, *exc: Any) -> bool:
+        return False
+
+
+_NOOP = _NoopSpan()
+
+_trace: ContextVar[Optional[_Trace]] = ContextVar("trace", default=None)
+_span: ContextVar[Optional[Span]] = ContextVar("span", default=None)
+
+
+class _Sink:
+    """Where kept traces go; off until configure() gets a path."""
+
+    def __init__(self) -> None:
+        self.path = ""
+        self.sample_rate = 0.0
+        self.slow_sec = 3.0
+        self.max_bytes = 0
+        self._fd = -1
+        self.finished = 0
+        self.kept = 0
+        self.kept_slow = 0
+        self.write_errors = 0
+
+    def keep(self, duration: float, failed: bool) -> bool:
+        if failed:
+            return True
+        if duration >= self.slow_sec:
+            self.kept_slow += 1
+            return True
+        return random.random() < self.sample_rate
+
+    def write(self, line: bytes) -> None:
+        try:
+            if self._fd < 0:
+                self._open()
+            elif self.max_bytes and os.fstat(self._fd).st_size + len(line) > self.max_bytes:
+                self._rotate()
+            # one O_APPEND write per trace: lines from several processes don't interleave
+            os.write(self._fd, line)
+        except OSError:
+            self.write_errors += 1
+
+    def _open(self) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o640)
+
+    def _rotate(self) -> None:
+        os.close(self._fd)
+        self._fd = -1
+        try:
+            # another process may have rotated already; then just reopen
+            if os.path.getsize(self.path) >= self.max_bytes:
+                os.replace(self.path, self.path + ".1")
+        except OSError:
+            pass
+        self._open()
+
+
+_sink = _Sink()
+
+
+def configure(path: str, *, sample_rate: float = 0.01, slow_ms: int = 3000, max_mb: int = 50) -> None:
+    _sink.path = path
+    _sink.sample_rate = max(0.0, min(1.0, sample_rate))
+    _sink.slow_sec = slow_ms / 1000
+    _sink.max_bytes = max(0, max_mb) * 1024 * 1024
+
+
+def stats() -> dict:
+    return {
+        "enabled": bool(_sink.path),
+        "finished": _sink.finished,
+        "kept": _sink.kept,
+        "kept_slow": _sink.kept_slow,
+        "write_errors": _sink.write_errors,
+    }
+
+
+class _SpanCtx:
+    __slots__ = ("trace", "name", "attrs", "bind", "span", "token")
+
+    def __init__(self, trace: _Trace, name: str, attrs: Dict[str, Any], bind: bool) -> None:
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+        self.bind = bind
+        self.token = None
+
+    def __enter__(self) -> Span:
+        parent = _span.get()
+        s = Span(len(self.trace.spans) + 1, parent.id if parent else 0, self.name, time.perf_counter(), attrs=self.attrs or None)
+        self.trace.spans.append(s)
+        self.span = s
+        if self.bind:
+            self.token = _span.set(s)
+        return s
+
+    def __exit__(self, et: Any, e: Any, tb: Any) -> bool:
+        self.span.end = time.perf_counter()
+        if e is not None and not isinstance(e, (asyncio.CancelledError, GeneratorExit)):
+            self.span.error = type(e).__name__
+        if self.token is not None:
+            _span.reset(self.token)
+        return False
+
+
+def span(name: str, *, bind: bool = True, **attrs: Any) -> Any:
+    """A child of the current span; a no-op outside a trace.
+
+    bind=False records the span without making it the parent of what runs
+    meanwhile: for async generators, whose body interleaves with the consumer.
+    """
+    tr = _trace.get()
+    if tr is None or tr.closed:
+        return _NOOP
+    return _SpanCtx(tr, name, attrs, bind)
+
+
+class _TraceCtx:
+    __slots__ = ("attrs", "name", "trace", "root", "tokens")
+
+    def __init__(self, name: str, attrs: Dict[str, Any]) -> None:
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self) -> Span:
+        self.trace = _Trace()
+        self.root = Span(1, 0, self.name, time.perf_counter(), attrs=self.attrs or None)
+        self.trace.spans.append(self.root)
+        self.tokens = (_trace.set(self.trace), _span.set(self.root))
+        return self.root
+
+    def __exit__(self, et: Any, e: Any, tb: Any) -> bool:
+        root = self.root
+        root.end = time.perf_counter()
+        if e is not None and not isinstance(e, asyncio.CancelledError):
+            root.error = type(e).__name__
+        _span.reset(self.tokens[1])
+        _trace.reset(self.tokens[0])
+        self.trace.closed = True
+        _sink.finished += 1
+        failed = any(s.error for s in self.trace.spans)
+        if _sink.keep(root.end - root.start, failed):
+            _sink.kept += 1
+            _sink.write(_encode(self.trace))
+        return False
+
+
+def trace(name: str, **attrs: Any) -> Any:
+    """Root span of a new trace (an update, a background job)."""
+    if not _sink.path:
+        return _NOOP
+    return _TraceCtx(name, attrs)
+
+
+def current() -> Optional[Span]:
+    tr = _trace.get()
+    return None if tr is None or tr.closed else _span.get()
+
+
+class _Attach:
+    __slots__ = ("trace", "span", "tokens")
+
+    def __init__(self, trace: Optional[_Trace], span: Optional[Span]) -> None:
+        self.trace = trace
+        self.span = span
+
+    def __enter__(self) -> None:
+        self.tokens = (_trace.set(self.trace), _span.set(self.span))
+
+    def __exit__(self, *exc: Any) -> bool:
+        _span.reset(self.tokens[1])
+        _trace.reset(self.tokens[0])
+        return False
+
+
+def capture() -> Any:
+    """The current trace position, to resume it from a task started elsewhere."""
+    return (_trace.get(), _span.get())
+
+
+def attach(captured: Any) -> _Attach:
+    return _Attach(*captured)
+
+
+F = TypeVar("F", bound=Callable[..., Awaitable[Any]])
+
+
+def traced(name: str) -> Callable[[F], F]:
+    def deco(fn: F) -> F:
+        @functools.wraps(fn)
+        async def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with span(name):
+                return await fn(*args, **kwargs)
+
+        return wrapper  # type: ignore[return-value]
+
+    return deco
+
+
+def _encode(tr: _Trace) -> bytes:
+    t0 = tr.spans[0].start
+    spans = []
+    for s in tr.spans:
+        end = s.end or time.perf_counter()
+        d: Dict[str, Any] = {
+            "id": s.id,
+            "parent": s.parent,
+            "name": s.name,
+            "start_ms": round((s.start - t0) * 1000, 2),
+            "dur_ms": round((end - s.start) * 1000, 2),
+        }
+        if s.attrs:
+            d["attrs"] = s.attrs
+        if s.error:
+            d["error"] = s.error
+        if not s.end:
+            d["unfinished"] = True
+        spans.append(d)
+    line = {
+        "trace_id": tr.trace_id,
+        "ts": round(tr.wall_start, 3),
+        "name": tr.spans[0].name,
+        "dur_ms": spans[0]["dur_ms"],
+        "attrs": tr.spans[0].attrs or {},
+        "spans": spans,
+    }
+    return (json.dumps(line, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+
+
+# --- CLI: python -m services.tracing <trace_id> ---
+
+
+def _read(path: str) -> Iterator[dict]:
+    for p in (path + ".1", path):
+        if not os.path.exists(p):
+            continue
+        with open(p, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+def critical_path(spans: List[dict]) -> List[tuple[dict, int]]:
+    """(span, depth) along the chain that determined the root's end time.
+
+    From a span's end, walk back through its children: the child that
+    finished last is on the path, then whichever finished last before that
+    one started, and so on.
+    """
+    children: Dict[int, List[dict]] = {}
+    for s in spans:
+        children.setdefault(s["parent"], []).append(s)
+
+    out: List[tuple[dict, int]] = []
+
+    def walk(s: dict, depth: int) -> None:
+        out.append((s, depth))
+        cursor = s["start_ms"] + s["dur_ms"]
+        chain = []
+        for c in sorted(children.get(s["id"], []), key=lambda c: c["start_ms"] + c["dur_ms"], reverse=True):
+            if c["start_ms"] + c["dur_ms"] <= cursor + 0.01:
+                chain.append(c)
+                cursor = c["start_ms"]
+        for c in reversed(chain):
+            walk(c, depth + 1)
+
+    roots = children.get(0, [])
+    if roots:
+        walk(roots[0], 0)
+    return out
+
+
+def _fmt_attrs(s: dict) -> str:
+    parts = [f"{k}={v}" for k, v in (s.get("attrs") or {}).items()]
+    if s.get("error"):
+        parts.append(f"error={s['error']}")
+    return ("  " + " ".join(parts)) if parts else ""
+
+
+def _print_trace(t: dict, *, tree: bool) -> None:
+    when = datetime.fromtimestamp(t["ts"]).strftime("%Y-%m-%d %H:%M:%S")
+    total = t["dur_ms"] or 1.0
+    print(f"trace {t['trace_id']}  {t['name']}  {when}  {t['dur_ms']:.1f} ms{_fmt_attrs(t)}")
+    print()
+    print("critical path:")
+    print(f"{'start':>10} {'dur':>10} {'share':>7}  span")
+    for s, depth in critical_path(t["spans"]):
+        print(
+            f"{s['start_ms']:>8.1f}ms {s['dur_ms']:>8.1f}ms {100 * s['dur_ms'] / total:>6.1f}%  "
+            f"{'  ' * depth}{s['name']}{_fmt_attrs(s)}"
+        )
+    if tree:
+        print()
+        print("all spans:")
+        depth_of: Dict[int, int] = {0: -1}
+        for s in sorted(t["spans"], key=lambda s: (s["start_ms"], s["id"])):
+            depth_of[s["id"]] = depth_of.get(s["parent"], -1) + 1
+            print(f"{s['start_ms']:>8.1f}ms {s['dur_ms']:>8.1f}ms  {'  ' * depth_of[s['id']]}{s['name']}{_fmt_attrs(s)}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    p = argparse.ArgumentParser(description="Show the critical path of a recorded trace")
+    p.add_argument("trace_id", nargs="?", help="trace to show (omit to list recent traces)")
+    p.add_argument("--file", default=os.environ.get("TRACE_FILE", "data/traces.jsonl"))
+    p.add_argument("--user", type=int, help="list traces of this user_id")
+    p.add_argument("--slowest", type=int, default=0, help="list the N slowest traces")
+    p.add_argument("--tree", action="store_true", help="also print every span")
+    args = p.parse_args(argv)
+
+    if args.trace_id:
+        for t in _read(args.file):
+            if t.get("trace_id") == args.trace_id:
+                _print_trace(t, tree=args.tree)
+                return 0
+        print(f"trace {args.trace_id} not found in {args.file}", file=sys.stderr)
+        return 1
+
+    traces = [t for t in _read(args.file) if args.user is None or (t.get("attrs") or {}).get("user_id") == args.user]
+    if args.slowest:
+        traces = sorted(traces, key=lambda t: t["dur_ms"], reverse=True)[: args.slowest]
+    else:
+        traces = traces[-20:]
+    for t in traces:
+        when = datetime.fromtimestamp(t["ts"]).strftime("%Y-%m-%d %H:%M:%S")
+        print(f"{t['trace_id']}  {when}  {t['dur_ms']:>9.1f} ms  {t['name']}{_fmt_attrs(t)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -8,6 +8,9 @@ from typing import Any, Optional
 
 import aiosqlite
 
+from services import referrals as refs_repo
+from services.metrics import db_timed
+
 
 def _base36(n: int) -> str:
     chars = "0123456789abcdefghijklmnopqrstuvwxyz"
@@ -42,12 +45,16 @@ class User:
     ref_code: str
     referrer_id: Optional[int]
     checkin_enabled: bool
+    long_memory_upto: int = 0
+    tz: str = ""
+    checkin_next_at: int = 0
 
     @property
     def is_premium(self) -> bool:
         return self.plan == "premium" and self.premium_until > int(time.time())
 
 
+@db_timed
 async def ensure_user(
     db: aiosqlite.Connection,
     user_id: int,
@@ -69,10 +76,13 @@ async def ensure_user(
         """,
         (user_id, now, now, ref_code, referrer_id),
     )
+    if referrer_id is not None:
+        await refs_repo.bump(db, referrer_id, total=1)
     await db.commit()
     return await get_user(db, user_id)  # type: ignore[return-value]
 
 
+@db_timed
 async def get_user(db: aiosqlite.Connection, user_id: int) -> Optional[User]:
     async with db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)) as cur:
         row = await cur.fetchone()
@@ -98,28 +108,39 @@ async def get_user(db: aiosqlite.Connection, user_id: int) -> Optional[User]:
             ref_code=row["ref_code"],
             referrer_id=row["referrer_id"],
             checkin_enabled=bool(row["checkin_enabled"]),
+            long_memory_upto=int(row["long_memory_upto"]) if "long_memory_upto" in row.keys() else 0,
+            tz=row["tz"] if "tz" in row.keys() else "",
+            checkin_next_at=int(row["checkin_next_at"]) if "checkin_next_at" in row.keys() else 0,
         )
 
 
+@db_timed
 async def touch_user(db: aiosqlite.Connection, user_id: int) -> None:
-    await db.execute("UPDATE users SET last_seen = strftime('%s','now') WHERE user_id = ?", (user_id,))
+    # writing to the bot again means it's no longer blocked
+    await db.execute("UPDATE users SET last_seen = strftime('%s','now'), blocked = 0 WHERE user_id = ?", (user_id,))
     await db.commit()
 
 
+@db_timed
 async def set_mode(db: aiosqlite.Connection, user_id: int, mode: str) -> None:
     await db.execute("UPDATE users SET mode = ? WHERE user_id = ?", (mode, user_id))
     await db.commit()
 
 
+@db_timed
 async def set_plan(db: aiosqlite.Connection, user_id: int, plan: str, premium_until: int = 0) -> None:
+    u = await get_user(db, user_id)
     await db.execute(
         "UPDATE users SET plan = ?, premium_until = ? WHERE user_id = ?",
         (plan, premium_until, user_id),
     )
+    if u and u.referrer_id is not None and (u.plan == "premium") != (plan == "premium"):
+        await refs_repo.bump(db, u.referrer_id, premium=1 if plan == "premium" else -1)
     await db.commit()
 
 
-async def add_premium(db: aiosqlite.Connection, user_id: int, seconds: int) -> int:
+@db_timed
+async def add_premium(db: aiosqlite.Connection, user_id: int, seconds: int, *, commit: bool = True) -> int:
     now = int(time.time())
     u = await get_user(db, user_id)
     current = (u.premium_until if u else 0)
@@ -129,23 +150,36 @@ async def add_premium(db: aiosqlite.Connection, user_id: int, seconds: int) -> i
         "UPDATE users SET plan='premium', premium_until=? WHERE user_id=?",
         (new_until, user_id),
     )
-    await db.commit()
+    if u and u.referrer_id is not None and u.plan != "premium":
+        await refs_repo.bump(db, u.referrer_id, premium=1)
+    if commit:
+        await db.commit()
     return new_until
 
 
+@db_timed
 async def toggle_checkin(db: aiosqlite.Connection, user_id: int) -> bool:
     u = await get_user(db, user_id)
     new_val = 0 if (u and u.checkin_enabled) else 1
-    await db.execute("UPDATE users SET checkin_enabled=? WHERE user_id=?", (new_val, user_id))
+    # checkin_next_at=0: the scheduler picks the next slot on its next tick
+    await db.execute("UPDATE users SET checkin_enabled=?, checkin_next_at=0 WHERE user_id=?", (new_val, user_id))
     await db.commit()
     return bool(new_val)
 
 
+@db_timed
+async def set_timezone(db: aiosqlite.Connection, user_id: int, tz: str) -> None:
+    await db.execute("UPDATE users SET tz=?, checkin_next_at=0 WHERE user_id=?", (tz, user_id))
+    await db.commit()
+
+
+@db_timed
 async def bump_trial_used(db: aiosqlite.Connection, user_id: int, by: int = 1) -> None:
     await db.execute("UPDATE users SET trial_used = trial_used + ? WHERE user_id=?", (by, user_id))
     await db.commit()
 
 
+@db_timed
 async def set_daily_usage(db: aiosqlite.Connection, user_id: int, *, daily_used: int, daily_date: str) -> None:
     await db.execute(
         "UPDATE users SET daily_used=?, daily_date=? WHERE user_id=?",
@@ -154,17 +188,34 @@ async def set_daily_usage(db: aiosqlite.Connection, user_id: int, *, daily_used:
     await db.commit()
 
 
+@db_timed
 async def set_style(db: aiosqlite.Connection, user_id: int, style: dict[str, Any]) -> None:
     await db.execute("UPDATE users SET style_json=? WHERE user_id=?", (json.dumps(style, ensure_ascii=False), user_id))
     await db.commit()
 
 
-async def append_long_memory(db: aiosqlite.Connection, user_id: int, text: str) -> None:
-    await db.execute("UPDATE users SET long_memory=? WHERE user_id=?", (text, user_id))
+@db_timed
+async def append_long_memory(
+    db: aiosqlite.Connection,
+    user_id: int,
+    text: str,
+    *,
+    upto_id: int | None = None,
+) -> None:
+    """Store the rolling summary; `upto_id` is the last memory row it covers."""
+    if upto_id is None:
+        await db.execute("UPDATE users SET long_memory=? WHERE user_id=?", (text, user_id))
+    else:
+        await db.execute(
+            "UPDATE users SET long_memory=?, long_memory_upto=? WHERE user_id=?",
+            (text, upto_id, user_id),
+        )
     await db.commit()
 
 
+@db_timed
 async def find_user_by_ref_code(db: aiosqlite.Connection, ref_code: str) -> Optional[int]:
+    # unique index lookup (idx_users_ref_code)
     async with db.execute("SELECT user_id FROM users WHERE ref_code=?", (ref_code,)) as cur:
         row = await cur.fetchone()
         return int(row["user_id"]) if row else None
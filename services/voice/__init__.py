@@ -1,3 +1,18 @@
-from .speechkit import speech_to_text_oggopus, SpeechkitError
-
-__all__ = ["speech_to_text_oggopus", "SpeechkitError"]
+from .cache import TranscriptionCache
+from .ogg import OggError, split_opus
+from .prefilter import VoicePrefilter, VoiceRejected
+from .speechkit import SpeechkitClient, SpeechkitEmptyResult, SpeechkitError, speech_to_text_oggopus
+from .transcriber import VoiceTranscriber
+
+__all__ = [
+    "split_opus",
+    "speech_to_text_oggopus",
+    "OggError",
+    "SpeechkitClient",
+    "SpeechkitEmptyResult",
+    "SpeechkitError",
+    "TranscriptionCache",
+    "VoicePrefilter",
+    "VoiceRejected",
+    "VoiceTranscriber",
+]
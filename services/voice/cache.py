@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import aiosqlite
+
+
+# prune the SQLite tier once per this many inserts
+PRUNE_EVERY = 200
+
+
+async def get_transcript(db: aiosqlite.Connection, file_unique_id: str) -> Optional[str]:
+    async with db.execute("SELECT text FROM voice_transcripts WHERE file_unique_id=?", (file_unique_id,)) as cur:
+        row = await cur.fetchone()
+        return row["text"] if row else None
+
+
+async def put_transcript(db: aiosqlite.Connection, file_unique_id: str, text: str, *, duration: int = 0) -> None:
+    await db.execute(
+        "INSERT OR REPLACE INTO voice_transcripts(file_unique_id, text, duration, created_at) VALUES(?, ?, ?, ?)",
+        (file_unique_id, text, duration, int(time.time())),
+    )
+    await db.commit()
+
+
+async def prune_transcripts(db: aiosqlite.Connection, keep: int) -> int:
+    """Drop everything but the newest `keep` rows."""
+    # rowids only grow (INSERT OR REPLACE makes a new one), so they order by recency
+    cur = await db.execute(
+        """
+        DELETE FROM voice_transcripts
+        WHERE rowid <= (SELECT rowid FROM voice_transcripts ORDER BY rowid DESC LIMIT 1 OFFSET ?)
+        """,
+        (keep,),
+    )
+    await db.commit()
+    return cur.rowcount or 0
+
+
+class TranscriptionCache:
+    """file_unique_id -> text: in-memory LRU in front of the voice_transcripts table."""
+
+    def __init__(self, db: aiosqlite.Connection, *, memory_items: int = 500, db_items: int = 50000):
+        self.db = db
+        self.memory_items = max(1, memory_items)
+        self.db_items = db_items
+        self._lru: "OrderedDict[str, str]" = OrderedDict()
+        self._puts = 0
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    def _remember(self, key: str, text: str) -> None:
+        self._lru[key] = text
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.memory_items:
+            self._lru.popitem(last=False)
+
+    async def get(self, file_unique_id: str) -> Optional[str]:
+        text = self._lru.get(file_unique_id)
+        if text is not None:
+            self._lru.move_to_end(file_unique_id)
+            self.memory_hits += 1
+            return text
+        text = await get_transcript(self.db, file_unique_id)
+        if text is not None:
+            self._remember(file_unique_id, text)
+            self.db_hits += 1
+            return text
+        self.misses += 1
+        return None
+
+    async def put(self, file_unique_id: str, text: str, *, duration: int = 0) -> None:
+        self._remember(file_unique_id, text)
+        await put_transcript(self.db, file_unique_id, text, duration=duration)
+        self._puts += 1
+        if self.db_items > 0 and self._puts % PRUNE_EVERY == 0:
+            await prune_transcripts(self.db, self.db_items)
+
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.db_hits + self.misses
+        return {
+            "memory_items": len(self._lru),
+            "memory_hits": self.memory_hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.memory_hits + self.db_hits) / lookups, 3) if lookups else 0.0,
+        }
@@ -0,0 +1,305 @@
+"""Minimal Ogg page reader/writer for Telegram voice notes (Ogg/Opus, one stream).
+
+Enough to cut a long note into shorter, independently decodable Ogg/Opus
+files at page boundaries, without ffmpeg.
+"""
+
+from __future__ import annotations
+
+import struct
+from dataclasses import dataclass
+from typing import Iterator, List, Sequence, Tuple
+
+
+class OggError(ValueError):
+    pass
+
+
+OPUS_RATE = 48000
+
+FLAG_CONTINUED = 0x01
+FLAG_BOS = 0x02
+FLAG_EOS = 0x04
+
+_HEADER = struct.Struct("<4sBBqIIIB")  # capture, version, flags, granule, serial, seqno, crc, nsegs
+
+
+def _crc_table() -> Tuple[int, ...]:
+    table = []
+    for i in range(256):
+        r = i << 24
+        for _ in range(8):
+            r = ((r << 1) ^ 0x04C11DB7) if r & 0x80000000 else (r << 1)
+        table.append(r & 0xFFFFFFFF)
+    return tuple(table)
+
+
+_CRC_TABLE = _crc_table()
+
+
+def ogg_crc(data: bytes) -> int:
+    """CRC-32 as Ogg defines it: poly 0x04C11DB7, not reflected, init 0."""
+    crc = 0
+    table = _CRC_TABLE
+    for b in data:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ table[((crc >> 24) ^ b) & 0xFF]
+    return crc
+
+
+@dataclass
+class OggPage:
+    flags: int
+    granule: int
+    serial: int
+    seqno: int
+    lacing: bytes
+    body: bytes
+
+    @property
+    def continued(self) -> bool:
+        return bool(self.flags & FLAG_CONTINUED)
+
+    def packet_sizes(self) -> List[int]:
+        """Sizes of the packet pieces on this page (the last may continue on the next page)."""
+        sizes, cur = [], 0
+        for v in self.lacing:
+            cur += v
+            if v < 255:
+                sizes.append(cur)
+                cur = 0
+        if cur:
+            sizes.append(cur)
+        return sizes
+
+    def ends_packet(self) -> bool:
+        return bool(self.lacing) and self.lacing[-1] < 255
+
+    def to_bytes(self) -> bytes:
+        head = _HEADER.pack(b"OggS", 0, self.flags, self.granule, self.serial, self.seqno, 0, len(self.lacing))
+        raw = head + self.lacing + self.body
+        crc = ogg_crc(raw)
+        return raw[:22] + struct.pack("<I", crc) + raw[26:]
+
+
+def iter_pages(data: bytes, *, verify_crc: bool = True) -> Iterator[OggPage]:
+    pos, n = 0, len(data)
+    while pos < n:
+        if n - pos < _HEADER.size:
+            raise OggError(f"truncated page header at {pos}")
+        capture, version, flags, granule, serial, seqno, crc, nsegs = _HEADER.unpack_from(data, pos)
+        if capture != b"OggS" or version != 0:
+            raise OggError(f"bad page header at {pos}")
+        lacing_end = pos + _HEADER.size + nsegs
+        lacing = data[pos + _HEADER.size : lacing_end]
+        body_end = lacing_end + sum(lacing)
+        if len(lacing) != nsegs or body_end > n:
+            raise OggError(f"truncated page at {pos}")
+        if verify_crc:
+            raw = data[pos:22 + pos] + b"\0\0\0\0" + data[pos + 26 : body_end]
+            if ogg_crc(raw) != crc:
+                raise OggError(f"bad CRC in page {seqno}")
+        yield OggPage(flags, granule, serial, seqno, bytes(lacing), data[lacing_end:body_end])
+        pos = body_end
+
+
+def parse_pages(data: bytes, *, verify_crc: bool = True) -> List[OggPage]:
+    return list(iter_pages(data, verify_crc=verify_crc))
+
+
+@dataclass
+class OpusStream:
+    headers: List[OggPage]  # OpusHead + OpusTags pages
+    audio: List[OggPage]
+    pre_skip: int
+
+    @property
+    def duration(self) -> float:
+        last = next((p.granule for p in reversed(self.audio) if p.granule >= 0), 0)
+        return max(0, last - self.pre_skip) / OPUS_RATE
+
+
+def parse_opus(data: bytes, *, verify_crc: bool = True) -> OpusStream:
+    pages = parse_pages(data, verify_crc=verify_crc)
+    if not pages or not pages[0].body.startswith(b"OpusHead"):
+        raise OggError("not an Ogg/Opus stream")
+    if len({p.serial for p in pages}) != 1:
+        raise OggError("multiplexed Ogg streams are not supported")
+    head = pages[0].body
+    pre_skip = struct.unpack_from("<H", head, 10)[0] if len(head) >= 12 else 0
+
+    # OpusTags is the second packet; it may span several pages
+    i = 1
+    while i < len(pages) and not pages[i].ends_packet():
+        i += 1
+    n_headers = min(len(pages), i + 1)
+    return OpusStream(headers=pages[:n_headers], audio=pages[n_headers:], pre_skip=pre_skip)
+
+
+def iter_packets(pages: Sequence[OggPage]) -> Iterator[bytes]:
+    """Whole packets, reassembled across page boundaries."""
+    pending: List[bytes] = []
+    for p in pages:
+        pos, cur = 0, 0
+        for v in p.lacing:
+            cur += v
+            if v < 255:
+                pending.append(p.body[pos : pos + cur])
+                yield b"".join(pending)
+                pending = []
+                pos += cur
+                cur = 0
+        if cur:
+            pending.append(p.body[pos : pos + cur])
+
+
+# frame length by TOC config (RFC 6716, 3.1): SILK 0-11, hybrid 12-15, CELT 16-31
+_SILK_MS = (10.0, 20.0, 40.0, 60.0)
+_HYBRID_MS = (10.0, 20.0)
+_CELT_MS = (2.5, 5.0, 10.0, 20.0)
+
+
+def opus_packet_seconds(packet: bytes) -> float:
+    """Audio carried by one Opus packet, from its TOC byte."""
+    if not packet:
+        return 0.0
+    toc = packet[0]
+    config = toc >> 3
+    if config < 12:
+        frame_ms = _SILK_MS[config % 4]
+    elif config < 16:
+        frame_ms = _HYBRID_MS[config % 2]
+    else:
+        frame_ms = _CELT_MS[config % 4]
+    code = toc & 0x03
+    if code == 0:
+        frames = 1
+    elif code in (1, 2):
+        frames = 2
+    else:
+        frames = packet[1] & 0x3F if len(packet) > 1 else 0
+    return frames * frame_ms / 1000.0
+
+
+def _cut_candidates(audio: Sequence[OggPage]) -> List[int]:
+    """Indexes i where a new file may start at audio[i]: the page starts a fresh packet
+    and the previous one carries a valid granule."""
+    return [
+        i
+        for i in range(1, len(audio))
+        if not audio[i].continued and audio[i - 1].granule >= 0 and audio[i - 1].ends_packet()
+    ]
+
+
+def _page_activity(p: OggPage) -> float:
+    """Mean packet size: Opus VBR packets shrink to a few bytes in silence."""
+    sizes = p.packet_sizes()
+    return sum(sizes) / len(sizes) if sizes else 0.0
+
+
+def plan_segments(
+    stream: OpusStream,
+    *,
+    max_seconds: float = 25.0,
+    max_bytes: int = 900_000,
+    search_seconds: float = 5.0,
+) -> List[Tuple[int, int]]:
+    """[start, end) ranges of audio pages, each within the limits, cut near silence.
+
+    Inside the last `search_seconds` before a segment would run over, the cut goes
+    to the page boundary whose neighbouring pages carry the smallest packets.
+    """
+    audio = stream.audio
+    if not audio:
+        return []
+    cands = _cut_candidates(audio)
+    header_bytes = sum(len(p.lacing) + len(p.body) + _HEADER.size for p in stream.headers)
+    page_bytes = [len(p.lacing) + len(p.body) + _HEADER.size for p in audio]
+
+    def time_at(i: int) -> float:
+        # seconds of audio before page i
+        return audio[i - 1].granule / OPUS_RATE if i > 0 else 0.0
+
+    segments: List[Tuple[int, int]] = []
+    start = 0
+    ci = 0
+    while True:
+        t0 = time_at(start)
+        size = header_bytes
+        # last candidate that still keeps the segment within limits
+        fits: List[int] = []
+        j = start
+        end_fits = True
+        for i in range(start, len(audio)):
+            size += page_bytes[i]
+            if size > max_bytes or (audio[i].granule >= 0 and audio[i].granule / OPUS_RATE - t0 > max_seconds):
+                end_fits = False
+                j = i
+                break
+        if end_fits:
+            segments.append((start, len(audio)))
+            return segments
+
+        while ci < len(cands) and cands[ci] <= start:
+            ci += 1
+        k = ci
+        while k < len(cands) and cands[k] <= j:
+            fits.append(cands[k])
+            k += 1
+        if not fits:
+            # no clean boundary in range: cut at the next one even if it overruns
+            if k >= len(cands):
+                segments.append((start, len(audio)))
+                return segments
+            fits = [cands[k]]
+
+        limit_t = time_at(fits[-1])
+        window = [c for c in fits if limit_t - time_at(c) <= search_seconds] or fits[-1:]
+        cut = min(window, key=lambda c: (_page_activity(audio[c - 1]) + _page_activity(audio[c]), -c))
+        segments.append((start, cut))
+        start = cut
+
+
+def build_segment(stream: OpusStream, start: int, end: int) -> bytes:
+    """A standalone Ogg/Opus file: the original header pages + audio[start:end],
+    with page numbers and granule positions rebased."""
+    audio = stream.audio[start:end]
+    if not audio:
+        return b""
+    # the copied OpusHead still tells the decoder to drop pre_skip samples, so
+    # a later segment keeps that offset: its end granule minus pre_skip is
+    # exactly the audio it carries
+    base = stream.audio[start - 1].granule - stream.pre_skip if start > 0 else 0
+    out = []
+    seq = 0
+    for p in stream.headers:
+        out.append(OggPage(p.flags & ~FLAG_EOS, p.granule, p.serial, seq, p.lacing, p.body).to_bytes())
+        seq += 1
+    for n, p in enumerate(audio):
+        flags = p.flags & ~(FLAG_EOS | FLAG_BOS)
+        if n == len(audio) - 1:
+            flags |= FLAG_EOS
+        granule = p.granule if p.granule < 0 else max(0, p.granule - base)
+        out.append(OggPage(flags, granule, p.serial, seq, p.lacing, p.body).to_bytes())
+        seq += 1
+    return b"".join(out)
+
+
+def split_opus(
+    data: bytes,
+    *,
+    max_seconds: float = 25.0,
+    max_bytes: int = 900_000,
+    search_seconds: float = 5.0,
+    stream: OpusStream | None = None,
+) -> List[bytes]:
+    """Cut an Ogg/Opus file into pieces SpeechKit's sync endpoint accepts.
+
+    Returns [data] unchanged when it is already small enough. Pass `stream`
+    when `data` has already been parsed.
+    """
+    if stream is None:
+        stream = parse_opus(data)
+    if len(data) <= max_bytes and stream.duration <= max_seconds:
+        return [data]
+    ranges = plan_segments(stream, max_seconds=max_seconds, max_bytes=max_bytes, search_seconds=search_seconds)
+    return [build_segment(stream, s, e) for s, e in ranges]
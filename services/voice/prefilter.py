@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+import logging
+from dataclasses import dataclass
+from typing import Dict
+
+from .ogg import OpusStream, iter_packets, opus_packet_seconds
+
+
+log = logging.getLogger(__name__)
+
+REASON_TOO_SHORT = "too_short"
+REASON_LOW_BITRATE = "low_bitrate"
+REASON_NO_SPEECH = "no_speech"
+
+
+class VoiceRejected(Exception):
+    """The note is too short or carries no speech: not worth a paid STT call."""
+
+    def __init__(self, reason: str, detail: str = ""):
+        super().__init__(f"{reason}: {detail}" if detail else reason)
+        self.reason = reason
+        self.detail = detail
+
+
+@dataclass
+class SpeechActivity:
+    duration: float  # seconds, from granule positions
+    speech_seconds: float  # audio in packets above the activity bitrate
+    packets: int
+
+
+def speech_activity(stream: OpusStream, *, active_bitrate: int = 8000) -> SpeechActivity:
+    """Estimate how much of the note is speech from Opus packet sizes alone.
+
+    Opus VBR spends a few bytes per frame on silence (none at all with DTX),
+    so a packet whose bitrate is under `active_bitrate` counts as pause.
+    """
+    speech = 0.0
+    packets = 0
+    for packet in iter_packets(stream.audio):
+        packets += 1
+        seconds = opus_packet_seconds(packet)
+        if seconds > 0 and len(packet) * 8 / seconds >= active_bitrate:
+            speech += seconds
+    return SpeechActivity(duration=stream.duration, speech_seconds=speech, packets=packets)
+
+
+class VoicePrefilter:
+    """Cheap local checks that turn away taps and silent clips before STT.
+
+    `check_metadata` needs only what Telegram sends with the message (before
+    the download); `check_stream` looks at the parsed audio (before the upload).
+    """
+
+    def __init__(
+        self,
+        *,
+        min_duration_sec: float = 1.0,
+        min_bitrate: int = 3000,
+        min_speech_sec: float = 0.5,
+        active_bitrate: int = 8000,
+    ):
+        self.min_duration_sec = min_duration_sec
+        self.min_bitrate = min_bitrate
+        self.min_speech_sec = min_speech_sec
+        self.active_bitrate = active_bitrate
+        self.checked = 0
+        self.rejected: Dict[str, int] = {}
+
+    def check_metadata(self, duration: int | None, file_size: int | None) -> None:
+        self.checked += 1
+        duration = duration or 0
+        if duration < self.min_duration_sec:
+            raise VoiceRejected(REASON_TOO_SHORT, f"{duration}s")
+        if file_size and self.min_bitrate > 0:
+            bitrate = file_size * 8 / duration
+            if bitrate < self.min_bitrate:
+                raise VoiceRejected(REASON_LOW_BITRATE, f"{bitrate:.0f} bps")
+
+    def check_stream(self, stream: OpusStream) -> SpeechActivity:
+        activity = speech_activity(stream, active_bitrate=self.active_bitrate)
+        if activity.duration < self.min_duration_sec:
+            raise VoiceRejected(REASON_TOO_SHORT, f"{activity.duration:.2f}s")
+        if activity.speech_seconds < self.min_speech_sec:
+            raise VoiceRejected(
+                REASON_NO_SPEECH,
+                f"{activity.speech_seconds:.2f}s of {activity.duration:.1f}s in {activity.packets} packets",
+            )
+        return activity
+
+    def record(self, file_unique_id: str, exc: VoiceRejected) -> None:
+        self.rejected[exc.reason] = self.rejected.get(exc.reason, 0) + 1
+        log.info(
+            "voice %s skipped before STT (%s); STT calls avoided: %d",
+            file_unique_id,
+            exc,
+            self.avoided,
+        )
+
+    @property
+    def avoided(self) -> int:
+        return sum(self.rejected.values())
+
+    def stats(self) -> dict:
+        return {
+            "checked": self.checked,
+            "stt_calls_avoided": self.avoided,
+            "rejected": dict(self.rejected),
+        }
@@ -1,51 +1,131 @@
-# services/voice/speechkit.py
-from __future__ import annotations
-
-import httpx
-
-
-class SpeechkitError(RuntimeError):
-    pass
-
-
-async def speech_to_text_oggopus(
-    audio_bytes: bytes,
-    *,
-    api_key: str,
-    folder_id: str = "",
-    lang: str = "ru-RU",
-    topic: str = "general",
-    timeout_sec: int = 25,
-) -> str:
-    """
-    Telegram voice -> ogg/opus. SpeechKit умеет format=oggopus.
-    """
-    if not api_key:
-        raise SpeechkitError("SPEECHKIT_API_KEY is empty")
-
-    url = "https://stt.api.cloud.yandex.net/speech/v1/stt:recognize"
-    params = {"lang": lang, "format": "oggopus"}
-    if topic:
-        params["topic"] = topic
-    if folder_id:
-        params["folderId"] = folder_id
-
-    headers = {"Authorization": f"Api-Key {api_key}"}
-
-    timeout = httpx.Timeout(timeout_sec, connect=10.0)
-    async with httpx.AsyncClient(timeout=timeout) as client:
-        r = await client.post(url, params=params, headers=headers, content=audio_bytes)
-
-    try:
-        data = r.json()
-    except Exception as e:
-        raise SpeechkitError(f"SpeechKit non-JSON response, status={r.status_code}") from e
-
-    if r.status_code != 200:
-        raise SpeechkitError(f"SpeechKit HTTP {r.status_code}: {data}")
-
-    text = (data.get("result") or "").strip()
-    if not text:
-        raise SpeechkitError(f"SpeechKit empty result: {data}")
-
-    return text
+# services/voice/speechkit.py
+from __future__ import annotations
+
+import time
+from collections import deque
+from typing import AsyncIterable, Deque, Union
+
+import httpx
+
+from services import tracing
+
+
+STT_URL = "https://stt.api.cloud.yandex.net/speech/v1/stt:recognize"
+
+
+class SpeechkitError(RuntimeError):
+    pass
+
+
+class SpeechkitEmptyResult(SpeechkitError):
+    """Recognition went fine but heard no words."""
+
+
+def _percentile_ms(vals: Deque[float], q: float) -> float:
+    if not vals:
+        return 0.0
+    s = sorted(vals)
+    return round(s[min(len(s) - 1, int(q * len(s)))] * 1000, 1)
+
+
+class SpeechkitClient:
+    """One pooled keep-alive client for all recognitions (no TLS handshake per voice)."""
+
+    def __init__(
+        self,
+        *,
+        api_key: str,
+        folder_id: str = "",
+        lang: str = "ru-RU",
+        topic: str = "general",
+        timeout_sec: int = 25,
+        transport: httpx.AsyncBaseTransport | None = None,
+    ):
+        self.api_key = api_key
+        self.folder_id = folder_id
+        self.lang = lang
+        self.topic = topic
+        self._client = httpx.AsyncClient(
+            timeout=httpx.Timeout(timeout_sec, connect=10.0),
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=60.0),
+            transport=transport,
+        )
+        self.calls = 0
+        self.errors = 0
+        self.streamed = 0
+        self._latency: Deque[float] = deque(maxlen=500)
+
+    async def close(self) -> None:
+        await self._client.aclose()
+
+    async def recognize(self, audio: Union[bytes, AsyncIterable[bytes]]) -> str:
+        """Telegram voice -> ogg/opus. SpeechKit умеет format=oggopus.
+
+        `audio` may be an async iterator of chunks: httpx then sends a chunked
+        body as the chunks arrive, so the upload can overlap the download.
+        """
+        if not self.api_key:
+            raise SpeechkitError("SPEECHKIT_API_KEY is empty")
+
+        params = {"lang": self.lang, "format": "oggopus"}
+        if self.topic:
+            params["topic"] = self.topic
+        if self.folder_id:
+            params["folderId"] = self.folder_id
+        headers = {"Authorization": f"Api-Key {self.api_key}"}
+
+        self.calls += 1
+        if not isinstance(audio, (bytes, bytearray, memoryview)):
+            self.streamed += 1
+        started = time.monotonic()
+        size = len(audio) if isinstance(audio, (bytes, bytearray, memoryview)) else "streamed"
+        try:
+            with tracing.span("stt.recognize", bytes=size) as sp:
+                r = await self._client.post(STT_URL, params=params, headers=headers, content=audio)
+                sp.set(status=r.status_code)
+        except httpx.HTTPError:
+            self.errors += 1
+            raise
+        self._latency.append(time.monotonic() - started)
+
+        try:
+            data = r.json()
+        except Exception as e:
+            self.errors += 1
+            raise SpeechkitError(f"SpeechKit non-JSON response, status={r.status_code}") from e
+
+        if r.status_code != 200:
+            self.errors += 1
+            raise SpeechkitError(f"SpeechKit HTTP {r.status_code}: {data}")
+
+        text = (data.get("result") or "").strip()
+        if not text:
+            raise SpeechkitEmptyResult(f"SpeechKit empty result: {data}")
+
+        return text
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "streamed": self.streamed,
+            "stt_p50_ms": _percentile_ms(self._latency, 0.50),
+            "stt_p95_ms": _percentile_ms(self._latency, 0.95),
+        }
+
+
+async def speech_to_text_oggopus(
+    audio_bytes: bytes,
+    *,
+    api_key: str,
+    folder_id: str = "",
+    lang: str = "ru-RU",
+    topic: str = "general",
+    timeout_sec: int = 25,
+) -> str:
+    """One-off recognition with its own client; the bot uses a shared SpeechkitClient."""
+    client = SpeechkitClient(api_key=api_key, folder_id=folder_id, lang=lang, topic=topic, timeout_sec=timeout_sec)
+    try:
+        return await client.recognize(audio_bytes)
+    finally:
+        await client.close()
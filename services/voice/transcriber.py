@@ -0,0 +1,201 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import resource
+import time
+from collections import deque
+from typing import AsyncIterator, Deque, Dict, List
+
+from aiogram import Bot
+from aiogram.types import Voice
+
+from services import tracing
+
+from .cache import TranscriptionCache
+from .ogg import OggError, parse_opus, split_opus
+from .prefilter import VoicePrefilter, VoiceRejected
+from .speechkit import SpeechkitClient, SpeechkitEmptyResult, _percentile_ms
+
+
+log = logging.getLogger(__name__)
+
+DOWNLOAD_CHUNK = 64 * 1024
+DOWNLOAD_TIMEOUT = 30
+
+
+def _maxrss_kb() -> int:
+    # Linux reports KiB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class VoiceTranscriber:
+    """Voice message -> text: cache first, then download + SpeechKit.
+
+    The same voice being transcribed concurrently (a forward burst) shares
+    one download and one recognition. Short notes are streamed from the
+    Telegram download straight into the STT request body; notes longer than
+    the sync STT limits are downloaded, cut into Ogg/Opus segments near
+    pauses and recognized in parallel. An optional prefilter turns away
+    taps and silent clips before anything is downloaded or uploaded.
+    """
+
+    def __init__(
+        self,
+        client: SpeechkitClient,
+        cache: TranscriptionCache,
+        *,
+        max_segment_sec: float = 25.0,
+        max_segment_bytes: int = 900_000,
+        parallelism: int = 4,
+        stream_upload: bool = True,
+        prefilter: VoicePrefilter | None = None,
+    ):
+        self.client = client
+        self.cache = cache
+        self.max_segment_sec = max_segment_sec
+        self.max_segment_bytes = max_segment_bytes
+        self.parallelism = max(1, parallelism)
+        self.stream_upload = stream_upload
+        self.prefilter = prefilter
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._download: Deque[float] = deque(maxlen=500)
+        self._total: Deque[float] = deque(maxlen=500)
+        self._total_streamed: Deque[float] = deque(maxlen=500)
+        self.streamed = 0
+        self.segmented = 0
+        self.segments = 0
+
+    async def transcribe(self, bot: Bot, voice: Voice) -> str:
+        key = voice.file_unique_id
+        cached = await self.cache.get(key)
+        if cached is not None:
+            return cached
+
+        if self.prefilter is not None:
+            try:
+                self.prefilter.check_metadata(voice.duration, voice.file_size)
+            except VoiceRejected as e:
+                self.prefilter.record(key, e)
+                raise
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._transcribe(bot, voice))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    def _can_stream(self, voice: Voice, file_size: int | None) -> bool:
+        # a streamed body can't be split afterwards, so only notes that surely fit
+        return (
+            self.stream_upload
+            and 0 < (voice.duration or 0) <= self.max_segment_sec
+            and 0 < (file_size or 0) <= self.max_segment_bytes
+        )
+
+    @tracing.traced("stt.transcribe")
+    async def _transcribe(self, bot: Bot, voice: Voice) -> str:
+        started = time.monotonic()
+        file = await bot.get_file(voice.file_id)
+
+        if self._can_stream(voice, file.file_size or voice.file_size):
+            mode = "streamed"
+            self.streamed += 1
+            text = await self.client.recognize(self._download_chunks(bot, file.file_path))
+            self._total_streamed.append(time.monotonic() - started)
+        else:
+            mode = "buffered"
+            with tracing.span("stt.download"):
+                chunks: List[bytes] = [c async for c in self._download_chunks(bot, file.file_path)]
+            self._download.append(time.monotonic() - started)
+            # one join instead of BytesIO + getvalue(): a single full-size buffer
+            try:
+                text = await self.recognize(b"".join(chunks))
+            except VoiceRejected as e:
+                if self.prefilter is not None:
+                    self.prefilter.record(voice.file_unique_id, e)
+                raise
+            self._total.append(time.monotonic() - started)
+
+        log.info(
+            "voice %s: %s, %ss, %s bytes, %.0f ms, maxrss %d KiB",
+            voice.file_unique_id,
+            mode,
+            voice.duration,
+            file.file_size,
+            (time.monotonic() - started) * 1000,
+            _maxrss_kb(),
+        )
+        await self.cache.put(voice.file_unique_id, text, duration=voice.duration or 0)
+        return text
+
+    async def _download_chunks(self, bot: Bot, file_path: str) -> AsyncIterator[bytes]:
+        url = bot.session.api.file_url(bot.token, file_path)
+        async for chunk in bot.session.stream_content(
+            url=url,
+            timeout=DOWNLOAD_TIMEOUT,
+            chunk_size=DOWNLOAD_CHUNK,
+            raise_for_status=True,
+        ):
+            yield chunk
+
+    def _prepare(self, audio: bytes) -> List[bytes]:
+        try:
+            stream = parse_opus(audio)
+        except OggError:
+            return [audio]
+        if self.prefilter is not None:
+            self.prefilter.check_stream(stream)
+        return split_opus(
+            audio,
+            max_seconds=self.max_segment_sec,
+            max_bytes=self.max_segment_bytes,
+            stream=stream,
+        )
+
+    async def recognize(self, audio: bytes) -> str:
+        # CRC + page walk is pure Python; keep it off the event loop
+        with tracing.span("stt.prepare", bytes=len(audio)):
+            chunks = await asyncio.to_thread(self._prepare, audio)
+        if len(chunks) == 1:
+            return await self.client.recognize(chunks[0])
+
+        self.segmented += 1
+        self.segments += len(chunks)
+        sem = asyncio.Semaphore(self.parallelism)
+
+        async def one(chunk: bytes) -> str:
+            async with sem:
+                try:
+                    return await self.client.recognize(chunk)
+                except SpeechkitEmptyResult:
+                    # a segment that is all pause
+                    return ""
+
+        parts = await asyncio.gather(*(one(c) for c in chunks))
+        text = " ".join(p for p in parts if p)
+        if not text:
+            raise SpeechkitEmptyResult("SpeechKit empty result for every segment")
+        return text
+
+    async def close(self) -> None:
+        await self.client.close()
+
+    def stats(self) -> dict:
+        return {
+            "cache": self.cache.stats(),
+            "prefilter": self.prefilter.stats() if self.prefilter else {},
+            "stt": self.client.stats(),
+            "download_p50_ms": _percentile_ms(self._download, 0.50),
+            "download_p95_ms": _percentile_ms(self._download, 0.95),
+            "total_p50_ms": _percentile_ms(self._total, 0.50),
+            "total_p95_ms": _percentile_ms(self._total, 0.95),
+            "streamed_voices": self.streamed,
+            "streamed_total_p50_ms": _percentile_ms(self._total_streamed, 0.50),
+            "streamed_total_p95_ms": _percentile_ms(self._total_streamed, 0.95),
+            "maxrss_kb": _maxrss_kb(),
+            "segmented_voices": self.segmented,
+            "segments": self.segments,
+            "inflight": len(self._inflight),
+        }
@@ -0,0 +1,83 @@
+import re
+
+import pytest
+
+from services.llm.features import analyze
+
+# the per-feature regexes analyze() replaced, kept verbatim as the baseline
+_MEDICAL_RE = re.compile(
+    r"\b(болит|боль|температур|кашел|насморк|давлен|пульс|тошнит|рвот|понос|диаре|сыпь|аллерг|анализ|симптом|врач|лекарств|таблет|антибиот|дозировк|мг|ml|мл)\b",
+    re.IGNORECASE,
+)
+_DOSAGE_RE = re.compile(r"\b(\d+\s?(мг|mg|мл|ml|таб|капс))\b", re.IGNORECASE)
+_DISCIPLINE_RE = re.compile(
+    r"\b(дисциплин|режим|привычк|цели|план|мотивац|продуктив|сон|тренировк|чек\s?-?ин|отч[её]т)\b",
+    re.IGNORECASE,
+)
+_NEEDS_WEB_RE = re.compile(
+    r"\b(сегодня|сейчас|последн|новост|актуал|цена|стоимост|курс|ставк|расписан|закон|регламент|обновлен|202[4-9]|президент|ceo)\b",
+    re.IGNORECASE,
+)
+_EMOJI_RE = re.compile(r"[\U0001F300-\U0001FAFF\u2600-\u27BF]")
+_PROFANITY_RE = re.compile(r"\b(бля|сука|нах|хуй|пизд|ёб|еба|заеб|пох|мудак)\b", re.IGNORECASE)
+
+
+def _baseline(text):
+    return {
+        "medical": bool(_MEDICAL_RE.search(text)),
+        "dosage": "доз" in text.lower() or bool(_DOSAGE_RE.search(text)),
+        "discipline": bool(_DISCIPLINE_RE.search(text)),
+        "needs_web": bool(_NEEDS_WEB_RE.search(text)),
+        "emoji": len(_EMOJI_RE.findall(text)),
+        "profanity": len(_PROFANITY_RE.findall(text)),
+        "length": len(text.strip()),
+    }
+
+
+KEYWORDS = [
+    "болит", "боль", "температур", "кашел", "врач", "таблет", "дозировк", "мг", "ml", "мл",
+    "дисциплин", "режим", "привычк", "цели", "план", "сон", "отчет", "отчёт",
+    "сегодня", "сейчас", "новост", "цена", "курс", "закон", "2024", "2029", "2030", "2023", "президент", "ceo",
+    "бля", "сука", "нах", "пох", "ёб", "мудак",
+]
+
+CORPUS = [
+    "",
+    "   ",
+    "Привет! Как дела?",
+    "У меня болит голова и температура 38",
+    "Болит горло, кашель, насморк",
+    "Сколько мг парацетамола можно?",
+    "Выпил 500 мг ибупрофена",
+    "500мг, 2 таб, 10 ml, 5 капс",
+    "какая доза витамина D",
+    "Дозировка?",
+    "Сделаем чекин вечером",
+    "Сделаем чек-ин вечером",
+    "чек ин / чек -ин / чекин",
+    "хочу режим сна и план тренировок",
+    "Отчёт за неделю: сон 7 часов",
+    "Какой курс доллара сегодня?",
+    "Новости за 2025 год",
+    "Что изменилось в 2024-2025?",
+    "CEO компании и президент",
+    "бля, сука, это нах не работает",
+    "Сукааа, блять",
+    "пох пох ПОХ",
+    "😀🔥 ☀️ ✅ ok",
+    "текст без ключевых слов, просто болтовня о погоде",
+    "таблетка, таблеток, таблет",
+    "Температура 37.5, пульс 90, давление 120/80",
+    "мгновенно, сонный, планета, курсор",
+    "ЦЕЛИ, ПЛАН, МОТИВАЦИЯ",
+    "x" * 5000 + " врач " + "y" * 5000,
+]
+for kw in KEYWORDS:
+    CORPUS += [f"у меня {kw} вчера", f"{kw.upper()}!", f"при{kw}", f"{kw}ы", f"({kw})"]
+
+
+@pytest.mark.parametrize("text", CORPUS)
+def test_analyze_matches_the_regexes_it_replaced(text):
+    f = analyze(text)
+    got = {k: getattr(f, k) for k in ("medical", "dosage", "discipline", "needs_web", "emoji", "profanity", "length")}
+    assert got == _baseline(text)
@@ -0,0 +1,99 @@
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+
+from services.llm.openai_compat import OpenAICompatClient
+from services.llm.pacing import ProviderPacer, TokenBucket, parse_duration
+
+
+def _ok(usage=None, headers=None):
+    body = {"choices": [{"message": {"content": "ok"}}]}
+    if usage is not None:
+        body["usage"] = {"total_tokens": usage}
+    return httpx.Response(200, headers=headers or {}, content=json.dumps(body))
+
+
+def _client(pacer, handler):
+    return OpenAICompatClient(
+        api_key="k",
+        base_url="https://llm.test/v1",
+        default_model="m",
+        pacer=pacer,
+        transport=httpx.MockTransport(handler),
+    )
+
+
+async def _chat(client, **kw):
+    try:
+        return await client.chat(messages=[{"role": "user", "content": "x" * 400}], max_tokens=100, **kw)
+    finally:
+        await client.aclose()
+
+
+@pytest.mark.parametrize(
+    "value, seconds",
+    [("1", 1.0), ("0.5", 0.5), ("20ms", 0.02), ("6m0s", 360.0), ("1h2m3.5s", 3723.5), ("", None), ("soon", None)],
+)
+def test_parse_duration(value, seconds):
+    assert parse_duration(value) == (pytest.approx(seconds) if seconds is not None else None)
+
+
+def test_bucket_refills_per_minute_up_to_capacity():
+    b = TokenBucket(capacity=120, updated=100.0)
+    b.take(120)
+    b.refill(110.0)  # 10 s at 2 per second
+    assert b.tokens == pytest.approx(20)
+    assert b.delay_for(30, 110.0) == pytest.approx(5.0)
+    b.refill(1000.0)
+    assert b.tokens == 120
+
+
+def test_headers_set_limits_and_clamp_remaining():
+    pacer = ProviderPacer("p")  # no configured limits: learnt from headers
+    headers = {
+        "x-ratelimit-limit-requests": "60",
+        "x-ratelimit-remaining-requests": "10",
+        "x-ratelimit-limit-tokens": "6000",
+        "x-ratelimit-remaining-tokens": "1000",
+    }
+    asyncio.run(_chat(_client(pacer, lambda req: _ok(usage=150, headers=headers))))
+
+    assert pacer.requests.capacity == 60
+    assert pacer.requests.tokens == pytest.approx(10, abs=0.1)
+    assert pacer.tokens.capacity == 6000
+    # clamped to the server's 1000, then corrected by real usage minus the estimate
+    est = 400 // 4 + 100
+    assert pacer.tokens.tokens == pytest.approx(1000 - (150 - est), abs=1)
+
+    # and from there it refills at limit/60 per second
+    pacer.requests.refill(pacer.requests.updated + 30)
+    assert pacer.requests.tokens == pytest.approx(40, abs=0.1)
+
+
+def test_exhausted_bucket_blocks_until_reset():
+    pacer = ProviderPacer("p", rpm=100)
+    now = time.monotonic()
+    pacer.observe({"x-ratelimit-remaining-requests": "0", "x-ratelimit-reset-requests": "2s"}, 200)
+    assert pacer.delay_for(1, now) == pytest.approx(2.0, abs=0.1)
+
+
+def test_429_pauses_the_provider_and_retries():
+    pacer = ProviderPacer("p", rpm=600)
+    calls = []
+
+    def handler(req):
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            return httpx.Response(429, headers={"retry-after": "0.2"}, content=b"slow down")
+        return _ok()
+
+    resp = asyncio.run(_chat(_client(pacer, handler)))
+
+    assert resp.content == "ok"
+    assert len(calls) == 2
+    assert calls[1] - calls[0] >= 0.2
+    assert pacer.throttled == 1
+    assert pacer.delayed == 1
@@ -0,0 +1,43 @@
+from hypothesis import given, settings, strategies as st
+
+from services.llm.postprocess import split_parts, split_problems, utf16_len
+
+TAGS = ["b", "i", "u", "code", "pre", "blockquote"]
+
+words = st.one_of(
+    st.text(st.characters(blacklist_categories=("Cs", "Cc", "Zs", "Zl", "Zp"), blacklist_characters="<>&"), min_size=1, max_size=12),
+    st.sampled_from(["привет", "слово.", "Конец!", "😀😀", "𝔘𝔫𝔦", "&amp;", "&lt;", "&#128512;", "&#x1F600;", "x" * 300]),
+)
+separators = st.sampled_from([" ", "  ", "\n", "\n\n", ". ", "! "])
+
+
+def _wrap(children):
+    return st.tuples(st.sampled_from(TAGS), children).map(lambda t: f"<{t[0]}>{t[1]}</{t[0]}>")
+
+
+fragments = st.recursive(
+    st.lists(st.one_of(words, separators), min_size=1, max_size=30).map("".join),
+    lambda children: st.lists(st.one_of(children, _wrap(children)), min_size=1, max_size=6).map("".join),
+    max_leaves=40,
+)
+
+
+@settings(max_examples=300, deadline=None)
+@given(src=fragments, limit=st.integers(min_value=8, max_value=400))
+def test_split_parts_keeps_text_and_limits(src, limit):
+    parts = split_parts(src, limit)
+    if utf16_len(src) <= limit:
+        assert parts == [src]
+        return
+    assert split_problems(src, parts, limit) == []
+
+
+def test_split_parts_cuts_at_paragraphs():
+    src = "\n\n".join(["<b>" + "слово " * 40 + "</b>"] * 5)
+    parts = split_parts(src, 300)
+    assert split_problems(src, parts, 300) == []
+    assert all(p.startswith("<b>") and p.endswith("</b>") for p in parts)
+
+
+def test_split_problems_reports_a_cut_entity():
+    assert split_problems("a &amp; b", ["a &am", "p; b"], 50)
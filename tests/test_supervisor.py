@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+
+from services.llm.supervisor import HANDLER_TURN, POLICY_CANCEL, POLICY_MERGE, POLICY_QUEUE, GenerationSupervisor
+
+
+class Flows:
+    """A flow that takes a while to start and to wind down after a cancel."""
+
+    def __init__(self):
+        self.running = 0
+        self.max_running = 0
+        self.started = []
+        self.finished = []
+
+    async def __call__(self, text, progress):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        self.started.append(text)
+        try:
+            await asyncio.sleep(0.05)
+            self.finished.append(text)
+        except asyncio.CancelledError:
+            # e.g. the refund and the "superseded" edit
+            await asyncio.sleep(0.02)
+            raise
+        finally:
+            self.running -= 1
+
+
+async def _three_back_to_back(policy):
+    sup = GenerationSupervisor(policy)
+    flows = Flows()
+    first = asyncio.create_task(sup.run(1, "a", flows))
+    await asyncio.sleep(0.01)  # the first one is streaming
+    rest = [asyncio.create_task(sup.run(1, t, flows)) for t in ("b", "c")]
+    results = await asyncio.gather(first, *rest)
+    return sup, flows, results
+
+
+@pytest.mark.parametrize("policy", [POLICY_CANCEL, POLICY_MERGE])
+def test_three_messages_leave_one_generation(policy):
+    sup, flows, results = asyncio.run(_three_back_to_back(policy))
+    assert flows.max_running == 1
+    assert results == [False, False, True]
+    assert len(flows.finished) == 1
+    if policy == POLICY_MERGE:
+        assert flows.finished == ["a\n\nb\n\nc"]
+    else:
+        assert flows.finished == ["c"]
+    assert sup.stats()["inflight"] == 0
+
+
+def test_three_messages_queue_in_order():
+    sup, flows, results = asyncio.run(_three_back_to_back(POLICY_QUEUE))
+    assert flows.max_running == 1
+    assert results == [True, True, True]
+    assert flows.finished == ["a", "b", "c"]
+
+
+def test_run_hands_back_the_turn_once_registered():
+    async def main():
+        sup = GenerationSupervisor(POLICY_CANCEL)
+        flows = Flows()
+        turn = asyncio.Event()
+
+        async def handler():
+            HANDLER_TURN.set(turn)
+            return await sup.run(1, "a", flows)
+
+        first = asyncio.create_task(handler())
+        await asyncio.wait_for(turn.wait(), 0.01)  # long before the answer is done
+        assert not first.done()
+        second = await sup.run(1, "b", flows)
+        return await first, second, flows
+
+    first, second, flows = asyncio.run(main())
+    assert (first, second) == (False, True)
+    assert flows.finished == ["b"]
@@ -1,16 +1,18 @@
 from __future__ import annotations
 
+import hmac
 import json
+import time
 from datetime import datetime, timezone
-from typing import Any
+from typing import Any, Callable, Dict, Iterable, List, Tuple
 
 from aiohttp import web
-from aiogram import Bot
-import aiosqlite
 
 from services.crypto_pay import CryptoPayClient, verify_signature
-from services import invoices as invoices_repo
-from services.jobs import handle_invoice_status
+from services.cryptopay_inbox import CryptoPayInbox
+from services.metrics import CONTENT_TYPE, CRYPTOPAY_WEBHOOKS, REGISTRY
+from services.profiler import MAX_SECONDS, ProfilerBusy, SamplingProfiler
+from web.telegram_webhook import TelegramWebhookIngress
 
 
 def _parse_iso(dt_str: str) -> datetime | None:
@@ -23,29 +25,79 @@ def _parse_iso(dt_str: str) -> datetime | None:
 
 def create_app(
     *,
-    bot: Bot,
-    db: aiosqlite.Connection,
     cryptopay: CryptoPayClient,
+    inbox: CryptoPayInbox,
     webhook_secret: str,
+    stats_secret: str | None = None,
+    stats: dict[str, Callable[[], Any]] | None = None,
+    metrics_token: str | None = None,
+    metric_dumps: Callable[[], Iterable[Tuple[Dict[str, str], List[dict]]]] | None = None,
+    profiler: SamplingProfiler | None = None,
+    telegram: TelegramWebhookIngress | None = None,
+    telegram_path: str = "/tg/webhook",
 ) -> web.Application:
     app = web.Application()
 
     async def health(_: web.Request) -> web.Response:
         return web.json_response({"ok": True})
 
+    async def stats_view(request: web.Request) -> web.Response:
+        if not stats_secret or request.match_info.get("secret") != stats_secret:
+            return web.Response(status=404, text="not found")
+        out: dict[str, Any] = {}
+        for name, fn in (stats or {}).items():
+            try:
+                out[name] = fn()
+            except Exception as e:
+                out[name] = {"error": str(e)}
+        return web.json_response(out)
+
+    async def metrics_view(request: web.Request) -> web.Response:
+        auth = request.headers.get("Authorization", "")
+        if not metrics_token or not hmac.compare_digest(auth, f"Bearer {metrics_token}"):
+            return web.Response(status=404, text="not found")
+        body = REGISTRY.render(merged=metric_dumps() if metric_dumps else ())
+        return web.Response(body=body.encode("utf-8"), headers={"Content-Type": CONTENT_TYPE})
+
+    async def profile_view(request: web.Request) -> web.Response:
+        # same secret as /stats; profiles this (ingress) process
+        if profiler is None or not stats_secret or request.match_info.get("secret") != stats_secret:
+            return web.Response(status=404, text="not found")
+        try:
+            seconds = int(request.query.get("seconds", "10"))
+            top_n = int(request.query.get("n", "30"))
+        except ValueError:
+            return web.Response(status=400, text="seconds and n must be integers")
+        if not 1 <= seconds <= MAX_SECONDS:
+            return web.Response(status=400, text=f"seconds must be 1..{MAX_SECONDS}")
+        try:
+            profile = await profiler.run(seconds)
+        except ProfilerBusy:
+            return web.Response(status=409, text="a profile is already being taken")
+        if request.query.get("format") == "top":
+            return web.Response(text=profile.top_table(top_n))
+        return web.Response(
+            text=profile.collapsed(),
+            headers={"Content-Disposition": f'attachment; filename="profile-{int(time.time())}.folded"'},
+        )
+
     async def cryptopay_webhook(request: web.Request) -> web.Response:
+        started = time.monotonic()
         # secret in path
         if request.match_info.get("secret") != webhook_secret:
+            CRYPTOPAY_WEBHOOKS.labels("bad_secret").inc()
             return web.Response(status=404, text="not found")
 
         raw = await request.read()
         sig = request.headers.get("crypto-pay-api-signature")
         if not verify_signature(cryptopay.api_token, raw, sig):
+            CRYPTOPAY_WEBHOOKS.labels("bad_signature").inc()
             return web.Response(status=401, text="bad signature")
 
         try:
             payload = json.loads(raw.decode("utf-8"))
         except Exception:
+            CRYPTOPAY_WEBHOOKS.labels("bad_json").inc()
             return web.Response(status=400, text="bad json")
 
         # optional freshness check
@@ -55,18 +107,28 @@ def create_app(
             if dt:
                 age = abs((datetime.now(timezone.utc) - dt.astimezone(timezone.utc)).total_seconds())
                 if age > 60 * 60:  # 1 hour
+                    CRYPTOPAY_WEBHOOKS.labels("stale").inc()
                     return web.Response(status=400, text="stale")
 
+        result = "ignored"
         update_type = payload.get("update_type")
         if update_type == "invoice_paid":
             inv = payload.get("payload") or {}
             invoice_id = int(inv.get("invoice_id", 0) or 0)
             status = str(inv.get("status") or "paid")
             if invoice_id:
-                await handle_invoice_status(bot, db, invoice_id, status, inv)
+                # persist and ack; the inbox worker applies it (retries are deduplicated there)
+                inserted = await inbox.submit(invoice_id, status, inv, started=started)
+                result = "accepted" if inserted else "duplicate"
+        CRYPTOPAY_WEBHOOKS.labels(result).inc()
 
         return web.json_response({"ok": True})
 
     app.router.add_get("/health", health)
+    app.router.add_get("/stats/{secret}", stats_view)
+    app.router.add_get("/metrics", metrics_view)
+    app.router.add_get("/profile/{secret}", profile_view)
     app.router.add_post("/cryptopay/webhook/{secret}", cryptopay_webhook)
+    if telegram is not None:
+        app.router.add_post(telegram_path, telegram.handle)
     return app
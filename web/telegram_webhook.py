@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+import asyncio
+import hmac
+import json
+import logging
+import time
+from collections import deque
+from typing import Any, Deque, Set
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+
+log = logging.getLogger("tg_webhook")
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class TelegramWebhookIngress:
+    """Receives Telegram updates over HTTPS and acks them right away.
+
+    Handlers run as background tasks, at most `max_pending` at a time. Past
+    that we answer 503, and Telegram redelivers the update later.
+    """
+
+    def __init__(
+        self,
+        *,
+        bot: Bot,
+        dispatcher: Dispatcher,
+        secret: str,
+        context: dict[str, Any],
+        max_pending: int = 256,
+    ):
+        self.bot = bot
+        self.dispatcher = dispatcher
+        self.secret = secret
+        self.context = context
+        self.max_pending = max_pending
+        self._tasks: Set[asyncio.Task] = set()
+        self.received = 0
+        self.rejected = 0
+        self.failed = 0
+        self._dispatch_delay: Deque[float] = deque(maxlen=1000)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        got = request.headers.get(SECRET_HEADER, "")
+        if not self.secret or not hmac.compare_digest(got.encode(), self.secret.encode()):
+            return web.Response(status=401, text="bad secret")
+
+        if len(self._tasks) >= self.max_pending:
+            self.rejected += 1
+            return web.Response(status=503, text="busy")
+
+        try:
+            data = json.loads(await request.read())
+            update = Update.model_validate(data, context={"bot": self.bot})
+        except Exception:
+            return web.Response(status=400, text="bad update")
+
+        self.received += 1
+        task = asyncio.create_task(self._process(update, time.monotonic()))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response(status=200)
+
+    async def _process(self, update: Update, received_at: float) -> None:
+        self._dispatch_delay.append(time.monotonic() - received_at)
+        try:
+            await self.dispatcher.feed_update(self.bot, update, **self.context)
+        except Exception:
+            self.failed += 1
+            log.exception("update %s failed", update.update_id)
+
+    async def close(self, timeout: float = 10.0) -> None:
+        if self._tasks:
+            await asyncio.wait(set(self._tasks), timeout=timeout)
+
+    def stats(self) -> dict:
+        d = sorted(self._dispatch_delay)
+        return {
+            "received": self.received,
+            "rejected_busy": self.rejected,
+            "failed": self.failed,
+            "pending": len(self._tasks),
+            "dispatch_delay_p50_ms": round(d[len(d) // 2] * 1000, 3) if d else 0.0,
+            "dispatch_delay_max_ms": round(d[-1] * 1000, 3) if d else 0.0,
+        }